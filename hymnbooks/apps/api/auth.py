@@ -1,11 +1,13 @@
+from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
-from django.contrib.sessions.models import Session
+from django.utils.crypto import constant_time_compare
+from django.utils.importlib import import_module
 
 from tastypie.authentication import BasicAuthentication, ApiKeyAuthentication
 from tastypie.authorization import Authorization
 from tastypie.exceptions import Unauthorized
 
-from hymnbooks.apps.core import utils
+from hymnbooks.apps.core import cache, utils
 from hymnbooks.apps.core.models import MongoUser, MongoGroup, \
      create_api_key, control_permissions
 
@@ -35,6 +37,47 @@ def get_created_by(obj):
     return created_by
 
 
+def get_owner_document(obj):
+    """
+    Returns resource object, or its parent object (which resource object
+    is embedded into) - whichever stores `created_by`.
+    """
+    if hasattr(obj, 'created_by'):
+        return obj
+    return obj.parent
+
+
+def filter_created_by(object_list, user):
+    """
+    Returns objects from `object_list` created by `user`.
+
+    Ownership of saved documents is checked with a single projected query
+    over their ids, without dereferencing `created_by` one by one. Unsaved
+    documents are checked in memory.
+    """
+    if hasattr(object_list, '_document'):
+        # QuerySet: simply narrow it down.
+        return object_list.filter(created_by=user)
+
+    owners = [get_owner_document(obj) for obj in object_list]
+    ids = set(owner.id for owner in owners if owner.id is not None)
+    owned_ids = set()
+    if ids:
+        document_class = owners[0].__class__
+        owned_ids = set(document_class.objects(id__in=ids, created_by=user)\
+                        .scalar('id'))
+
+    owned = []
+    for obj, owner in zip(object_list, owners):
+        if owner.id is None:
+            if owner.created_by == user:
+                owned.append(obj)
+        elif owner.id in owned_ids:
+            owned.append(obj)
+
+    return owned
+
+
 def get_document_type(obj):
     """
     Returns document_type of resource object, or document_type of its parent
@@ -72,22 +115,31 @@ class AppApiKeyAuthentication(ApiKeyAuthentication):
         if not username or not api_key:
             return self.super_self._unauthorized()
 
-        lookup = {'username': username}
-        try:
-            user = MongoUser.objects.get(**lookup)
-        except (MongoUser.DoesNotExist, MongoUser.MultipleObjectsReturned):
-            return self.super_self._unauthorized()
+        credentials = cache.credentials.get(username)
+        if credentials is None:
+            try:
+                user = MongoUser.objects.get(username=username)
+            except (MongoUser.DoesNotExist, MongoUser.MultipleObjectsReturned):
+                return self.super_self._unauthorized()
 
-        if not self.super_self.check_active(user):
+            credentials = (str(user.id), cache.digest(user.api_key),
+                           user.is_active)
+            cache.credentials.set(username, credentials)
+            cache.set_user(user)
+
+        user_id, api_key_digest, is_active = credentials
+        if self.require_active and not is_active:
             return False
 
+        if not constant_time_compare(cache.digest(api_key), api_key_digest):
+            return self.super_self._unauthorized()
+
         try:
-            MongoUser.objects.get(username=username, api_key=api_key)
+            request.user = cache.get_user(user_id)
         except MongoUser.DoesNotExist:
+            cache.credentials.pop(username)
             return self.super_self._unauthorized()
 
-        request.user = user
-
         return True
 
     def is_authenticated(self, request, **kwargs):
@@ -121,13 +173,32 @@ class CookieBasicAuthentication(BasicAuthentication):
         self.super_self = super(CookieBasicAuthentication, self)
         self.super_self.__init__(*args, **kwargs)
 
+    def get_session(self, request):
+        """
+        Returns the session of the request (decoded once by the session
+        engine) or None if there's no session cookie.
+        """
+        session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME, None)
+        if session_key is None:
+            return None
+
+        session = getattr(request, 'session', None)
+        if session is None:
+            engine = import_module(settings.SESSION_ENGINE)
+            session = engine.SessionStore(session_key)
+
+        return session
+
     def is_authenticated(self, request, **kwargs):
-        if 'sessionid' in request.COOKIES:
-            s = Session.objects.get(pk=request.COOKIES['sessionid'])
-            if '_auth_user_id' in s.get_decoded():
-                request.user = MongoUser.objects.get(
-                    id=s.get_decoded()['_auth_user_id'])
-                return True
+        session = self.get_session(request)
+        if session is not None:
+            user_id = session.get('_auth_user_id', None)
+            if user_id is not None:
+                try:
+                    request.user = cache.get_user(user_id)
+                    return True
+                except MongoUser.DoesNotExist:
+                    pass
         return self.super_self.is_authenticated(request, **kwargs)
 
 
@@ -258,6 +329,8 @@ class AppAuthorization(Authorization):
         except AttributeError:
             raise Unauthorized(_('You have to authenticate first!'))
 
+        return []
+
     def update_detail(self, object_list, bundle):
         return bundle.request.user.is_superuser or \
           (bundle.request.user.has_permission('update_detail',
@@ -265,21 +338,33 @@ class AppAuthorization(Authorization):
            and bundle.request.user == get_created_by(bundle.obj))
 
     def update_list(self, object_list, bundle):
-        allowed = []
+        """
+        Batch version of `update_detail`: permission is evaluated once per
+        document type, ownership is checked with one query for all objects.
+        """
+        user = bundle.request.user
+        if user.is_superuser:
+            return list(object_list)
 
-        # Since they may not all be saved, iterate over them.
+        # Group objects by document type, keeping their order.
+        by_type = {}
         for obj in object_list:
-            if self.update_detail([obj], bundle):
-                allowed.append(obj)
+            by_type.setdefault(get_document_type(obj), []).append(obj)
 
-        return allowed
+        allowed = set()
+        for document_type, objects in by_type.iteritems():
+            if user.has_permission('update_detail', document_type):
+                allowed.update(id(obj) for obj in
+                               filter_created_by(objects, user))
+
+        return [obj for obj in object_list if id(obj) in allowed]
 
     def delete_list(self, object_list, bundle):
         """
         Only superuser can delete lists!
         """
-        if self.bundle.request.user.is_superuser:
-            return True
+        if bundle.request.user.is_superuser:
+            return object_list
 
         raise Unauthorized("Sorry, no deletes.")
 
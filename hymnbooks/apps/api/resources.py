@@ -1,16 +1,32 @@
+from django.conf import settings
+from django.conf.urls import url
 from django.utils.translation import ugettext as _
+from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
+from django.http import HttpResponseNotModified
 
+from tastypie import http
+from tastypie.exceptions import ImmediateHttpResponse, NotFound
 from tastypie.resources import Resource, ModelResource, ALL, ALL_WITH_RELATIONS
 from tastypie.authentication import Authentication, MultiAuthentication
 from tastypie.authorization import Authorization, ReadOnlyAuthorization
 from tastypie_mongoengine.resources import MongoEngineResource
+from tastypie.utils import trailing_slash
 from tastypie_mongoengine.fields import *
 
 from hymnbooks.settings.base import API_NAME
-from hymnbooks.apps.core import models, utils
+from hymnbooks.apps.core import melody, models, similarity, utils
 from hymnbooks.apps.api.auth import AppApiKeyAuthentication, \
      CookieBasicAuthentication, AnyoneCanViewAuthorization, \
      StaffAuthorization, AppAuthorization
+from hymnbooks.apps.medialib import tasks as medialib_tasks
+
+from mongoengine import ValidationError
+from mongoengine.queryset import DoesNotExist
+
+import os
+import tempfile
+import time
+import zipfile
 
 
 DATE_FILTERS = ('exact', 'lt', 'lte', 'gte', 'gt', 'ne')
@@ -291,6 +307,44 @@ class EndUserDataResource(MongoEngineResource):
 
         return {field: data.obj, key: '%s%s/' % \
                 (resource_uri, str(data.obj.id))}
+
+    def get_validators(self, obj):
+        """
+        Returns weak ETag and Last-Modified timestamp derived from `updated`.
+        """
+        if obj.updated is None:
+            return None, None
+
+        return ('%s-%s' % (obj.id, obj.updated.strftime('%Y%m%d%H%M%S%f')),
+                time.mktime(obj.updated.timetuple()))
+
+    def get_detail(self, request, **kwargs):
+        """
+        Same as tastypie's `get_detail`, but answers conditional requests
+        with 304 before the document is serialized.
+        """
+        basic_bundle = self.build_bundle(request=request)
+
+        try:
+            obj = self.cached_obj_get(bundle=basic_bundle,
+                                      **self.remove_api_resource_names(kwargs))
+        except ObjectDoesNotExist:
+            return http.HttpNotFound()
+        except MultipleObjectsReturned:
+            return http.HttpMultipleChoices(
+                "More than one resource is found at this URI.")
+
+        etag, last_modified = self.get_validators(obj)
+        if utils.is_not_modified(request, etag, last_modified):
+            return utils.set_validators(HttpResponseNotModified(),
+                                        etag, last_modified, weak=True)
+
+        bundle = self.build_bundle(obj=obj, request=request)
+        bundle = self.full_dehydrate(bundle)
+        bundle = self.alter_detail_data_to_serialize(request, bundle)
+        response = self.create_response(request, bundle)
+
+        return utils.set_validators(response, etag, last_modified, weak=True)
         
     def dehydrate(self, bundle, *args):
         """
@@ -405,7 +459,8 @@ class MediaLibraryResource(EndUserDataResource):
         object_class = models.MediaLibrary
         resource_name = 'media_library'
         allowed_methods = ('get', 'post', 'put', 'patch', 'delete')
-        excludes = ('id', 'mediafile', 'thumbnail', 'container_safe')
+        excludes = ('id', 'mediafile', 'file_id', 'thumbnail',
+                    'container_safe', 'ancestors')
         filtering = {
             'created_by': ALL,
             'updated_by': ALL,
@@ -425,14 +480,131 @@ class MediaLibraryResource(EndUserDataResource):
         args = ('container',)
         bundle = super(MediaLibraryResource, self).dehydrate(bundle, *args)
 
-        if bundle.data['is_file']:
-            bundle.data.update({
-                'size': bundle.obj.mediafile.length,
-                'size_pretty': utils.sizify(bundle.obj.mediafile.length),
-                'content_type': bundle.obj.mediafile.content_type})
+        # File metadata is stored in the document, GridFS is not touched.
+        if bundle.data['is_file'] and (bundle.obj.size is not None):
+            bundle.data['size_pretty'] = utils.sizify(bundle.obj.size)
+        elif not bundle.data['is_file']:
+            bundle.data['total_size_pretty'] = \
+              utils.sizify(bundle.obj.total_size or 0)
+
+        # Progress of the removal (see medialib.tasks.delete_folder) only
+        # for the folders being deleted.
+        if bundle.data.get('status') != 'deleted':
+            bundle.data.pop('deleted_count', None)
+            bundle.data.pop('delete_total', None)
 
         return bundle
 
+    def get_validators(self, obj):
+        """
+        Counters of the folders and the status of a subtree being deleted
+        change without touching `updated`: they go into ETag, and there is
+        no Last-Modified for folders and deleted documents.
+        """
+        etag, last_modified = super(MediaLibraryResource, self)\
+          .get_validators(obj)
+        if etag is None:
+            return etag, last_modified
+
+        etag = '%s-%s-%d-%d-%d-%d' % (etag, obj.status, obj.total_size or 0,
+                                      obj.file_count or 0,
+                                      obj.folder_count or 0,
+                                      obj.deleted_count or 0)
+        if (not obj.is_file) or (obj.status == 'deleted'):
+            last_modified = None
+        return etag, last_modified
+
+    def build_filters(self, filters=None):
+        orm_filters = super(MediaLibraryResource, self).build_filters(filters)
+
+        # Folders being deleted are hidden, unless asked for by status.
+        if not any(key.startswith('status') for key in orm_filters):
+            orm_filters['status__ne'] = 'deleted'
+
+        return orm_filters
+
+    def obj_delete(self, bundle, **kwargs):
+        """
+        Deletes a file right away, a folder - in the background (the response
+        does not wait for the whole subtree to be removed).
+        """
+        if not hasattr(bundle.obj, 'delete'):
+            try:
+                bundle.obj = self.obj_get(bundle=bundle, **kwargs)
+            except (ObjectDoesNotExist, DoesNotExist):
+                raise NotFound("A document instance matching the provided "
+                               "arguments could not be found.")
+
+        self.authorized_delete_detail(self.get_object_list(bundle.request),
+                                      bundle)
+        medialib_tasks.delete_item(bundle.obj)
+
+    def prepend_urls(self):
+        return [
+            url(r"^(?P<resource_name>%s)/ingest%s$" % \
+                (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('ingest'), name='api_media_library_ingest'),
+            url(r"^(?P<resource_name>%s)/(?P<pk>\w+)/ingest%s$" % \
+                (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('ingest'), name='api_media_library_ingest'),
+            ]
+
+    def ingest(self, request, **kwargs):
+        """
+        POST: zip archive (multipart field `file`) is ingested into the
+        folder (root if no `pk`) in the background. Responds with 202 and
+        `task_id`.
+
+        GET ?task_id=<id>: state of the ingest, its stats (including
+        throughput) and error if it failed (see MediaIngest).
+        """
+        self.method_check(request, allowed=['get', 'post'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        if request.method == 'GET':
+            state = models.MediaIngest.get_state(
+                request.GET.get('task_id', ''))
+            if state is None:
+                return http.HttpNotFound()
+            return self.create_response(request, state)
+
+        container = None
+        if 'pk' in kwargs:
+            try:
+                container = models.MediaLibrary.objects.get(id=kwargs['pk'],
+                                                            is_file=False)
+            except (DoesNotExist, ValidationError):
+                return http.HttpNotFound()
+
+        bundle = self.build_bundle(
+            obj=models.MediaLibrary(container=container), request=request)
+        self.authorized_create_detail(self.get_object_list(request), bundle)
+
+        archive = request.FILES.get('file', None)
+        if (archive is None) or (not zipfile.is_zipfile(archive)):
+            return http.HttpBadRequest('Zip archive expected in `file`.')
+
+        # Workers remove the copy when done.
+        if not os.path.isdir(settings.MEDIA_INGEST_ROOT):
+            os.makedirs(settings.MEDIA_INGEST_ROOT)
+        fd, path = tempfile.mkstemp(suffix='.zip',
+                                    dir=settings.MEDIA_INGEST_ROOT)
+        with os.fdopen(fd, 'wb') as copy:
+            for chunk in archive.chunks():
+                copy.write(chunk)
+
+        user_id = getattr(request.user, 'id', None)
+        ingest = models.MediaIngest()
+        ingest.save()
+        medialib_tasks.ingest_zip.delay(
+            str(ingest.id), path, container and str(container.id),
+            user_id and str(user_id))
+
+        self.log_throttled_access(request)
+        return self.create_response(request, {'task_id': str(ingest.id)},
+                                    response_class=http.HttpAccepted)
+
 
 class EmbeddedMediaReferenceResource(MongoEngineResource):
     """
@@ -543,3 +715,124 @@ class ManuscriptResource(EndUserDataResource):
                                   field_fro='title',
                                   obj_class=models.Manuscript)
         return bundle
+
+    def dehydrate(self, bundle, *args):
+        """
+        Adds progress of the extraction of scores (numbers of pieces by
+        status, see core.tasks.extract_scores).
+        """
+        bundle = super(ManuscriptResource, self).dehydrate(bundle, *args)
+        bundle.data['extraction'] = bundle.obj.get_extraction_progress()
+        return bundle
+
+    def get_validators(self, obj):
+        """
+        Extraction of scores changes the pieces without touching `updated`:
+        the progress goes into ETag, and there is no Last-Modified until it
+        is over.
+        """
+        etag, last_modified = super(ManuscriptResource, self)\
+          .get_validators(obj)
+        if etag is None:
+            return etag, last_modified
+
+        progress = obj.get_extraction_progress()
+        etag = '%s-%d-%d-%d' % (etag, progress['pending'], progress['done'],
+                                progress['failed'])
+        return etag, (None if progress['pending'] else last_modified)
+
+
+class MelodySearchResource(Resource):
+    """
+    Melodic search in the pieces (see core.melody). GET with `melody` -
+    MIDI key numbers or pitches ('E4 G4 C5', 'B-4', 'F#'), in any key.
+    Returns pieces ranked by score (share of the intervals of the melody
+    found, halved for contour-only matches) with their manuscripts,
+    positions in them, and the first matching note (its index, measure and
+    transposition against the query).
+    """
+    manuscript = fields.CharField(attribute='manuscript')
+    title = fields.CharField(attribute='title', null=True)
+    piece_index = fields.IntegerField(attribute='piece_index')
+    piece_name = fields.CharField(attribute='piece_name', null=True)
+    note = fields.IntegerField(attribute='note')
+    measure = fields.CharField(attribute='measure', null=True)
+    transposition = fields.IntegerField(attribute='transposition', null=True)
+    score = fields.FloatField(attribute='score')
+    match = fields.CharField(attribute='match')
+
+    class Meta:
+        resource_name = 'melody_search'
+        list_allowed_methods = ('get',)
+        detail_allowed_methods = ()
+        authorization = ReadOnlyAuthorization()
+        authentication = Authentication()
+
+    def obj_get_list(self, bundle, **kwargs):
+        try:
+            pitches = melody.parse_melody(bundle.request.GET.get('melody', ''))
+            return melody.search(pitches)
+        except ValueError as e:
+            raise ImmediateHttpResponse(
+                http.HttpBadRequest('Invalid `melody`: %s' % e))
+
+    def dehydrate(self, bundle):
+        del bundle.data['resource_uri']
+        bundle.data['manuscript_resource_uri'] = '%s%s/' % \
+          (ManuscriptResource().get_resource_uri(), bundle.obj.manuscript)
+        return bundle
+
+
+class SimilarPiece(object):
+    """
+    Container for a result of similarity search.
+    """
+    def __init__(self, melody, score):
+        self.manuscript = str(melody['manuscript'])
+        self.title = melody.get('title')
+        self.piece_index = melody['piece_index']
+        self.piece_name = melody.get('piece_name')
+        self.score = round(score, 3)
+
+
+class SimilarPieceResource(Resource):
+    """
+    Pieces with the most similar melodies (see core.similarity), best first.
+    GET with `manuscript` (id) and `piece_index` for pieces similar to an
+    indexed piece, or with `melody` (as in MelodySearchResource, rhythm is
+    not compared then).
+    """
+    manuscript = fields.CharField(attribute='manuscript')
+    title = fields.CharField(attribute='title', null=True)
+    piece_index = fields.IntegerField(attribute='piece_index')
+    piece_name = fields.CharField(attribute='piece_name', null=True)
+    score = fields.FloatField(attribute='score')
+
+    class Meta:
+        resource_name = 'similar_piece'
+        list_allowed_methods = ('get',)
+        detail_allowed_methods = ()
+        authorization = ReadOnlyAuthorization()
+        authentication = Authentication()
+
+    def obj_get_list(self, bundle, **kwargs):
+        query = bundle.request.GET
+        try:
+            if 'melody' in query:
+                vector = similarity.get_features(
+                    melody.parse_melody(query['melody']))
+                results = similarity.similar(vector)
+            else:
+                results = similarity.similar_to_piece(
+                    query.get('manuscript'), int(query.get('piece_index')))
+        except (KeyError, TypeError, ValueError):
+            raise ImmediateHttpResponse(http.HttpBadRequest(
+                'Expected `melody` or `manuscript` and `piece_index` of an '
+                'indexed piece.'))
+        return [SimilarPiece(*result) for result in results]
+
+    def dehydrate(self, bundle):
+        del bundle.data['resource_uri']
+        bundle.data['manuscript_resource_uri'] = '%s%s/' % \
+          (ManuscriptResource().get_resource_uri(), bundle.obj.manuscript)
+        return bundle
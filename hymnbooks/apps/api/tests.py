@@ -2,12 +2,22 @@
 
 from mongoengine import connect, connection, register_connection
 from mongoengine.context_managers import switch_db
+from tastypie.bundle import Bundle
+from tastypie.exceptions import Unauthorized
 from tastypie.test import ResourceTestCase
 from mixer.backend.mongoengine import mixer
 from django.conf import settings
+from django.test import SimpleTestCase
+from django.test.client import RequestFactory
 
-from hymnbooks.apps.core import models, utils
-from hymnbooks.apps.api import resources
+from hymnbooks.apps.core import cache, models, sessions, utils
+from hymnbooks.apps.core.testing import FakeCollection, patch_collection
+from hymnbooks.apps.api import auth, resources
+
+from bson import ObjectId
+from datetime import datetime
+
+import json
 
 
 # WARNING!
@@ -277,3 +287,172 @@ class ManuscriptResourceTest(MongoResourcePermissionsTestCase):
         # Check creation of:
         # - name
         # - created and created_by
+
+
+class CookieBasicAuthenticationTest(SimpleTestCase):
+    """
+    The user is resolved from the cached session and user, no db access.
+    """
+    def setUp(self):
+        self.user = models.MongoUser(id=ObjectId(), username='kabalyero',
+                                     email='kabalyero@example.com')
+        cache.set_user(self.user)
+        cache.sessions.set('key', {'_auth_user_id': str(self.user.id)})
+
+    def tearDown(self):
+        cache.users.pop(str(self.user.id))
+        cache.sessions.clear()
+
+    def get_request(self):
+        request = RequestFactory().get('/')
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = 'key'
+        request.session = sessions.SessionStore('key')
+        return request
+
+    def test_user_from_session(self):
+        request = self.get_request()
+        self.assertTrue(auth.CookieBasicAuthentication()\
+                        .is_authenticated(request))
+        self.assertEqual(request.user.id, self.user.id)
+
+    def test_anonymous_session(self):
+        cache.sessions.set('key', {})
+        # Falls back to basic authentication, which asks for credentials.
+        response = auth.CookieBasicAuthentication()\
+          .is_authenticated(self.get_request())
+        self.assertEqual(response.status_code, 401)
+
+
+class FakeQuerySet(object):
+    _document = models.Manuscript
+
+    def filter(self, **kwargs):
+        return kwargs
+
+
+class AppAuthorizationListTest(SimpleTestCase):
+    """
+    Ownership of unsaved documents is checked in memory, no db access.
+    """
+    def setUp(self):
+        self.owner = models.MongoUser(id=ObjectId(), username='owner')
+        self.other = models.MongoUser(id=ObjectId(), username='other')
+        self.owned = models.Manuscript(title=u'Owned', created_by=self.owner)
+        self.foreign = models.Manuscript(title=u'Foreign',
+                                         created_by=self.other)
+        self.objects = [self.foreign, self.owned]
+
+    def get_bundle(self, user):
+        request = RequestFactory().get('/')
+        request.user = user
+        return Bundle(obj=models.Manuscript(), request=request)
+
+    def allow(self, user, permission):
+        user.permissions = [models.GlobalPermission(
+            permission=permission, document_type='Manuscript')]
+        user.compile_permissions()
+
+    def test_filter_created_by(self):
+        self.assertEqual(auth.filter_created_by(self.objects, self.owner),
+                         [self.owned])
+        self.assertEqual(auth.filter_created_by(FakeQuerySet(), self.owner),
+                         {'created_by': self.owner})
+
+    def test_update_list(self):
+        authorization = auth.AppAuthorization()
+        self.assertEqual(authorization.update_list(
+            self.objects, self.get_bundle(self.owner)), [])
+
+        self.allow(self.owner, 'update_detail')
+        self.assertEqual(authorization.update_list(
+            self.objects, self.get_bundle(self.owner)), [self.owned])
+
+        self.owner.is_superuser = True
+        self.assertEqual(authorization.update_list(
+            self.objects, self.get_bundle(self.owner)), self.objects)
+
+    def test_delete_list(self):
+        authorization = auth.AppAuthorization()
+        self.assertRaises(Unauthorized, authorization.delete_list,
+                          self.objects, self.get_bundle(self.owner))
+
+        # Only superuser, whatever the permissions.
+        self.allow(self.owner, 'delete_list')
+        self.assertRaises(Unauthorized, authorization.delete_list,
+                          self.objects, self.get_bundle(self.owner))
+
+        self.owner.is_superuser = True
+        self.assertEqual(authorization.delete_list(
+            self.objects, self.get_bundle(self.owner)), self.objects)
+
+
+class MediaLibraryResourceTest(SimpleTestCase):
+    def test_deleted_are_hidden(self):
+        resource = resources.MediaLibraryResource()
+        self.assertEqual(resource.build_filters({})['status__ne'], 'deleted')
+        filters = resource.build_filters({'status': 'deleted'})
+        self.assertEqual(filters, {'status__exact': 'deleted'})
+
+    def test_delete_progress(self):
+        resource = resources.MediaLibraryResource()
+        folder = models.MediaLibrary(id=ObjectId(), name=u'a',
+                                     is_file=False, status='deleted',
+                                     deleted_count=2, delete_total=5)
+        bundle = resource.full_dehydrate(resource.build_bundle(obj=folder))
+        self.assertEqual((bundle.data['deleted_count'],
+                          bundle.data['delete_total']), (2, 5))
+
+        folder.status = 'active'
+        bundle = resource.full_dehydrate(resource.build_bundle(obj=folder))
+        self.assertFalse('deleted_count' in bundle.data)
+
+    def test_validators(self):
+        resource = resources.MediaLibraryResource()
+        folder = models.MediaLibrary(id=ObjectId(), name=u'a',
+                                     is_file=False, status='active',
+                                     updated=datetime(2014, 1, 1))
+        etag, last_modified = resource.get_validators(folder)
+        self.assertEqual(last_modified, None)
+
+        # Counters and status change without `updated`.
+        folder.file_count = 1
+        self.assertNotEqual(resource.get_validators(folder)[0], etag)
+        etag = resource.get_validators(folder)[0]
+        folder.status = 'deleted'
+        self.assertNotEqual(resource.get_validators(folder)[0], etag)
+
+        media_file = models.MediaLibrary(id=ObjectId(), name=u'b',
+                                         status='active',
+                                         updated=datetime(2014, 1, 1))
+        self.assertNotEqual(resource.get_validators(media_file)[1], None)
+
+
+class MediaLibraryIngestTest(SimpleTestCase):
+    def setUp(self):
+        self.ingest_id = ObjectId()
+        self.collection = FakeCollection([{'_id': self.ingest_id}])
+        patch_collection(self, models.MediaIngest, self.collection)
+
+        self.resource = resources.MediaLibraryResource()
+        self.resource.is_authenticated = lambda request: None
+
+    def get(self, task_id):
+        request = RequestFactory().get('/', {'task_id': task_id},
+                                       HTTP_ACCEPT='application/json')
+        return self.resource.ingest(request)
+
+    def test_progress(self):
+        response = self.get(str(self.ingest_id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content),
+                         {'state': 'PENDING', 'stats': None, 'error': None})
+
+        models.MediaIngest.report(self.ingest_id, 'PROGRESS',
+                                  {'files': 3, 'skipped': 1})
+        data = json.loads(self.get(str(self.ingest_id)).content)
+        self.assertEqual(data['state'], 'PROGRESS')
+        self.assertEqual(data['stats'], {'files': 3, 'skipped': 1})
+
+    def test_unknown(self):
+        self.assertEqual(self.get(str(ObjectId())).status_code, 404)
+        self.assertEqual(self.get('x').status_code, 404)
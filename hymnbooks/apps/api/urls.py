@@ -12,6 +12,8 @@ v1_api.register(UserResource())
 v1_api.register(PermissionResource())
 v1_api.register(DocumentTypeResource())
 v1_api.register(MediaLibraryResource())
+v1_api.register(MelodySearchResource())
+v1_api.register(SimilarPieceResource())
 
 from django.core.urlresolvers import reverse
 from django.views.generic import RedirectView
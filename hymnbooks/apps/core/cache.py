@@ -0,0 +1,487 @@
+"""
+Caches shared by the apps.
+
+LRUCache is local to a worker process: entries expire after `ttl` seconds,
+so changes made by other workers become visible in bounded time. Entries
+that must be invalidated at once in every worker (API key credentials,
+users) are kept in a shared Django cache, see SharedCache and AUTH_CACHE.
+DiskLRUCache keeps files in a directory that workers may share.
+
+SingleFlight and `coalesce` make concurrent requests for the same thing
+share one fetch or computation (within a worker, and across workers with
+a lock in a shared Django cache, see COALESCE_CACHE).
+"""
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from hashlib import sha1
+
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    """
+    Bounded thread-safe LRU cache with optional time-to-live for entries.
+
+    Every entry counts as 1 towards `maxsize`, or as `sizeof(value)` if
+    given (e.g. bytes): an entry larger than `maxsize` is not kept at all.
+    """
+    def __init__(self, maxsize=1024, ttl=None, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires, size = self._data.pop(key)
+            except KeyError:
+                return default
+
+            if expires is not None and expires < time.time():
+                self.size -= size
+                return default
+
+            # Re-insert as the most recently used.
+            self._data[key] = (value, expires, size)
+            return value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        size = self.sizeof(value) if self.sizeof else 1
+        with self._lock:
+            self._pop(key)
+            if size > self.maxsize:
+                return
+            self._data[key] = (value, expires, size)
+            self.size += size
+            while self.size > self.maxsize:
+                self.size -= self._data.popitem(last=False)[1][2]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._pop(key, default)
+
+    def _pop(self, key, default=None):
+        try:
+            value, expires, size = self._data.pop(key)
+        except KeyError:
+            return default
+        self.size -= size
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
+def digest(value):
+    """
+    Hex digest of a secret, so that the secret itself is never cached.
+    Byte strings (e.g. from request headers) are hashed as they are.
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return sha1(value).hexdigest()
+
+
+class SharedCache(object):
+    """
+    Cache of entries shared by the workers, kept in the Django cache named
+    by the `setting` (see get_shared_cache) for `ttl` seconds: an entry
+    removed by one worker is gone for all of them. Without the setting the
+    entries are kept in-process (LRUCache), which is right only for a
+    single worker.
+    """
+    def __init__(self, prefix, ttl, setting='AUTH_CACHE', maxsize=10000):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.setting = setting
+        self.local = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._backend = (None, None)
+
+    @property
+    def backend(self):
+        """
+        The Django cache or None, created once per cache name.
+        """
+        name = getattr(settings, self.setting, None)
+        if self._backend[0] != name:
+            self._backend = (name, get_shared_cache(self.setting))
+        return self._backend[1]
+
+    def key(self, key):
+        return '%s:%s' % (self.prefix, digest(key))
+
+    def get(self, key, default=None):
+        backend = self.backend
+        if backend is None:
+            return self.local.get(key, default)
+        return backend.get(self.key(key), default)
+
+    def set(self, key, value):
+        backend = self.backend
+        if backend is None:
+            self.local.set(key, value)
+        else:
+            backend.set(self.key(key), value, self.ttl)
+
+    def pop(self, key):
+        backend = self.backend
+        if backend is None:
+            self.local.pop(key)
+        else:
+            backend.delete(self.key(key))
+
+
+"""
+API key credentials: username -> (user id, api key digest, is_active).
+"""
+credentials = SharedCache('credentials',
+                          getattr(settings, 'API_KEY_CACHE_TTL', 300))
+
+"""
+Authenticated users: user id -> raw MongoUser document (every request gets
+its own instance, see get_user).
+"""
+users = SharedCache('user', getattr(settings, 'USER_CACHE_TTL', 300))
+
+"""
+Decoded sessions: session key -> session data.
+"""
+sessions = LRUCache(maxsize=getattr(settings, 'SESSION_CACHE_SIZE', 10000),
+                    ttl=getattr(settings, 'SESSION_CACHE_TTL', 60))
+
+
+def set_user(user):
+    users.set(str(user.id), user.to_mongo())
+
+
+def get_user(user_id):
+    """
+    Returns MongoUser by id, built from the cached document if possible.
+    Every call returns a new instance: requests never share (and modify)
+    the same one.
+    """
+    from hymnbooks.apps.core.models import MongoUser
+
+    son = users.get(str(user_id))
+    if son is not None:
+        return MongoUser._from_son(son)
+
+    user = MongoUser.objects.get(id=user_id)
+    set_user(user)
+    return user
+
+
+class DiskLRUCache(object):
+    """
+    Size-bounded cache of files in a directory (may be shared by workers).
+
+    Least recently used files (by modification time, refreshed on every hit)
+    are evicted when the total size exceeds `max_bytes`. Each worker counts
+    its own writes and rescans the directory when evicting.
+    """
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._size = None
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        name = sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, name[:2], name[2:4], name)
+
+    def get(self, key):
+        """
+        Returns path to the cached file or None.
+        """
+        path = self.path(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def set(self, key, chunks):
+        """
+        Stores the file (given as iterable of strings) and returns its path.
+        """
+        for chunk in self.tee(key, chunks):
+            pass
+        return self.path(key)
+
+    def tee(self, key, chunks):
+        """
+        Yields the chunks (strings) of a file while storing it: the file is
+        in the cache once all of them have been consumed. If the iteration
+        is abandoned or fails, nothing is stored.
+        """
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass # Created concurrently.
+
+        # Write to a temporary file first, rename is atomic.
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                for chunk in chunks:
+                    tmp.write(chunk)
+                    size += len(chunk)
+                    yield chunk
+            os.rename(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            if self._size is None:
+                self._size = self.scan()[1]
+            else:
+                self._size += size
+            if self._size > self.max_bytes:
+                self.evict()
+
+    def scan(self):
+        """
+        Returns list of (mtime, size, path) of cached files and their total
+        size.
+        """
+        files, total = [], 0
+        for directory, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue # Evicted concurrently.
+                files.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        return files, total
+
+    def evict(self):
+        """
+        Removes least recently used files until the cache takes 90% of its
+        budget.
+        """
+        files, total = self.scan()
+        files.sort()
+        limit = self.max_bytes * 0.9
+        for mtime, size, path in files:
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self._size = total
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key within a process: the
+    first caller runs the function, the others wait for it and get the
+    same result (or exception).
+    """
+    class Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self.Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+        except Exception:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+flights = SingleFlight()
+
+
+class Reloadable(object):
+    """
+    Value kept by a worker (e.g. an in-memory index) and reloaded by `load`
+    when it is older than `ttl` seconds. Only the first load is waited for
+    (by all the concurrent callers), later ones run in a background thread,
+    one at a time, while the stale value is served. If a reload fails, the
+    stale value stays until the next one.
+    """
+    def __init__(self, load, ttl):
+        self.load = load
+        self.ttl = ttl
+        self.value = None
+        self.loaded = None
+        self.reloading = None
+        self._first_load = threading.Lock()
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self.value is None:
+            with self._first_load:
+                if self.value is None:
+                    self.set(self.load())
+        elif self.loaded + self.ttl < time.time():
+            self.reload()
+        return self.value
+
+    def set(self, value):
+        self.value, self.loaded = value, time.time()
+
+    def reload(self):
+        """
+        Starts reloading in the background, unless it is running already.
+        """
+        with self._lock:
+            if self.reloading is not None:
+                return
+            thread = self.reloading = threading.Thread(target=self.run_reload)
+        thread.daemon = True
+        thread.start()
+
+    def run_reload(self):
+        try:
+            self.set(self.load())
+        except Exception:
+            logger.exception('Reload failed, the stale value is kept')
+        finally:
+            with self._lock:
+                self.reloading = None
+
+
+# Django caches that are not shared by the workers.
+LOCAL_CACHES = (LocMemCache, DummyCache)
+
+
+def get_shared_cache(setting):
+    """
+    Returns the Django cache named by the `setting` (an alias of CACHES) or
+    None if there is none. Raises ImproperlyConfigured if the cache is local
+    to a process: its entries would not be seen by the other workers.
+    """
+    name = getattr(settings, setting, None)
+    if name is None:
+        return None
+
+    backend = get_cache(name)
+    if isinstance(backend, LOCAL_CACHES):
+        raise ImproperlyConfigured(
+            '%s should be shared by the workers (memcached, redis), %s is '
+            'local to a process.' % (setting, name))
+    return backend
+
+
+def get_lock_cache():
+    """
+    Returns the Django cache of shared locks (COALESCE_CACHE) or None.
+    """
+    return get_shared_cache('COALESCE_CACHE')
+
+
+@contextmanager
+def shared_lock(key, timeout=None, wait=None):
+    """
+    Lock shared by workers through the Django cache COALESCE_CACHE: `add`
+    is atomic. Waits up to `wait` seconds for the lock, yields True if it
+    has been acquired, False otherwise. The lock expires after `timeout`
+    seconds if its holder dies. Without COALESCE_CACHE the lock is always
+    acquired (only threads of a worker are coalesced).
+    """
+    backend = get_lock_cache()
+    if backend is None:
+        yield True
+        return
+
+    key = 'lock:%s' % digest(key)
+    timeout = timeout or getattr(settings, 'COALESCE_LOCK_TIMEOUT', 120)
+    if wait is None:
+        wait = getattr(settings, 'COALESCE_LOCK_WAIT', 30)
+    deadline = time.time() + wait
+    token = uuid.uuid4().hex
+
+    acquired = backend.add(key, token, timeout)
+    while (not acquired) and (time.time() < deadline):
+        time.sleep(0.05)
+        acquired = backend.add(key, token, timeout)
+
+    try:
+        yield acquired
+    finally:
+        # Not to remove the lock of another worker if ours has expired.
+        if acquired and backend.get(key) == token:
+            backend.delete(key)
+
+
+def coalesce(key, get, create):
+    """
+    Returns `get()`, or `create()` if it returns None, so that concurrent
+    callers with the same key create the thing once: threads of a worker
+    wait for the first one, workers wait for the one holding the shared
+    lock and `get()` what it has created. If the wait times out, the thing
+    is created anyway.
+    """
+    def fetch():
+        value = get()
+        if value is not None:
+            return value
+
+        with shared_lock(key):
+            # Created while we were waiting for the lock?
+            value = get()
+            if value is not None:
+                return value
+            return create()
+
+    return flights.do(key, fetch)
@@ -0,0 +1,102 @@
+"""
+Finds pairs of pieces with near-identical melodies (variants of a melody,
+see core.similarity): cosine similarity of their features at least
+`--threshold`.
+
+Rows of the feature matrix are split into blocks compared with the whole
+matrix by a pool of processes (one per core by default). The matrix is
+loaded before the pool is started and handed to the workers by their
+initializer: forked workers share it instead of receiving copies with
+every block.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from hymnbooks.apps.core import similarity
+
+from multiprocessing import Pool, cpu_count
+from optparse import make_option
+
+import numpy
+
+
+# Rows compared at once (block x corpus scores per worker).
+BLOCK_SIZE = 256
+
+# Set in every worker by init_worker.
+_matrix = None
+_manuscripts = None
+
+
+def init_worker(matrix, manuscripts):
+    global _matrix, _manuscripts
+    _matrix, _manuscripts = matrix, manuscripts
+
+
+def find_pairs(args):
+    """
+    Returns (row, column, score) of the pairs above the threshold among the
+    rows of the block and the following rows (each pair once).
+    """
+    start, end, threshold, across = args
+    scores = _matrix[start:end].dot(_matrix.T)
+    rows, columns = numpy.nonzero(scores >= threshold)
+    rows += start
+
+    keep = columns > rows
+    if across:
+        keep &= _manuscripts[rows] != _manuscripts[columns]
+    rows, columns = rows[keep], columns[keep]
+    return [(int(row), int(column), float(scores[row - start, column]))
+            for row, column in zip(rows, columns)]
+
+
+class Command(BaseCommand):
+    help = 'Finds pairs of pieces with near-identical melodies.'
+    option_list = BaseCommand.option_list + (
+        make_option('--threshold', type='float', dest='threshold',
+                    default=0.95, help='Minimal similarity (0-1).'),
+        make_option('--across', action='store_true', dest='across',
+                    default=False,
+                    help='Only pairs from different manuscripts.'),
+        make_option('--processes', type='int', dest='processes',
+                    default=cpu_count(), help='Number of processes.'),
+        )
+
+    def handle(self, *args, **options):
+        if not 0 < options['threshold'] <= 1:
+            raise CommandError('Threshold should be between 0 and 1.')
+
+        features = similarity.load_matrix()
+        manuscripts = numpy.array([str(melody['manuscript'])
+                                   for melody in features.melodies])
+
+        blocks = [(start, min(start + BLOCK_SIZE, len(features)),
+                   options['threshold'], options['across'])
+                  for start in xrange(0, len(features), BLOCK_SIZE)]
+        pool = Pool(max(options['processes'], 1), initializer=init_worker,
+                    initargs=(features.matrix, manuscripts))
+        try:
+            pairs = [pair for block in pool.imap_unordered(find_pairs, blocks)
+                     for pair in block]
+        except:
+            # Don't wait for the remaining blocks.
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+        pairs.sort(key=lambda pair: -pair[2])
+        for row, column, score in pairs:
+            self.stdout.write('%.3f %s <-> %s' % (
+                score, self.describe(features.melodies[row]),
+                self.describe(features.melodies[column])))
+
+        self.stdout.write('Found %d pairs among %d pieces' % (
+            len(pairs), len(features)))
+
+    def describe(self, melody):
+        return u'%s #%d %s (%s)' % (melody.get('title'), melody['piece_index'],
+                                    melody.get('piece_name') or u'',
+                                    melody['manuscript'])
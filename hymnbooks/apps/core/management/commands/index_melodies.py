@@ -0,0 +1,25 @@
+"""
+Rebuilds melodies of the pieces for the melodic search (`piece_melody`,
+see core.melody) from the extracted scores of all manuscripts, and removes
+melodies of manuscripts that no longer exist.
+"""
+from django.core.management.base import BaseCommand
+
+from hymnbooks.apps.core.models import Manuscript, PieceMelody
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds melodies of the pieces for the melodic search.'
+
+    def handle(self, *args, **options):
+        manuscripts, pieces = 0, 0
+        for manuscript in Manuscript.objects.only('title', 'pieces'):
+            pieces += PieceMelody.update_manuscript(manuscript)
+            manuscripts += 1
+
+        existing = Manuscript.objects.distinct('id')
+        removed = PieceMelody.objects(manuscript__nin=existing).count()
+        PieceMelody.objects(manuscript__nin=existing).delete()
+
+        self.stdout.write('Indexed %d pieces of %d manuscripts, removed %d '
+                          'orphaned melodies' % (pieces, manuscripts, removed))
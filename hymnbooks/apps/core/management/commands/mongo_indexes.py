@@ -0,0 +1,210 @@
+"""
+Maintains indexes declared in the `meta` of core documents:
+
+* builds them in the background
+* reports missing and extra indexes
+* prints query plans for the filter/ordering combinations registered
+  in the API resources
+* fails if any of these queries would be a collection scan
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from mongoengine import Document, fields
+from mongoengine.document import includes_cls
+
+from bson import ObjectId
+from datetime import datetime
+from optparse import make_option
+
+import inspect
+import itertools
+
+
+def get_documents():
+    """
+    Returns all non-abstract top level documents defined in core.
+    """
+    from hymnbooks.apps.core import models
+
+    return [obj for name, obj in inspect.getmembers(models, inspect.isclass)
+            if issubclass(obj, Document) and obj.__module__ == models.__name__
+            and not obj._meta.get('abstract')]
+
+
+def build_indexes(document):
+    """
+    Builds indexes declared in the meta of the document, like
+    `ensure_indexes` but always in the background (whatever the
+    document's `index_background`).
+    """
+    collection = document._get_collection()
+    index_opts = document._meta.get('index_opts') or {}
+
+    cls_indexed = False
+    for spec in document._meta['index_specs'] or []:
+        opts = dict(index_opts, **spec)
+        index_fields = opts.pop('fields')
+        cls_indexed = cls_indexed or includes_cls(index_fields)
+        opts['background'] = True
+        collection.ensure_index(index_fields, **opts)
+
+    # Inherited documents are queried by `_cls`.
+    if document._meta.get('allow_inheritance') and \
+      document._meta.get('index_cls', True) and not cls_indexed:
+        collection.ensure_index('_cls', background=True, **index_opts)
+
+
+def sample_value(field):
+    """
+    Returns a value of the field's type to build the query with.
+    """
+    if isinstance(field, fields.ListField) and field.field is not None:
+        field = field.field
+    if isinstance(field, fields.ReferenceField):
+        return ObjectId()
+    if isinstance(field, fields.DateTimeField):
+        return datetime.now()
+    if isinstance(field, fields.BooleanField):
+        return True
+    if isinstance(field, (fields.IntField, fields.FloatField)):
+        return 0
+    return u''
+
+
+def get_lookups(lookups):
+    """
+    Returns lookups allowed by the filter. ALL and ALL_WITH_RELATIONS
+    are explained as `exact` and `in` lookups.
+    """
+    if isinstance(lookups, (list, tuple)):
+        return list(lookups)
+    return ['exact', 'in']
+
+
+def build_queries(document, field_name, lookups):
+    """
+    Returns list of (lookup, raw query) for every lookup of the filter or
+    None if `field_name` is not a field of the document.
+    """
+    try:
+        field = document._fields[field_name]
+    except KeyError:
+        return None
+
+    queries = []
+    for lookup in get_lookups(lookups):
+        value = sample_value(field)
+        if lookup == 'in':
+            value = {'$in': [value]}
+        elif lookup != 'exact':
+            value = {'$%s' % lookup: value}
+        queries.append((lookup, {field.db_field: value}))
+
+    return queries
+
+
+def plan_stages(explain):
+    """
+    Returns list of stages (or cursor names for MongoDB < 3.0) of the
+    winning plan.
+    """
+    if 'queryPlanner' not in explain:
+        return [explain.get('cursor', 'BasicCursor').split()[0]]
+
+    stages = []
+    plan = explain['queryPlanner']['winningPlan']
+    while plan:
+        stages.append(plan['stage'])
+        children = plan.get('inputStages') or [plan.get('inputStage')]
+        for child in children[1:]:
+            stages.extend(plan_stages(
+                {'queryPlanner': {'winningPlan': child}}))
+        plan = children[0]
+
+    return stages
+
+
+def is_collection_scan(stages):
+    return 'COLLSCAN' in stages or 'BasicCursor' in stages
+
+
+class Command(BaseCommand):
+    help = 'Builds, compares and explains indexes of the core collections.'
+    option_list = BaseCommand.option_list + (
+        make_option('--no-build', action='store_false', dest='build',
+                    default=True, help='Do not build missing indexes.'),
+        make_option('--no-explain', action='store_false', dest='explain',
+                    default=True, help='Do not explain resource queries.'),
+        )
+
+    def handle(self, *args, **options):
+        documents = get_documents()
+
+        if options['build']:
+            for document in documents:
+                self.stdout.write('Building indexes for %s (background)' % \
+                                  document._get_collection_name())
+                build_indexes(document)
+
+        for document in documents:
+            report = document.compare_indexes()
+            for key in ('missing', 'extra'):
+                for index in report[key]:
+                    self.stdout.write('%s: %s index %s' % (
+                        document._get_collection_name(), key, index))
+
+        if not options['explain']:
+            return
+
+        from hymnbooks.apps.api.urls import v1_api
+
+        collection_scans = self.explain_resources(v1_api._registry)
+        if collection_scans:
+            raise CommandError('Queries without index:\n%s' % \
+                               '\n'.join(collection_scans))
+
+    def explain(self, document, query, order=None):
+        """
+        Returns stages of the winning plan of the raw query.
+        """
+        # Queryset adds `_cls` to the query for inherited documents.
+        queryset = document.objects(__raw__=query)
+        if order is not None:
+            queryset = queryset.order_by(order)
+        return plan_stages(queryset.explain())
+
+    def explain_resources(self, registry):
+        """
+        Explains queries built from `filtering` (every lookup) and
+        `ordering` of the resources (resource name -> resource). Returns
+        descriptions of collection scans.
+        """
+        collection_scans = []
+        for name, resource in sorted(registry.items()):
+            document = getattr(resource._meta, 'object_class', None)
+            if not (inspect.isclass(document) and issubclass(document, Document)):
+                continue
+
+            filtering = resource._meta.filtering or {}
+            ordering = list(resource._meta.ordering or []) + [None]
+
+            for field_name, lookups in sorted(filtering.items()):
+                queries = build_queries(document, field_name, lookups)
+                if queries is None:
+                    self.stdout.write('%s: unknown filter field %s, skipped' % \
+                                      (name, field_name))
+                    continue
+
+                for (lookup, query), order in itertools.product(queries,
+                                                                ordering):
+                    if (order is not None) and (order not in document._fields):
+                        continue
+
+                    stages = self.explain(document, query, order)
+                    description = '%s: filter=%s__%s order=%s -> %s' % \
+                      (name, field_name, lookup, order, ' <- '.join(stages))
+                    self.stdout.write(description)
+                    if is_collection_scan(stages):
+                        collection_scans.append(description)
+
+        return collection_scans
@@ -0,0 +1,267 @@
+"""
+Melodic search: transposition-invariant lookup of short melodies (incipits)
+in the pieces.
+
+Melodies of the pieces (PieceMelody) are indexed by n-grams of their
+intervals (MELODY_NGRAM steps in semitones) and of their contour
+(MELODY_CONTOUR_NGRAM steps up, down or repeated - Parsons code) in an
+in-memory inverted index: gram -> posting list of the melodies containing
+it. Every worker loads the index from `piece_melody` on the first search
+and reloads it in the background when it is older than MELODY_INDEX_TTL
+seconds (searches use the old one in the meantime).
+
+A query counts the grams every melody shares with it (contour grams only if
+intervals find less than the number of results asked for), then aligns the
+best candidates to find where the melody starts in them and how many of its
+intervals match.
+"""
+from django.conf import settings
+
+from hymnbooks.apps.core import cache
+from hymnbooks.apps.core.models import PieceMelody
+
+from array import array
+
+import collections
+import re
+
+
+STEPS = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+
+PITCH_RE = re.compile(r'^([A-G])([#b-]*)(-?\d+)?$', re.I)
+
+# Candidates aligned per result asked for.
+CANDIDATES_PER_RESULT = 4
+
+# Contour matches are weaker evidence than interval ones.
+CONTOUR_WEIGHT = 0.5
+
+Entry = collections.namedtuple('Entry', ('id', 'manuscript', 'piece_index',
+    'piece_name', 'title', 'pitches', 'intervals', 'contour'))
+
+
+class Hit(object):
+    """
+    Search result: the piece and the alignment of the query with it.
+    `offset` is the start of the query in the piece (negative if the query
+    starts before the piece), `note` - the first note of the piece matching
+    the query.
+    """
+    def __init__(self, entry, position, offset, matches, length, match):
+        self.melody_id = entry.id
+        self.id = str(entry.id)
+        self.manuscript = str(entry.manuscript)
+        self.piece_index = entry.piece_index
+        self.piece_name = entry.piece_name
+        self.title = entry.title
+        self.position = position
+        self.offset = offset
+        self.note = max(offset, 0)
+        self.matches = matches
+        self.match = match
+        self.score = round(float(matches) / length *
+                           (CONTOUR_WEIGHT if match == 'contour' else 1), 3)
+        self.transposition = None
+        self.measure = None
+
+
+def parse_melody(text):
+    """
+    Returns MIDI key numbers of the melody given as numbers or pitches
+    separated by spaces or commas ('64 67 72', 'E4 G4 C5', 'B-4', 'Bb4',
+    'F#'). Pitches without octave are taken in the octave nearest to the
+    previous note (4 for the first one). Raises ValueError.
+    """
+    pitches = []
+    for token in re.split(r'[\s,]+', text.strip()):
+        if not token:
+            continue
+        if re.match(r'^\d+$', token):
+            midi = int(token)
+        else:
+            match = PITCH_RE.match(token)
+            if match is None:
+                raise ValueError('Unknown pitch: %s' % token)
+            step, accidentals, octave = match.groups()
+            alter = accidentals.count('#') - len(accidentals.replace('#', ''))
+            pitch_class = STEPS[step.upper()] + alter
+            if octave is not None:
+                midi = (int(octave) + 1) * 12 + pitch_class
+            else:
+                previous = pitches[-1] if pitches else 60
+                midi = previous + (pitch_class - previous + 6) % 12 - 6
+        if not 0 <= midi <= 127:
+            raise ValueError('Pitch out of range: %s' % token)
+        pitches.append(midi)
+    return pitches
+
+
+def encode_intervals(pitches):
+    """
+    Returns intervals between the notes as a string, one character each.
+    """
+    return ''.join(chr(max(-127, min(127, b - a)) + 128)
+                   for a, b in zip(pitches, pitches[1:]))
+
+
+def encode_contour(pitches):
+    """
+    Returns contour of the melody: 'u' (up), 'd' (down), 'r' (repeat).
+    """
+    return ''.join('u' if b > a else ('d' if b < a else 'r')
+                   for a, b in zip(pitches, pitches[1:]))
+
+
+def grams(sequence, n):
+    return set(sequence[i:i + n] for i in xrange(len(sequence) - n + 1))
+
+
+def align(query, sequence, n):
+    """
+    Returns (offset, matches): the start of the query in the sequence that
+    most of their shared grams agree on (negative if the query starts
+    before the sequence) and the number of equal steps there.
+    """
+    votes = collections.defaultdict(int)
+    for i in xrange(len(query) - n + 1):
+        gram = query[i:i + n]
+        start = sequence.find(gram)
+        while start != -1:
+            votes[start - i] += 1
+            start = sequence.find(gram, start + 1)
+    if not votes:
+        return 0, 0
+
+    offset = max(votes, key=lambda start: (votes[start], -abs(start)))
+    matches = sum(1 for i, step in enumerate(query)
+                  if 0 <= offset + i < len(sequence)
+                  and sequence[offset + i] == step)
+    return offset, matches
+
+
+class MelodyIndex(object):
+    """
+    Inverted index of melodies: posting lists (arrays of positions in
+    `entries`) by interval and contour grams.
+    """
+    def __init__(self, melodies=(), n=None, contour_n=None):
+        self.n = n or getattr(settings, 'MELODY_NGRAM', 3)
+        self.contour_n = contour_n or \
+          getattr(settings, 'MELODY_CONTOUR_NGRAM', 5)
+        self.entries = []
+        self.intervals = {}
+        self.contours = {}
+        for melody in melodies:
+            self.add(melody)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, melody):
+        """
+        Adds melody given as raw PieceMelody document.
+        """
+        pitches = melody['pitches']
+        entry = Entry(melody['_id'], melody['manuscript'],
+                      melody['piece_index'], melody.get('piece_name'),
+                      melody.get('title'), pitches,
+                      encode_intervals(pitches), encode_contour(pitches))
+        position = len(self.entries)
+        self.entries.append(entry)
+
+        for postings, sequence, n in (
+          (self.intervals, entry.intervals, self.n),
+          (self.contours, entry.contour, self.contour_n)):
+            for gram in grams(sequence, n):
+                posting = postings.get(gram)
+                if posting is None:
+                    posting = postings[gram] = array('I')
+                posting.append(position)
+
+    def search(self, pitches, limit=None):
+        """
+        Returns up to `limit` (MELODY_SEARCH_RESULTS) hits for the melody
+        (MIDI key numbers), best first. Raises ValueError if the melody is
+        too short to be looked up.
+        """
+        limit = limit or getattr(settings, 'MELODY_SEARCH_RESULTS', 50)
+        if len(pitches) <= self.n:
+            raise ValueError('At least %d notes expected' % (self.n + 1))
+
+        intervals = encode_intervals(pitches)
+        hits = self.lookup(intervals, self.intervals, self.n, 'intervals',
+                           limit)
+        if len(hits) < limit and len(pitches) > self.contour_n:
+            found = set(hit.id for hit in hits)
+            hits.extend(hit for hit in self.lookup(
+                encode_contour(pitches), self.contours, self.contour_n,
+                'contour', limit) if hit.id not in found)
+
+        hits.sort(key=lambda hit: (-hit.score, hit.title, hit.piece_index))
+        hits = hits[:limit]
+        for hit in hits:
+            entry = self.entries[hit.position]
+            if hit.note < len(entry.pitches):
+                hit.transposition = entry.pitches[hit.note] - \
+                  pitches[max(-hit.offset, 0)]
+        return hits
+
+    def lookup(self, query, postings, n, match, limit):
+        counts = collections.defaultdict(int)
+        for gram in grams(query, n):
+            for position in postings.get(gram, ()):
+                counts[position] += 1
+
+        # Only the candidates sharing the most grams are aligned.
+        candidates = sorted(counts, key=counts.get, reverse=True)\
+          [:limit * CANDIDATES_PER_RESULT]
+        hits = []
+        for position in candidates:
+            entry = self.entries[position]
+            sequence = entry.intervals if match == 'intervals' \
+              else entry.contour
+            offset, matches = align(query, sequence, n)
+            hits.append(Hit(entry, position, offset, matches, len(query),
+                            match))
+        return hits
+
+
+def load_index():
+    """
+    Builds the index from all melodies of `piece_melody`.
+    """
+    return MelodyIndex(PieceMelody._get_collection().find(
+        {}, fields=['manuscript', 'piece_index', 'piece_name', 'title',
+                    'pitches']))
+
+
+_index = cache.Reloadable(load_index,
+                          getattr(settings, 'MELODY_INDEX_TTL', 300))
+
+
+def get_index():
+    """
+    Returns the index of this worker (see cache.Reloadable): concurrent
+    requests wait for the first load only.
+    """
+    return _index.get()
+
+
+def search(pitches, limit=None):
+    """
+    Returns hits for the melody (see MelodyIndex.search) with the measures
+    of their first matching notes.
+    """
+    hits = get_index().search(pitches, limit)
+    if not hits:
+        return hits
+
+    measures = dict((str(melody['_id']), melody.get('measures') or [])
+                    for melody in PieceMelody._get_collection().find(
+                        {'_id': {'$in': [hit.melody_id for hit in hits]}},
+                        fields=['measures']))
+    for hit in hits:
+        hit_measures = measures.get(hit.id, [])
+        if hit.note < len(hit_measures):
+            hit.measure = hit_measures[hit.note]
+    return hits
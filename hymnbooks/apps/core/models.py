@@ -1,12 +1,15 @@
 from mongoengine import *
 from mongoengine.django.auth import User
 
+from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 
+from bson import ObjectId
 from datetime import datetime
 
-from hymnbooks.apps.core import utils
+from hymnbooks.apps.core import cache, musicxml, similarity, storage, utils
 
+import collections
 import inspect
 
 
@@ -27,6 +30,24 @@ DOCUMENT_STATUS = (('draft', _('Draft')),
                    ('suspended', _('Suspended')),
                    ('deleted', _('Deleted')))
 
+"""
+Extraction of piece scores from MusicXML (runs in the background, see
+core.tasks.extract_scores): pending until a worker gets to it, then done or
+failed (with `extraction_error`).
+"""
+EXTRACTION_STATUS = (('pending', _('Pending')),
+                     ('done', _('Done')),
+                     ('failed', _('Failed')))
+
+"""
+Ingest of a zip archive into Media library (runs in the background, see
+medialib.tasks.ingest_zip), named after the celery task states.
+"""
+INGEST_STATE = (('PENDING', _('Pending')),
+                ('PROGRESS', _('In progress')),
+                ('SUCCESS', _('Done')),
+                ('FAILURE', _('Failed')))
+
 # AUTHENTICATION AND AUTHORIZATION CLASSES
 """
 Permission types that fit API requirements.
@@ -67,10 +88,34 @@ class GlobalPermission(EmbeddedDocument):
         return u"can %s of %s" % (self.permission, self.document_type)
 
 
+def raw_permission_pairs(permissions):
+    """
+    Returns permissions as stored in the db (list of dicts) as a set of
+    (permission, document_type) pairs.
+    """
+    return set((p.get('permission'), p.get('document_type'))
+               for p in permissions or [])
+
+
+def global_permissions(pairs):
+    """
+    Returns sorted list of GlobalPermissions from (permission,
+    document_type) pairs.
+    """
+    return [GlobalPermission(permission=permission, document_type=document_type)
+            for permission, document_type in sorted(pairs)]
+
+
 class PermissionControlDocument(Document):
     permissions = ListField(EmbeddedDocumentField(GlobalPermission),
                             help_text=_(u'Permissions'))
-    meta = {'abstract': True}
+    meta = {
+        'abstract': True,
+        'index_background': True,
+        'indexes': [
+            ('permissions.permission', 'permissions.document_type')
+            ]
+        }
 
     def ensure_no_duplicates_permissions(self):
         """
@@ -82,6 +127,13 @@ class PermissionControlDocument(Document):
         permissions_dicts = [dict((m[0], m[1]) for m in l)
                              for l in permissions_clean]
         self.permissions = [GlobalPermission(**kw) for kw in permissions_dicts]
+
+    def permission_pairs(self):
+        """
+        Returns permissions defined on the document as a set of
+        (permission, document_type) pairs.
+        """
+        return set((p.permission, p.document_type) for p in self.permissions)
     
 
 class MongoGroup(PermissionControlDocument):
@@ -96,14 +148,7 @@ class MongoGroup(PermissionControlDocument):
         return self.name
 
     def has_permission(self, permission, document_type):
-        try:
-            MongoGroup.objects.get(id=self.id,
-                                   permissions__permission=permission,
-                                   permissions__document_type=document_type)
-        except (MongoGroup.DoesNotExist, MongoGroup.MultipleObjectsReturned):
-            return False
-
-        return True
+        return (permission, document_type) in self.permission_pairs()
 
     def ensure_permission(self, permission, document_type):
         if not self.has_permission(permission, document_type):
@@ -116,6 +161,54 @@ class MongoGroup(PermissionControlDocument):
         self.ensure_no_duplicates_permissions()
         
         super(MongoGroup, self).save(*args, **kwargs)
+
+        self.recompile_members()
+
+    def recompile_members(self):
+        """
+        Rebuilds effective permissions of every user in the group. Members
+        and their groups are read with one query each, members that end up
+        with the same permissions are updated together: one multi-document
+        update per distinct set of permissions.
+        """
+        users = MongoUser._get_collection()
+        members = list(users.find({'group': self.id},
+                                  fields=['username', 'permissions', 'group']))
+        if not members:
+            return
+
+        group_ids = set(group_id for member in members
+                        for group_id in member.get('group', []))
+        group_pairs = dict(
+            (group['_id'], raw_permission_pairs(group.get('permissions')))
+            for group in MongoGroup._get_collection().find(
+                {'_id': {'$in': list(group_ids)}}, fields=['permissions']))
+
+        by_pairs = {}
+        for member in members:
+            pairs = raw_permission_pairs(member.get('permissions'))
+            for group_id in member.get('group', []):
+                # Dangling references to deleted groups add nothing.
+                pairs.update(group_pairs.get(group_id, ()))
+            by_pairs.setdefault(frozenset(pairs), []).append(member['_id'])
+
+        compiled = datetime.now()
+        for pairs, user_ids in by_pairs.iteritems():
+            users.update(
+                {'_id': {'$in': user_ids}},
+                {'$set': {'effective_permissions': [
+                    permission.to_mongo()
+                    for permission in global_permissions(pairs)],
+                          'permissions_compiled': compiled}},
+                multi=True)
+
+        for member in members:
+            cache.credentials.pop(member['username'])
+            cache.users.pop(str(member['_id']))
+
+    @classmethod
+    def post_delete(cls, sender, document, **kwargs):
+        document.recompile_members()
     
 
 class MongoUser(User, PermissionControlDocument):
@@ -129,20 +222,46 @@ class MongoUser(User, PermissionControlDocument):
     api_key = StringField(required=False, max_length=256, default='')
     api_key_created = DateTimeField(help_text=_(u'Created'))
     group = ListField(ReferenceField(MongoGroup))
+    effective_permissions = ListField(EmbeddedDocumentField(GlobalPermission),
+                                      help_text=_(u'Effective permissions'))
+    permissions_compiled = DateTimeField(help_text=_(u'Permissions compiled'))
 
-    meta = {'collection': 'admin_user'}
+    meta = {
+        'collection': 'admin_user',
+        'index_background': True,
+        'indexes': [
+            ('username', 'api_key'),
+            'group',
+            'is_active',
+            'date_joined'
+            ]
+        }
 
     def save(self, *args, **kwargs):
         if not self.api_key:
             self.set_api_key()
 
         self.ensure_no_duplicates_permissions()
+        self.compile_permissions()
 
         super(MongoUser, self).save(*args, **kwargs)
 
+        # Key rotation, deactivation or permission changes.
+        self.invalidate_caches()
+
+    def delete(self, *args, **kwargs):
+        super(MongoUser, self).delete(*args, **kwargs)
+        self.invalidate_caches()
+
+    def invalidate_caches(self):
+        cache.credentials.pop(self.username)
+        if self.id is not None:
+            cache.users.pop(str(self.id))
+
     def set_api_key(self):
         self.api_key = self.generate_key()
         self.api_key_created = datetime.now()
+        cache.credentials.pop(self.username)
 
     def generate_key(self):
         import uuid, hmac
@@ -151,25 +270,48 @@ class MongoUser(User, PermissionControlDocument):
         new_uuid = uuid.uuid4()
         return hmac.new(str(new_uuid), digestmod=sha1).hexdigest()
 
-    def has_permission(self, permission, document_type):
-        # No permissions for non-active users.
-        if not self.is_active:
-            return False
-
-        # Check Group permissions.
+    def compile_permissions(self):
+        """
+        Merges individual permissions with the permissions of all the
+        user's groups into `effective_permissions`.
+        """
+        pairs = self.permission_pairs()
         for group in self.group:
-            if group.has_permission(permission, document_type):
-                return True
+            # Skip dangling references to deleted groups.
+            if isinstance(group, MongoGroup):
+                pairs.update(group.permission_pairs())
 
-        # Check individual permissions.
+        self.effective_permissions = global_permissions(pairs)
+        self.permissions_compiled = datetime.now()
+        self._permission_set = frozenset(pairs)
+
+    def get_permission_set(self):
+        """
+        Returns effective permissions as a set of (permission, document_type)
+        pairs. Built once per instance, without hitting the db.
+        """
         try:
-            MongoUser.objects.get(id=self.id,
-                                  permissions__permission=permission,
-                                  permissions__document_type=document_type)
-        except (MongoUser.DoesNotExist, MongoUser.MultipleObjectsReturned):
+            return self._permission_set
+        except AttributeError:
+            pass
+
+        if self.permissions_compiled is None:
+            # Never compiled (created before effective permissions were
+            # introduced): compile in memory, will be stored on next save.
+            self.compile_permissions()
+        else:
+            self._permission_set = frozenset(
+                (p.permission, p.document_type)
+                for p in self.effective_permissions)
+
+        return self._permission_set
+
+    def has_permission(self, permission, document_type):
+        # No permissions for non-active users.
+        if not self.is_active:
             return False
 
-        return True
+        return (permission, document_type) in self.get_permission_set()
 
     def __unicode__(self):
         return u"%s (%s)" % (self.username, self.get_full_name())
@@ -207,7 +349,17 @@ class TemplateGenericDocument(Document):
     status = StringField(choices=DOCUMENT_STATUS, default='draft',
                          help_text=_(u'Status'))
 
-    meta = {'abstract': True}
+    meta = {
+        'abstract': True,
+        'index_background': True,
+        'indexes': [
+            'status',
+            'created',
+            'updated',
+            'created_by',
+            'updated_by'
+            ]
+        }
 
     def save(self, force_insert=False, validate=True, 
              clean=True, write_concern=None, cascade=None, 
@@ -293,7 +445,10 @@ class Section(TemplateGenericDocument):
     fields = ListField(EmbeddedDocumentField(FieldDefinition),
                        help_text=_(u'Fields'))
 
-    meta = {'collection': 'cms_section'}
+    meta = {
+        'collection': 'cms_section',
+        'indexes': ['name']
+        }
 
     def save(self, *args, **kwargs):
         utils.FieldValidator().validate(self, ('fields',))
@@ -315,30 +470,161 @@ class SectionData(EmbeddedDocument):
 
 # LIBRARY
 
+class MediaBlob(Document):
+    """
+    Content-addressed store of Media library files: all the files with the
+    same content (md5) share one stored file, `refcount` is the number of
+    MediaLibrary documents referencing it.
+
+    `grid_id` is the id of the file in `storage` (see core.storage; file ids
+    are unique across the backends).
+
+    A blob is never revived once its `refcount` dropped to 0: it is being
+    removed then, and the next upload of the same content stores a new one.
+    """
+    md5 = StringField(required=True, unique=True, help_text=_(u'MD5'))
+    storage = StringField(choices=storage.STORAGES, default='gridfs',
+                          help_text=_(u'Storage'))
+    grid_id = ObjectIdField(required=True, help_text=_(u'File'))
+    size = IntField(help_text=_(u'File size'))
+    refcount = IntField(default=0, help_text=_(u'References'))
+    meta = {
+        'collection': 'media_blob',
+        'index_background': True,
+        'indexes': ['grid_id']
+        }
+
+    @classmethod
+    def acquire(cls, md5):
+        """
+        Adds a reference to the blob with given md5. Returns (storage, file
+        id) of its file or None if there is no such blob.
+        """
+        blob = cls._get_collection().find_and_modify(
+            {'md5': md5, 'refcount': {'$gt': 0}},
+            {'$inc': {'refcount': 1}}, fields={'grid_id': True, 'storage': True})
+        if blob is None:
+            return None
+        return blob.get('storage', 'gridfs'), blob['grid_id']
+
+    @classmethod
+    def register(cls, md5, storage_name, grid_id, size=None):
+        """
+        Stores a freshly written file as the blob for md5 with one reference.
+        Returns (storage, file id) of the file to use: if the same content
+        has been stored concurrently, that one is acquired and the given file
+        is deleted.
+        """
+        while True:
+            try:
+                cls(md5=md5, storage=storage_name, grid_id=grid_id, size=size,
+                    refcount=1).save()
+                return storage_name, grid_id
+            except NotUniqueError:
+                pass
+
+            existing = cls.acquire(md5)
+            if existing is not None:
+                storage.get_storage(storage_name).delete([grid_id])
+                return existing
+
+            # The existing blob is not referenced any more (being removed).
+            cls._get_collection().remove({'md5': md5, 'refcount': {'$lte': 0}})
+
+    @classmethod
+    def release(cls, grid_ids):
+        """
+        Removes references to the blobs of the files (once per occurrence
+        of the id in `grid_ids`). Returns ids of the files that nothing
+        references any more and should be deleted: blobs without references
+        and files that have never been in the store.
+        """
+        counts = collections.Counter(grid_ids)
+        collection = cls._get_collection()
+
+        by_count = collections.defaultdict(list)
+        for grid_id, count in counts.iteritems():
+            by_count[count].append(grid_id)
+        for count, ids in by_count.iteritems():
+            collection.update({'grid_id': {'$in': ids}},
+                              {'$inc': {'refcount': -count}}, multi=True)
+
+        stored, unreferenced = set(), []
+        for blob in collection.find({'grid_id': {'$in': counts.keys()}},
+                                    fields=['grid_id', 'refcount']):
+            stored.add(blob['grid_id'])
+            if blob['refcount'] <= 0:
+                unreferenced.append(blob['grid_id'])
+        if unreferenced:
+            collection.remove({'grid_id': {'$in': unreferenced},
+                               'refcount': {'$lte': 0}})
+
+        return unreferenced + [grid_id for grid_id in counts
+                               if grid_id not in stored]
+
+    def __unicode__(self):
+        return u"%s (%d)" % (self.md5, self.refcount)
+
+
 class MediaLibrary(GenericDocument):
     """
     Tree structure: containers can reference to another containes,
     which means a folder in another folder.
+
+    `ancestors` holds ids of all the folders above the document (from the
+    root down to its container), so that the whole subtree of a folder
+    can be fetched with a single indexed query.
+
+    The file is kept in `storage` (see core.storage): GridFS files in
+    `mediafile`, others by `file_id`. Its metadata (size, content type, md5
+    and image dimensions) is copied into the document on upload, so that
+    listings never touch the storage.
+
+    Folders count everything under them (recursively): `total_size` of the
+    files, `file_count` and `folder_count`. The counters are never written
+    by `save`, only changed with $inc along `ancestors` (see
+    update_counters), and rebuilt by `reconcile_media_counters` command.
+
+    A folder marked as deleted stays until everything under it has been
+    removed (see medialib.tasks.delete_subtree), `deleted_count` of
+    `delete_total` documents so far.
     """
     is_file = BooleanField(required=True, default=True,
                            help_text=_(u'File'))
+    storage = StringField(choices=storage.STORAGES, default='gridfs',
+                          help_text=_(u'Storage'))
     mediafile = FileField(help_text=_(u'Media file'))
+    file_id = ObjectIdField(help_text=_(u'Media file'))
     thumbnail = ImageField(size=(100, 100, True), help_text=_(u'Thumbnail'))
     container = ReferenceField('MediaLibrary', reverse_delete_rule=CASCADE)
     container_safe = ReferenceField('MediaLibrary') # Safe link to a container:
                                                     # updated only when it's safe
                                                     # to update.
+    ancestors = ListField(ObjectIdField(), help_text=_(u'Ancestors'))
+    size = IntField(help_text=_(u'File size'))
+    content_type = StringField(help_text=_(u'File type'))
+    md5 = StringField(help_text=_(u'MD5'))
+    width = IntField(help_text=_(u'Width'))
+    height = IntField(help_text=_(u'Height'))
+    total_size = IntField(default=0, help_text=_(u'Total size'))
+    file_count = IntField(default=0, help_text=_(u'Files'))
+    folder_count = IntField(default=0, help_text=_(u'Folders'))
+    deleted_count = IntField(help_text=_(u'Deleted'))
+    delete_total = IntField(help_text=_(u'To delete'))
     meta = {
         'collection': 'media_library',
         'indexes': [
-            {'fields': ('name', 'container', ), 'unique': True}
+            {'fields': ('name', 'container', ), 'unique': True},
+            ('container', 'is_file', 'name', 'id'), # Pages of folder content.
+            ('is_file', 'name'),
+            'ancestors'
             ]
         }
 
     @classmethod
     def pre_delete(cls, sender, document, **kwargs):
-        if document.mediafile is not None:
-            document.mediafile.delete()
+        # The file may be shared with other documents (see MediaBlob).
+        document.release_file()
 
 
     def save(self, force_insert=False, validate=True, 
@@ -351,7 +637,16 @@ class MediaLibrary(GenericDocument):
 
         # Folders are not files.
         if not self.is_file:
-            self.mediafile = None
+            self.mediafile = self.file_id = None
+
+        is_new = self.id is None
+        old_ancestors = list(self.ancestors)
+        old_size = self.size
+
+        if (not self.is_file) or (self.md5 is None) or \
+          ('mediafile' in self._changed_fields) or \
+          ('file_id' in self._changed_fields):
+            self.fill_file_metadata()
             
         if self.container:
 
@@ -370,35 +665,386 @@ class MediaLibrary(GenericDocument):
                         'cannot insert object into this folder!')
 
             self.container_safe = self.container # solidify
+            self.ancestors = self.container.ancestors + [self.container.id]
+        else:
+            self.ancestors = []
 
         super(MediaLibrary, self).save(force_insert, validate, clean,
             write_concern, cascade, cascade_kwargs, _refs, **kwargs)
 
+        # Folder moved: its subtree should follow.
+        if (not self.is_file) and (not is_new) \
+          and (old_ancestors != self.ancestors):
+            self.update_descendants(old_ancestors)
+
+        # Counters of the folders above.
+        if is_new:
+            self.update_counters(self.ancestors, *self.get_totals())
+        elif (old_ancestors != self.ancestors) or (old_size != self.size):
+            totals = self.get_totals()
+            old_totals = ((old_size or 0), 1, 0) if self.is_file else totals
+            if old_ancestors != self.ancestors:
+                self.update_counters(old_ancestors, *[-t for t in old_totals])
+                self.update_counters(self.ancestors, *totals)
+            else:
+                self.update_counters(self.ancestors, *[
+                    t - old_t for t, old_t in zip(totals, old_totals)])
+
+    def put_file(self, fileobj, content_type=None):
+        """
+        Stores content of the file as the media file of the document (the
+        document should be saved afterwards) in MEDIA_STORAGE. If the same
+        content is already in the library, its file is referenced instead of
+        a new copy (in whatever storage it is).
+        """
+        md5, size = utils.file_md5(fileobj)
+
+        # Replacing the file.
+        self.release_file()
+
+        blob = MediaBlob.acquire(md5)
+        if blob is None:
+            backend = storage.get_storage()
+            blob = MediaBlob.register(
+                md5, backend.name, backend.put(fileobj, content_type), size)
+
+        self.content_type = content_type
+        self.set_file(*blob)
+
+    def release_file(self):
+        """
+        Drops the reference of the document to its media file, the file is
+        deleted if nothing else references it (see MediaBlob). The document
+        keeps pointing to it.
+        """
+        file_id = self.get_file_id()
+        if file_id is not None:
+            self.get_storage().delete(MediaBlob.release([file_id]))
+
+    def set_file(self, storage_name, file_id):
+        """
+        Points the document to a stored file.
+        """
+        self.storage = storage_name
+        if storage_name == 'gridfs':
+            self.mediafile = self._fields['mediafile'].to_python(file_id)
+            self.file_id = None
+        else:
+            self.mediafile = None
+            self.file_id = file_id
+
+    def get_file_id(self):
+        if self.storage == 'filesystem':
+            return self.file_id
+        return self.mediafile.grid_id if self.mediafile else None
+
+    def get_storage(self):
+        return storage.get_storage(self.storage)
+
+    def open_file(self):
+        """
+        Returns the media file opened for reading (see core.storage), or None.
+        """
+        file_id = self.get_file_id()
+        if file_id is None:
+            return None
+        return self.get_storage().open(file_id, self.content_type)
+
+    def fill_file_metadata(self):
+        """
+        Copies metadata of the media file into the document.
+        """
+        stored = self.open_file() if self.is_file else None
+        if stored is None:
+            self.size = self.content_type = self.md5 = None
+            self.width = self.height = None
+            return
+
+        try:
+            self.size = stored.length
+            self.content_type = stored.content_type or self.content_type
+            self.md5 = stored.md5
+            self.width, self.height = None, None
+            if (self.content_type or '').startswith('image/'):
+                self.width, self.height = utils.image_size(stored)
+        finally:
+            stored.close()
+
+    def update_descendants(self, old_ancestors):
+        """
+        Replaces the path above the folder in ancestors of all the documents
+        under it after it has been moved, keeping them root-first. Children
+        of a folder share their ancestors: one update per folder of the
+        subtree (as in `rebuild_media_ancestors`). The folder stays among
+        the ancestors, so its subtree query is never affected.
+        """
+        collection = MediaLibrary._get_collection()
+        depth = len(old_ancestors)
+
+        # Old ancestors of the subfolders are read before anything changes.
+        folders = [(self.id, old_ancestors)] + [
+            (folder['_id'], folder['ancestors']) for folder in collection.find(
+                {'ancestors': self.id, 'is_file': False},
+                fields=['ancestors'])]
+
+        for folder_id, ancestors in folders:
+            collection.update(
+                {'container': folder_id},
+                {'$set': {'ancestors': self.ancestors + ancestors[depth:] +
+                          [folder_id]}},
+                multi=True)
+
+    def get_totals(self):
+        """
+        Returns (size, files, folders) the document adds to the counters of
+        the folders above it: the folder's own counters are read from the db.
+        """
+        if self.is_file:
+            return (self.size or 0), 1, 0
+        if self.id is None:
+            return 0, 0, 1
+
+        folder = MediaLibrary.objects(id=self.id)\
+          .only('total_size', 'file_count', 'folder_count').first()
+        return folder.total_size, folder.file_count, folder.folder_count + 1
+
+    @staticmethod
+    def update_counters(ancestors, size=0, files=0, folders=0):
+        """
+        Atomically adds the numbers to the counters of the folders.
+        """
+        if ancestors and (size or files or folders):
+            MediaLibrary.objects(id__in=ancestors).update(
+                inc__total_size=size, inc__file_count=files,
+                inc__folder_count=folders)
+
+    @classmethod
+    def post_delete(cls, sender, document, **kwargs):
+        # Documents under a folder are deleted one by one (CASCADE), every one
+        # takes away only itself.
+        if document.is_file:
+            cls.update_counters(document.ancestors, -(document.size or 0), -1)
+        else:
+            cls.update_counters(document.ancestors, folders=-1)
+
+    def get_ancestors(self):
+        """
+        Returns folders above the document, from the root down (breadcrumbs).
+        """
+        if not self.ancestors:
+            return []
+
+        return sorted(MediaLibrary.objects(id__in=self.ancestors),
+                      key=lambda folder: len(folder.ancestors))
+
+    def get_descendants(self, **kwargs):
+        """
+        Returns QuerySet of all the documents under the folder.
+        """
+        return MediaLibrary.objects(ancestors=self.id, **kwargs)
+
+    def get_subtree_query(self):
+        """
+        Returns raw query for the document and everything under it.
+        """
+        return {'$or': [{'_id': self.id}, {'ancestors': self.id}]}
+
+    def mark_deleted(self):
+        """
+        Sets 'deleted' status to the document and everything under it, so
+        that the subtree disappears from listings before it is actually
+        removed (see medialib.tasks.delete_subtree).
+        """
+        self.status = 'deleted'
+        MediaLibrary.objects(__raw__=self.get_subtree_query())\
+          .update(set__status='deleted')
+
     @staticmethod
     def higher_in_hierarchy(document, container):
         """
-        Recursively walks down, gathering folders in lower part of hierarchy,
-        and then checks if `container` is among them.
-
-        Makes sense only for existing folders. If `document` is a newly created
-        folder, throws ValidationError.
-        """
-        def _collect_lower_level_containers(folder):
-            """
-            Recurse down through hierarchy to collect folders from lower levels.
-            """
-            children = folder.__class__.objects.filter(container=folder,
-                                                       is_file=False)
-            if children:
-                lower_level_containers.extend(list(children))
-                for child in children:
-                    _collect_lower_level_containers(child)
-            return
+        Checks if `container` is `document` itself or lies lower in its part
+        of hierarchy (i.e. `document` is among ancestors of `container`).
+
+        Makes sense only for existing folders.
+        """
+        return (container.id == document.id) or \
+          (document.id in container.ancestors)
+
+
+class MediaDerivative(Document):
+    """
+    Resized copy of an image from Media library (see MEDIA_DERIVATIVES
+    setting). Derivatives are keyed by md5 of the source file, so identical
+    files share them.
+    """
+    source_md5 = StringField(required=True, help_text=_(u'Source MD5'))
+    variant = StringField(required=True, help_text=_(u'Variant'))
+    image = FileField(collection_name='derivatives', help_text=_(u'Image'))
+    width = IntField(help_text=_(u'Width'))
+    height = IntField(help_text=_(u'Height'))
+    created = DateTimeField(default=datetime.now, help_text=_(u'Created'))
+
+    meta = {
+        'collection': 'media_derivative',
+        'index_background': True,
+        'indexes': [
+            {'fields': ('source_md5', 'variant'), 'unique': True}
+            ]
+        }
+
+    def open_file(self):
+        field = self._fields['image']
+        return storage.GridFSStorage(field.collection_name, field.db_alias)\
+          .open(self.image.grid_id)
+
+    def __unicode__(self):
+        return u"%s (%s)" % (self.source_md5, self.variant)
+
+
+class MediaPeaksLevel(EmbeddedDocument):
+    """
+    Waveform peaks at one resolution: 8-bit (min, max) pairs, one pair per
+    `samples_per_peak` frames.
+    """
+    samples_per_peak = IntField(required=True,
+                                help_text=_(u'Samples per peak'))
+    data = BinaryField(help_text=_(u'Peaks'))
+
+
+class MediaPeaks(Document):
+    """
+    Waveform peaks of an audio file from Media library (see
+    medialib.peaks), keyed by md5 of the source file like derivatives.
+    Levels go from the finest resolution to the coarsest.
+    """
+    source_md5 = StringField(required=True, unique=True,
+                             help_text=_(u'Source MD5'))
+    sample_rate = IntField(help_text=_(u'Sample rate'))
+    channels = IntField(help_text=_(u'Channels'))
+    frames = IntField(help_text=_(u'Frames'))
+    levels = ListField(EmbeddedDocumentField(MediaPeaksLevel),
+                       help_text=_(u'Levels'))
+    created = DateTimeField(default=datetime.now, help_text=_(u'Created'))
+
+    meta = {
+        'collection': 'media_peaks',
+        'index_background': True
+        }
+
+    def __unicode__(self):
+        return self.source_md5
+
+
+class MediaIngest(Document):
+    """
+    State of a background ingest into Media library and its stats (see
+    medialib.ingest.IngestStats), updated by the worker after every batch.
+    Removed by MongoDB a week after the ingest started.
+    """
+    state = StringField(choices=INGEST_STATE, default='PENDING',
+                        help_text=_(u'State'))
+    stats = DictField(help_text=_(u'Stats'))
+    error = StringField(help_text=_(u'Error'))
+    created = DateTimeField(default=datetime.now, help_text=_(u'Created'))
+
+    meta = {
+        'collection': 'media_ingest',
+        'index_background': True,
+        'indexes': [
+            {'fields': ['created'], 'expireAfterSeconds': 7 * 24 * 3600}
+            ]
+        }
+
+    @classmethod
+    def report(cls, ingest_id, state, stats=None, error=None):
+        """
+        Stores the state of the ingest and its stats (serialized).
+        """
+        cls._get_collection().update({'_id': ObjectId(ingest_id)}, {'$set': {
+            'state': state, 'stats': stats or {}, 'error': error}})
+
+    @classmethod
+    def get_state(cls, ingest_id):
+        """
+        Returns {'state': ..., 'stats': ..., 'error': ...} of the ingest or
+        None if there is no such ingest.
+        """
+        if not ObjectId.is_valid(ingest_id):
+            return None
+        doc = cls._get_collection().find_one(
+            {'_id': ObjectId(ingest_id)}, fields=['state', 'stats', 'error'])
+        if doc is None:
+            return None
+        return {'state': doc.get('state', 'PENDING'),
+                'stats': doc.get('stats') or None, 'error': doc.get('error')}
+
+    def __unicode__(self):
+        return u"%s (%s)" % (self.id, self.state)
+
+
+class ParsedScore(Document):
+    """
+    MusicXML file from Media library extracted for search (see
+    core.musicxml), keyed by md5 of the source file, so that every content
+    is parsed once. The raw dictionary of the file (xmltodict) is kept only
+    if it has been asked for (MUSICXML_RAW_DICT).
+    """
+    source_md5 = StringField(required=True, unique=True,
+                             help_text=_(u'Source MD5'))
+    scores = DictField(help_text=_(u'Scores'))
+    scores_dict = DictField(help_text=_(u'Scores dictionary'))
+    created = DateTimeField(default=datetime.now, help_text=_(u'Created'))
+
+    meta = {
+        'collection': 'parsed_score',
+        'index_background': True
+        }
 
-        lower_level_containers = list()
-        _collect_lower_level_containers(document)
+    @classmethod
+    def for_media(cls, media_item, raw=False):
+        """
+        Returns ParsedScore of the MusicXML media item (with the raw
+        dictionary if `raw` is True), parses the file only if it has not
+        been parsed before (or by an older version of the extractor).
+        """
+        md5 = media_item.md5
+        parsed = cls.objects(source_md5=md5).first() if md5 else None
+        if parsed is None:
+            parsed = cls(source_md5=md5)
+
+        if parsed.scores.get('version') != musicxml.VERSION:
+            parsed.scores = cls.extract(media_item)
+        if raw and not parsed.scores_dict:
+            parsed.scores_dict = cls.parse(media_item)
+
+        if (md5 is not None) and parsed._get_changed_fields():
+            # Without md5 (metadata not filled yet) nothing to key it by.
+            try:
+                parsed.save()
+            except NotUniqueError:
+                pass # Parsed concurrently.
+        return parsed
 
-        return container in lower_level_containers
+    @staticmethod
+    def extract(media_item):
+        stored = media_item.open_file()
+        try:
+            return musicxml.extract(stored)
+        finally:
+            stored.close()
+
+    @staticmethod
+    def parse(media_item):
+        import xmltodict
+
+        stored = media_item.open_file()
+        try:
+            return xmltodict.parse(stored.read(), process_namespaces=True)
+        finally:
+            stored.close()
+
+    def __unicode__(self):
+        return self.source_md5
 
 
 class EmbeddedGenericDocument(EmbeddedDocument):
@@ -444,30 +1090,56 @@ class Piece(EmbeddedGenericDocument):
     author = ListField(StringField(), help_text=_(u'Author(s)'))
     voices = ListField(EmbeddedDocumentField(Voice), help_text=_(u'Voices'))
     incipit = ListField(StringField(), help_text=_(u'Incipit'))
+    scores = DictField(help_text=_(u'Scores'))
     scores_dict = DictField(help_text=_(u'Scores dictionary'))
+    scores_md5 = StringField(help_text=_(u'Scores MD5'))
+    extraction_status = StringField(choices=EXTRACTION_STATUS,
+                                    help_text=_(u'Extraction status'))
+    extraction_error = DictField(help_text=_(u'Extraction error'))
+
+    def is_extracted(self, media_item):
+        """
+        Checks if the scores come from the content of the media item (by
+        the current extractor, in the current mode). Content that could not
+        be extracted is not tried again.
+        """
+        if (not media_item.md5) or (self.scores_md5 != media_item.md5):
+            return False
+        if self.extraction_status == 'failed':
+            return True
+        return (self.scores.get('version') == musicxml.VERSION) and \
+          (bool(self.scores_dict) == settings.MUSICXML_RAW_DICT)
 
     def convert_mxml_to_dict(self, media_item):
         """
-        Converts MusicXML media item to dict for search. Appends the item to
-        self.media if it is not referenced for the current Piece.
+        Extracts MusicXML media item for search into `scores` (see
+        core.musicxml), and into raw `scores_dict` if MUSICXML_RAW_DICT is
+        set. Nothing is done if they already come from the same content
+        (`scores_md5`), parsed contents are shared through ParsedScore.
         """
-        import xmltodict
+        if self.is_extracted(media_item):
+            return
 
-        mxml = media_item.mediafile.read()
+        raw = settings.MUSICXML_RAW_DICT
+        self.scores_md5 = media_item.md5
         try:
-            self.scores_dict = xmltodict.parse(mxml, process_namespaces=True)
+            parsed = ParsedScore.for_media(media_item, raw)
+            self.scores = parsed.scores
+            self.scores_dict = parsed.scores_dict if raw else {}
         except Exception as e:
+            self.scores, self.scores_dict = {}, {}
             message = 'Cannot extract XML from library file %s!\nThe error os %s' %\
-              (media_item.mediafile.name, e)
+              (media_item.name, e)
             return utils.UserMessage(message).danger()
 
         return
 
     def fill_scores_dict(self, media_ref=None, ensure_reference=True):
         """
-        Converts MusicXML to dictionary from item of MediaLibrary.
+        Extracts MusicXML from item of MediaLibrary (see
+        convert_mxml_to_dict).
 
-        If media_ref is given, simply overrides self.scores_dict. Otherwise
+        If media_ref is given, simply overrides self.scores. Otherwise
         tries to fill it automatically looking for XML in media.
 
         If ensure_reference is True, ensures that it is referenced
@@ -484,13 +1156,12 @@ class Piece(EmbeddedGenericDocument):
             return danger
 
         # No media_ref provided, try to find xml in media.
-        xml_items = [f for f in self.media if f.mediafile.content_type == 'text/xml']
         try:
-            media_item = xml_items[0]
-        except IndexError:
-            return utils.UserMessage('Could not find XML in media files!').danger()
+            media_item = self.get_xml_item()
         except Exception as e:
             return utils.UserMessage('Error: %s' % e).danger()
+        if media_item is None:
+            return utils.UserMessage('Could not find XML in media files!').danger()
 
         danger = self.convert_mxml_to_dict(media_item)
         if not danger:
@@ -498,6 +1169,45 @@ class Piece(EmbeddedGenericDocument):
 
         return danger
 
+    def get_xml_item(self):
+        """
+        Returns the first MusicXML item of media (by the content type copied
+        into the documents, files are not touched) or None.
+        """
+        for media_item in self.media:
+            if media_item.content_type == 'text/xml':
+                return media_item
+        return None
+
+    def prepare_extraction(self):
+        """
+        Marks the piece as pending if its scores should be extracted (again).
+        Returns True if so.
+        """
+        try:
+            media_item = self.get_xml_item()
+        except Exception:
+            # Broken reference: the worker reports it (once).
+            if self.extraction_status == 'failed':
+                return False
+        else:
+            if (media_item is None) or self.is_extracted(media_item):
+                return False
+
+        self.extraction_status = 'pending'
+        self.extraction_error = {}
+        return True
+
+    def extract(self):
+        """
+        Extracts scores (in a worker, see core.tasks.extract_scores) and
+        records the outcome.
+        """
+        danger = self.fill_scores_dict()
+        self.extraction_status = 'failed' if danger else 'done'
+        self.extraction_error = danger or {}
+        return danger
+
 class ManuscriptContent(EmbeddedGenericDocument):
     """
     Actual Manuscript content (scan parts and description).
@@ -505,6 +1215,10 @@ class ManuscriptContent(EmbeddedGenericDocument):
     page_description = StringField(help_text=_(u'Description'))
 
 
+# Fields of a piece that go into its melody (see PieceMelody).
+MELODY_FIELDS = ('name', 'scores', 'extraction_status')
+
+
 class Manuscript(GenericDocument):
     """
     Main container for manuscripts.
@@ -516,6 +1230,10 @@ class Manuscript(GenericDocument):
     pieces = ListField(EmbeddedDocumentField(Piece), help_text=_(u'Pieces'))
     media = ListField(ReferenceField(MediaLibrary))
 
+    meta = {
+        'indexes': ['name', 'title']
+        }
+
     def clean(self):
         utils.FieldValidator().validate(self, ('content',))
 
@@ -523,13 +1241,107 @@ class Manuscript(GenericDocument):
              clean=True, write_concern=None, cascade=None, 
              cascade_kwargs=None, _refs=None, **kwargs):
 
-        # Try to convert scores.
-        for piece in self.pieces:
-            piece.fill_scores_dict()                
+        # Scores are converted in the background.
+        pending = [piece for piece in self.pieces
+                   if piece.prepare_extraction()]
+        melodies_changed = self.melodies_changed()
 
         super(Manuscript, self).save(force_insert, validate, clean,
             write_concern, cascade, cascade_kwargs, _refs, **kwargs)
 
+        # Melodies are indexed after the extraction, or right away if they
+        # have changed.
+        from hymnbooks.apps.core import tasks
+        if pending:
+            tasks.extract_scores.delay(str(self.id))
+        elif melodies_changed:
+            tasks.index_melodies.delay(str(self.id))
+
+    def melodies_changed(self):
+        """
+        Checks if the changes of the document (not saved yet) affect the
+        melodies of its pieces (see PieceMelody): its title, the list of
+        pieces, or names, scores or extraction status of some of them.
+        """
+        if self.id is None:
+            return bool(self.pieces)
+
+        for field in self._get_changed_fields():
+            path = field.split('.')
+            if (path[0] == 'title') or ((path[0] == 'pieces') and \
+              ((len(path) < 3) or (path[2] in MELODY_FIELDS))):
+                return True
+        return False
+
+    @classmethod
+    def post_delete(cls, sender, document, **kwargs):
+        PieceMelody.objects(manuscript=document.id).delete()
+
+    def get_extraction_progress(self):
+        """
+        Returns numbers of pieces by extraction status.
+        """
+        progress = dict((status, 0) for status, name in EXTRACTION_STATUS)
+        for piece in self.pieces:
+            if piece.extraction_status in progress:
+                progress[piece.extraction_status] += 1
+        return progress
+
+
+class PieceMelody(Document):
+    """
+    Melody of a piece (see core.musicxml.get_melody) for the melodic
+    search (see core.melody) and its features for similarity of pieces
+    (see core.similarity), one per piece with scores, addressed by the
+    manuscript and the position of the piece in it.
+    """
+    manuscript = ReferenceField(Manuscript, required=True,
+                                help_text=_(u'Manuscript'))
+    piece_index = IntField(required=True, help_text=_(u'Piece position'))
+    piece_name = StringField(help_text=_(u'Piece'))
+    title = StringField(help_text=_(u'Manuscript title'))
+    pitches = ListField(IntField(), help_text=_(u'MIDI key numbers'))
+    measures = ListField(StringField(), help_text=_(u'Measures'))
+    features = BinaryField(help_text=_(u'Features'))
+    updated = DateTimeField(default=datetime.now, help_text=_(u'Updated'))
+
+    meta = {
+        'collection': 'piece_melody',
+        'indexes': [('manuscript', 'piece_index')],
+        'index_background': True
+        }
+
+    @classmethod
+    def update_manuscript(cls, manuscript):
+        """
+        Replaces melodies of the manuscript with those of its pieces: every
+        melody is upserted in place, then the rows of pieces without one
+        are removed, so that readers never miss a melody that is kept.
+        Returns number of melodies.
+        """
+        collection = cls._get_collection()
+        indexes = []
+        for index, piece in enumerate(manuscript.pieces):
+            pitches, measures, durations = musicxml.get_melody(piece.scores)
+            if len(pitches) < 2:
+                continue
+            features = similarity.get_features(pitches, durations)
+            melody = cls(manuscript=manuscript, piece_index=index,
+                         piece_name=piece.name, title=manuscript.title,
+                         pitches=pitches, measures=measures,
+                         features=similarity.to_binary(features))
+            collection.update({'manuscript': manuscript.id,
+                               'piece_index': index},
+                              melody.to_mongo(), upsert=True)
+            indexes.append(index)
+
+        collection.remove({'manuscript': manuscript.id,
+                           'piece_index': {'$nin': indexes}})
+        return len(indexes)
+
+    def __unicode__(self):
+        return u'%s #%d' % (self.title, self.piece_index)
+
 
 # SIGNALS
 
@@ -557,3 +1369,6 @@ def control_permissions(sender, **kwargs):
 
 
 signals.pre_delete.connect(MediaLibrary.pre_delete, sender=MediaLibrary)
+signals.post_delete.connect(MediaLibrary.post_delete, sender=MediaLibrary)
+signals.post_delete.connect(MongoGroup.post_delete, sender=MongoGroup)
+signals.post_delete.connect(Manuscript.post_delete, sender=Manuscript)
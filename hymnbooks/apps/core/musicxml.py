@@ -0,0 +1,249 @@
+"""
+Extraction of MusicXML scores into a compact representation for search.
+
+The file is read with lxml `iterparse`: every measure is dropped as soon as
+its notes are taken, so memory does not depend on the length of the score.
+Layout, credits, encoding and MIDI settings are skipped.
+
+Representation (VERSION 1):
+
+    {'version': 1,
+     'title': <work or movement title or None>,
+     'composer': <creator of type composer or None>,
+     'fields': NOTE_FIELDS,
+     'parts': [{'id': 'P1', 'name': 'Soprano',
+                'keys': [[<measure>, <fifths>, <mode>], ...],
+                'times': [[<measure>, <beats>, <beat type>], ...],
+                'notes': [[<value of every field of NOTE_FIELDS>], ...]}]}
+
+Note fields:
+
+* measure - measure number (string, as in the file)
+* voice - voice (string, '1' if not given)
+* pitch - spelled pitch ('B-4', '-' flat, '#' sharp) or None for rests
+* midi - MIDI key number or None for rests
+* duration - in quarter notes (0 for grace notes)
+* chord - True if the note sounds with the previous one
+* tied - True if the note continues the previous one (tie stop)
+* lyric - text of the first lyric or None
+* syllabic - 'single', 'begin', 'middle', 'end' or None
+"""
+from lxml import etree
+
+
+VERSION = 1
+
+NOTE_FIELDS = ('measure', 'voice', 'pitch', 'midi', 'duration', 'chord',
+               'tied', 'lyric', 'syllabic')
+
+STEPS = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+
+
+def localname(elem):
+    tag = elem.tag
+    if not isinstance(tag, basestring):
+        return None # Comment or processing instruction.
+    return tag.rsplit('}', 1)[-1]
+
+
+def child(elem, name):
+    for item in elem:
+        if localname(item) == name:
+            return item
+    return None
+
+
+def child_text(elem, name, default=None):
+    item = child(elem, name)
+    if (item is None) or (item.text is None):
+        return default
+    return item.text.strip()
+
+
+def to_number(text, default=None):
+    try:
+        number = float(text)
+    except (TypeError, ValueError):
+        return default
+    return int(number) if number.is_integer() else number
+
+
+def spell_pitch(step, alter, octave):
+    """
+    Returns (spelled pitch, MIDI key number).
+    """
+    accidental = ('#' * int(alter)) if alter > 0 else ('-' * int(-alter))
+    midi = (octave + 1) * 12 + STEPS[step] + alter
+    return '%s%s%d' % (step, accidental, octave), int(round(midi))
+
+
+class Extractor(object):
+    """
+    Collects the representation from iterparse events (works for both
+    score-partwise and score-timewise files).
+    """
+    def __init__(self):
+        self.score = {'version': VERSION, 'title': None, 'composer': None,
+                      'fields': list(NOTE_FIELDS), 'parts': []}
+        self.parts = {}
+        self.part = None
+        self.measure = None
+
+    def get_part(self, part_id):
+        part = self.parts.get(part_id)
+        if part is None:
+            part = {'id': part_id, 'name': None,
+                    'keys': [], 'times': [], 'notes': []}
+            self.parts[part_id] = part
+            self.score['parts'].append(part)
+        return part
+
+    def start(self, name, elem):
+        if name == 'part':
+            self.part = self.get_part(elem.get('id'))
+            self.part.setdefault('divisions', 1)
+        elif name == 'measure':
+            self.measure = elem.get('number')
+
+    def end(self, name, elem):
+        """
+        Handles the element, returns True if it can be dropped.
+        """
+        if name == 'note':
+            self.note(elem)
+        elif name == 'attributes':
+            self.attributes(elem)
+        elif name == 'score-part':
+            self.get_part(elem.get('id'))['name'] = \
+              child_text(elem, 'part-name')
+        elif name in ('work-title', 'movement-title'):
+            self.score['title'] = self.score['title'] or \
+              (elem.text or '').strip() or None
+            return False
+        elif (name == 'creator') and (elem.get('type') == 'composer'):
+            self.score['composer'] = (elem.text or '').strip() or None
+            return False
+        elif name in ('part', 'measure', 'defaults', 'credit',
+                      'identification', 'part-list'):
+            return True
+        return False
+
+    def attributes(self, elem):
+        part = self.part
+        if part is None:
+            return
+
+        divisions = to_number(child_text(elem, 'divisions'))
+        if divisions:
+            part['divisions'] = divisions
+
+        key = child(elem, 'key')
+        if key is not None:
+            part['keys'].append([self.measure,
+                                 to_number(child_text(key, 'fifths'), 0),
+                                 child_text(key, 'mode')])
+
+        time = child(elem, 'time')
+        if time is not None:
+            part['times'].append([self.measure,
+                                  child_text(time, 'beats'),
+                                  to_number(child_text(time, 'beat-type'))])
+
+    def note(self, elem):
+        part = self.part
+        if part is None:
+            return
+
+        pitch = midi = None
+        pitch_elem = child(elem, 'pitch')
+        if pitch_elem is not None:
+            step = child_text(pitch_elem, 'step')
+            octave = to_number(child_text(pitch_elem, 'octave'))
+            if (step in STEPS) and (octave is not None):
+                pitch, midi = spell_pitch(
+                    step, to_number(child_text(pitch_elem, 'alter'), 0),
+                    octave)
+
+        duration = 0
+        if child(elem, 'grace') is None:
+            duration = round(float(to_number(child_text(elem, 'duration'), 0))
+                             / part['divisions'], 4)
+
+        tied = any(item.get('type') == 'stop' for item in elem
+                   if localname(item) == 'tie')
+
+        lyric = child(elem, 'lyric')
+        text = syllabic = None
+        if lyric is not None:
+            text = child_text(lyric, 'text')
+            syllabic = child_text(lyric, 'syllabic')
+
+        part['notes'].append([self.measure, child_text(elem, 'voice', '1'),
+                              pitch, midi, duration,
+                              child(elem, 'chord') is not None, tied,
+                              text, syllabic])
+
+    def finish(self):
+        for part in self.score['parts']:
+            part.pop('divisions', None)
+        return self.score
+
+
+def get_melody(scores):
+    """
+    Returns the melody of the compact representation: (MIDI key numbers,
+    measures, durations) of the notes of the first voice of the first part
+    with notes. Rests, grace notes and lower notes of chords are left out,
+    continuations of tied notes are added to their durations.
+    """
+    for part in scores.get('parts') or []:
+        if part['notes']:
+            break
+    else:
+        return [], [], []
+
+    fields = scores.get('fields') or NOTE_FIELDS
+    index = dict((name, i) for i, name in enumerate(fields))
+    notes = [dict((name, note[i]) for name, i in index.iteritems())
+             for note in part['notes']]
+
+    voice = next((note['voice'] for note in notes if note['midi'] is not None),
+                 None)
+    pitches, measures, durations = [], [], []
+    for note in notes:
+        if (note['voice'] != voice) or (note['midi'] is None) or \
+          note['chord'] or (not note['duration']):
+            continue
+        if note['tied'] and pitches and (pitches[-1] == note['midi']):
+            durations[-1] += note['duration']
+            continue
+        pitches.append(note['midi'])
+        measures.append(note['measure'])
+        durations.append(note['duration'])
+    return pitches, measures, durations
+
+
+def extract(fileobj):
+    """
+    Returns compact representation of MusicXML file (see module docstring).
+    Raises etree.XMLSyntaxError if the file is not well-formed.
+    """
+    extractor = Extractor()
+    events = etree.iterparse(fileobj, events=('start', 'end'),
+                             resolve_entities=False, no_network=True,
+                             remove_comments=True)
+    for event, elem in events:
+        name = localname(elem)
+        if event == 'start':
+            extractor.start(name, elem)
+            continue
+
+        if extractor.end(name, elem):
+            # Drop the element and whatever preceded it in its parent.
+            elem.clear()
+            parent = elem.getparent()
+            if parent is not None:
+                while elem.getprevious() is not None:
+                    del parent[0]
+
+    return extractor.finish()
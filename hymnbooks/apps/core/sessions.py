@@ -0,0 +1,49 @@
+"""
+MongoDB session engine with an optional in-process cache layer.
+
+Sessions are stored by mongoengine's MongoSession, which expires them
+through a TTL index on `expire_date`. Decoded sessions are kept in the
+worker for SESSION_CACHE_TTL seconds (SESSION_CACHE_SIZE = 0 disables
+the cache), so a cached session can outlive its logout in other workers
+by that long at most.
+
+Usage: SESSION_ENGINE = 'hymnbooks.apps.core.sessions'
+"""
+from mongoengine.django import sessions
+
+from hymnbooks.apps.core import cache
+
+
+def is_cached(session_key):
+    """
+    Sessions with a key are cached, unless SESSION_CACHE_SIZE is 0.
+    """
+    return session_key is not None and cache.sessions.maxsize > 0
+
+
+class SessionStore(sessions.SessionStore):
+
+    def load(self):
+        if is_cached(self.session_key):
+            data = cache.sessions.get(self.session_key)
+            if data is not None:
+                return dict(data)
+
+        data = super(SessionStore, self).load()
+        if is_cached(self.session_key):
+            cache.sessions.set(self.session_key, dict(data))
+
+        return data
+
+    def save(self, must_create=False):
+        super(SessionStore, self).save(must_create=must_create)
+        if is_cached(self.session_key):
+            cache.sessions.set(self.session_key,
+                               dict(self._get_session(no_load=must_create)))
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            session_key = self.session_key
+        super(SessionStore, self).delete(session_key)
+        if is_cached(session_key):
+            cache.sessions.pop(session_key)
@@ -0,0 +1,175 @@
+"""
+Approximate melodic similarity of pieces (variants of a melody across the
+manuscripts).
+
+Every melody (see core.musicxml.get_melody) is described by a fixed-length
+vector of features, stored with it (PieceMelody.features, float32):
+
+* interval histogram - shares of the intervals from an octave down to an
+  octave up (wider ones are counted as an octave)
+* contour - the pitches relative to their mean, resampled to
+  CONTOUR_POINTS points (in octaves)
+* rhythm profile - shares of the ratios of durations of consecutive notes
+  (log2, rounded, from 1:8 to 8:1)
+
+Blocks are normalized and weighted (WEIGHTS), the vector has unit length:
+cosine similarity is a dot product. All features are transposition
+invariant, the rhythm profile is also invariant to the note values used.
+
+Every worker keeps the vectors of all melodies in a matrix (reloaded in
+the background after MELODY_INDEX_TTL seconds): a query is scored against
+all of them with one matrix-vector product, the best ones are selected
+with `argpartition`.
+"""
+from django.conf import settings
+
+from hymnbooks.apps.core import cache
+
+import numpy
+
+
+INTERVAL_RANGE = 12
+CONTOUR_POINTS = 16
+RHYTHM_RANGE = 3
+
+WEIGHTS = {'intervals': 1.0, 'contour': 1.0, 'rhythm': 0.5}
+
+FEATURE_SIZE = (2 * INTERVAL_RANGE + 1) + CONTOUR_POINTS + \
+  (2 * RHYTHM_RANGE + 1)
+
+
+def normalize(vector):
+    norm = numpy.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def interval_histogram(pitches):
+    intervals = numpy.clip(numpy.diff(pitches), -INTERVAL_RANGE,
+                           INTERVAL_RANGE)
+    return numpy.bincount(intervals + INTERVAL_RANGE,
+                          minlength=2 * INTERVAL_RANGE + 1)\
+      .astype(numpy.float32)
+
+
+def contour_vector(pitches):
+    pitches = numpy.asarray(pitches, dtype=numpy.float32)
+    points = numpy.linspace(0, len(pitches) - 1, CONTOUR_POINTS)
+    contour = numpy.interp(points, numpy.arange(len(pitches)), pitches)
+    return ((contour - pitches.mean()) / 12).astype(numpy.float32)
+
+
+def rhythm_profile(durations):
+    durations = numpy.asarray(durations, dtype=numpy.float64)
+    if len(durations) < 2 or not (durations > 0).all():
+        return numpy.zeros(2 * RHYTHM_RANGE + 1, dtype=numpy.float32)
+    ratios = numpy.rint(numpy.log2(durations[1:] / durations[:-1]))
+    ratios = numpy.clip(ratios, -RHYTHM_RANGE, RHYTHM_RANGE).astype(int)
+    return numpy.bincount(ratios + RHYTHM_RANGE,
+                          minlength=2 * RHYTHM_RANGE + 1)\
+      .astype(numpy.float32)
+
+
+def get_features(pitches, durations=None):
+    """
+    Returns feature vector (float32 array of FEATURE_SIZE) of the melody.
+    Without durations the rhythm profile is left empty.
+    """
+    if len(pitches) < 2:
+        raise ValueError('At least 2 notes expected')
+    blocks = [('intervals', interval_histogram(pitches)),
+              ('contour', contour_vector(pitches)),
+              ('rhythm', rhythm_profile(durations or []))]
+    return normalize(numpy.concatenate(
+        [normalize(block) * WEIGHTS[name] for name, block in blocks]))\
+      .astype(numpy.float32)
+
+
+def to_binary(features):
+    return features.astype('<f4').tostring()
+
+
+def from_binary(data):
+    return numpy.frombuffer(data, dtype='<f4')
+
+
+class FeatureMatrix(object):
+    """
+    Feature vectors of the melodies as rows of a matrix, with the raw
+    PieceMelody documents they come from (without the features).
+    """
+    def __init__(self, melodies=()):
+        self.melodies, rows = [], []
+        for melody in melodies:
+            data = melody.pop('features', None)
+            if not data or len(data) != FEATURE_SIZE * 4:
+                continue # Not indexed (yet) or by other features.
+            self.melodies.append(melody)
+            rows.append(str(data))
+        self.matrix = from_binary(''.join(rows)).reshape(-1, FEATURE_SIZE)
+        self.positions = dict(
+            ((str(melody['manuscript']), melody['piece_index']), position)
+            for position, melody in enumerate(self.melodies))
+
+    def __len__(self):
+        return len(self.melodies)
+
+    def top_k(self, vector, k, exclude=()):
+        """
+        Returns up to `k` (position, score) of the rows most similar to the
+        vector, best first, leaving out positions in `exclude`.
+        """
+        scores = self.matrix.dot(vector)
+        if exclude:
+            scores[list(exclude)] = -numpy.inf
+        k = min(k, len(scores) - len(exclude))
+        if k <= 0:
+            return []
+        best = numpy.argpartition(-scores, k - 1)[:k]
+        best = best[numpy.argsort(-scores[best], kind='mergesort')]
+        return [(int(position), float(scores[position])) for position in best]
+
+
+def load_matrix():
+    """
+    Builds the matrix from all melodies of `piece_melody`.
+    """
+    from hymnbooks.apps.core.models import PieceMelody
+
+    return FeatureMatrix(PieceMelody._get_collection().find(
+        {}, fields=['manuscript', 'piece_index', 'piece_name', 'title',
+                    'features']))
+
+
+_matrix = cache.Reloadable(load_matrix,
+                           getattr(settings, 'MELODY_INDEX_TTL', 300))
+
+
+def get_matrix():
+    """
+    Returns the matrix of this worker (see cache.Reloadable): concurrent
+    requests wait for the first load only.
+    """
+    return _matrix.get()
+
+
+def similar(vector, k=None, exclude=(), matrix=None):
+    """
+    Returns up to `k` (SIMILARITY_RESULTS) (raw PieceMelody, score) most
+    similar to the feature vector, best first.
+    """
+    k = k or getattr(settings, 'SIMILARITY_RESULTS', 20)
+    if matrix is None:
+        matrix = get_matrix()
+    return [(matrix.melodies[position], score)
+            for position, score in matrix.top_k(vector, k, exclude)]
+
+
+def similar_to_piece(manuscript_id, piece_index, k=None):
+    """
+    Same as `similar` for an indexed piece (leaving it out). Raises
+    KeyError if the piece is not in the index.
+    """
+    matrix = get_matrix()
+    position = matrix.positions[(str(manuscript_id), piece_index)]
+    return similar(matrix.matrix[position], k, exclude=[position],
+                   matrix=matrix)
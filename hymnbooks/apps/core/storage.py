@@ -0,0 +1,234 @@
+"""
+Storage backends of Media library files.
+
+Files are identified by ObjectId in every backend (ids are unique across
+them, see MediaBlob), opened files are read-only file-like objects with
+`length`, `md5`, `content_type` and `upload_date` attributes (as GridOut)
+and `iter_range(start, end)` yielding the content between the offsets.
+
+* GridFSStorage - files and chunks in Mongo (mongoengine's FileField).
+* FileSystemStorage - files in a sharded directory tree on the local disk
+  (MEDIA_STORAGE_ROOT), read through memory maps.
+"""
+from django.conf import settings
+from django.utils.translation import ugettext_lazy as _
+
+from bson import ObjectId
+from datetime import datetime
+from gridfs import GridIn, GridOut
+from gridfs.errors import NoFile
+from mongoengine.connection import DEFAULT_CONNECTION_NAME, get_db
+
+import errno
+import hashlib
+import mmap
+import os
+import tempfile
+
+
+STORAGES = (('gridfs', _('GridFS')),
+            ('filesystem', _('File system')))
+
+CHUNK_SIZE = 256 * 1024
+
+
+class GridFSFile(GridOut):
+    """
+    GridFS file that reads ranges of chunks with a single cursor.
+    """
+    def __init__(self, root_collection, file_id=None, file_document=None):
+        super(GridFSFile, self).__init__(root_collection, file_id,
+                                         file_document)
+        self.chunks = root_collection.chunks
+
+    def iter_range(self, start=0, end=None):
+        if end is None:
+            end = self.length - 1
+        if end < start:
+            return
+
+        first, last = start // self.chunk_size, end // self.chunk_size
+        cursor = self.chunks.find(
+            {'files_id': self._id, 'n': {'$gte': first, '$lte': last}},
+            sort=[('n', 1)])
+        for chunk in cursor:
+            offset = chunk['n'] * self.chunk_size
+            data = chunk['data']
+            yield data[max(start - offset, 0):end - offset + 1]
+
+
+class GridFSStorage(object):
+    name = 'gridfs'
+
+    def __init__(self, collection_name='fs', db_alias=DEFAULT_CONNECTION_NAME):
+        self.collection_name = collection_name
+        self.db_alias = db_alias
+
+    def get_collection(self):
+        return get_db(self.db_alias)[self.collection_name]
+
+    def put(self, fileobj, content_type=None, **kwargs):
+        """
+        Stores content of the file, returns its id.
+        """
+        grid_in = GridIn(self.get_collection(), content_type=content_type,
+                         **kwargs)
+        try:
+            while True:
+                chunk = fileobj.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                grid_in.write(chunk)
+        finally:
+            grid_in.close()
+        return grid_in._id
+
+    def open(self, file_id, content_type=None):
+        """
+        Returns the file or None if it does not exist.
+        """
+        try:
+            return GridFSFile(self.get_collection(), file_id)
+        except NoFile:
+            return None
+
+    def delete(self, file_ids):
+        """
+        Removes the files (and their chunks) with two `$in` removals.
+        """
+        if not file_ids:
+            return
+        collection = self.get_collection()
+        collection.files.remove({'_id': {'$in': file_ids}})
+        collection.chunks.remove({'files_id': {'$in': file_ids}})
+
+
+class MappedFile(object):
+    """
+    Read-only file of FileSystemStorage, memory-mapped: reads and ranges are
+    slices of the page cache, nothing is buffered by Python.
+    """
+    def __init__(self, path, content_type=None):
+        self.path = path
+        self.content_type = content_type
+        with open(path, 'rb') as fileobj:
+            stat = os.fstat(fileobj.fileno())
+            self.length = stat.st_size
+            # Empty files cannot be mapped.
+            self.data = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ) \
+              if self.length else ''
+        self.upload_date = datetime.utcfromtimestamp(stat.st_mtime)
+        self.position = 0
+        self._md5 = None
+
+    @property
+    def md5(self):
+        if self._md5 is None:
+            self._md5 = hashlib.md5(self.data).hexdigest()
+        return self._md5
+
+    def read(self, size=-1):
+        end = self.length if (size is None) or (size < 0) \
+          else min(self.position + size, self.length)
+        data = self.data[self.position:end]
+        self.position = max(end, self.position)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.length
+        if offset < 0:
+            raise IOError(errno.EINVAL, 'Invalid offset')
+        self.position = offset
+
+    def tell(self):
+        return self.position
+
+    def iter_range(self, start=0, end=None):
+        if end is None:
+            end = self.length - 1
+        for offset in xrange(start, end + 1, CHUNK_SIZE):
+            yield self.data[offset:min(offset + CHUNK_SIZE, end + 1)]
+
+    def close(self):
+        if self.length:
+            self.data.close()
+
+
+class FileSystemStorage(object):
+    """
+    Files are named by their id and sharded by its last (most variable)
+    digits: <root>/<id[-2:]>/<id[-4:-2]>/<id>.
+    """
+    name = 'filesystem'
+
+    def __init__(self, root=None):
+        self.root = root or settings.MEDIA_STORAGE_ROOT
+
+    def path(self, file_id):
+        name = str(file_id)
+        return os.path.join(self.root, name[-2:], name[-4:-2], name)
+
+    def put(self, fileobj, content_type=None, **kwargs):
+        """
+        Stores content of the file, returns its id. The file appears under
+        its name only when it is complete.
+        """
+        file_id = ObjectId()
+        path = self.path(file_id)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        handle, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(handle, 'wb') as output:
+                while True:
+                    chunk = fileobj.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    output.write(chunk)
+            os.rename(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        return file_id
+
+    def open(self, file_id, content_type=None):
+        """
+        Returns the file or None if it does not exist. The storage keeps no
+        metadata: content type comes from the referencing document.
+        """
+        try:
+            return MappedFile(self.path(file_id), content_type)
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    def delete(self, file_ids):
+        for file_id in file_ids:
+            try:
+                os.remove(self.path(file_id))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+def get_storage(name=None):
+    """
+    Returns backend of Media library files by name (MEDIA_STORAGE by
+    default).
+    """
+    name = name or settings.MEDIA_STORAGE
+    if name == 'gridfs':
+        return GridFSStorage()
+    if name == 'filesystem':
+        return FileSystemStorage()
+    raise ValueError('Unknown storage: %s' % name)
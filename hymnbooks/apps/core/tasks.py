@@ -0,0 +1,74 @@
+"""
+Background processing of end-user data (celery tasks).
+"""
+from django.conf import settings
+
+from celery import task
+from celery.utils.log import get_task_logger
+
+from hymnbooks.apps.core.models import Manuscript, PieceMelody
+
+
+logger = get_task_logger(__name__)
+
+# Fields of a piece written back by the extraction.
+EXTRACTION_FIELDS = ('scores', 'scores_dict', 'scores_md5',
+                     'extraction_status', 'extraction_error')
+
+
+@task(soft_time_limit=settings.SCORES_EXTRACTION_TIME_LIMIT)
+def extract_scores(manuscript_id):
+    """
+    Extracts scores of the pending pieces of the manuscript (progress is
+    their extraction status, see Manuscript.get_extraction_progress).
+    Returns numbers of pieces by extraction status.
+
+    Results are written into the pieces in place, so that edits of the
+    manuscript made in the meantime are kept. A piece that has been moved
+    or edited again is left alone: that save has scheduled another run.
+    A manuscript deleted in the meantime has no progress.
+    """
+    try:
+        manuscript = Manuscript.objects.get(id=manuscript_id)
+    except Manuscript.DoesNotExist:
+        return Manuscript().get_extraction_progress()
+    collection = Manuscript._get_collection()
+
+    pending = [(index, piece) for index, piece in enumerate(manuscript.pieces)
+               if piece.extraction_status == 'pending']
+    for index, piece in pending:
+        piece.extract()
+
+        prefix = 'pieces.%d.' % index
+        data = piece.to_mongo()
+        collection.update(
+            {'_id': manuscript.id, prefix + 'name': piece.name,
+             prefix + 'extraction_status': 'pending'},
+            {'$set': dict((prefix + name, data.get(name))
+                          for name in EXTRACTION_FIELDS)})
+
+    # Fetched again, not reloaded: reload of a deleted document raises
+    # OperationError.
+    try:
+        manuscript = Manuscript.objects.get(id=manuscript.id)
+    except Manuscript.DoesNotExist:
+        return Manuscript().get_extraction_progress()
+    PieceMelody.update_manuscript(manuscript)
+
+    progress = manuscript.get_extraction_progress()
+    logger.info('Scores of manuscript %s extracted: %s', manuscript_id,
+                progress)
+    return progress
+
+
+@task()
+def index_melodies(manuscript_id):
+    """
+    Replaces melodies of the manuscript's pieces in the melodic index (see
+    core.melody). Returns number of indexed pieces.
+    """
+    try:
+        manuscript = Manuscript.objects.get(id=manuscript_id)
+    except Manuscript.DoesNotExist:
+        return 0 # Deleted in the meantime.
+    return PieceMelody.update_manuscript(manuscript)
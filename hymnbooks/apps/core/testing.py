@@ -0,0 +1,120 @@
+"""
+Helpers for the tests that run without MongoDB: in-memory collections for
+the raw queries of the models and patches undone after every test.
+"""
+from bson import ObjectId
+from pymongo.errors import AutoReconnect
+
+
+MISSING = object()
+
+
+def patch(test, obj, name, value):
+    """
+    Sets attribute `name` of `obj` (class, module, settings) to `value`
+    until the end of the test. An attribute of a class is looked up in the
+    class itself: an inherited one is removed again, not copied.
+    """
+    if isinstance(obj, type):
+        original = obj.__dict__.get(name, MISSING)
+    else:
+        original = getattr(obj, name, MISSING)
+
+    def restore():
+        if original is MISSING:
+            delattr(obj, name)
+        else:
+            setattr(obj, name, original)
+
+    setattr(obj, name, value)
+    test.addCleanup(restore)
+
+
+def patch_collection(test, document, collection):
+    """
+    Makes `collection` the collection of the document class for the test.
+    """
+    patch(test, document, '_get_collection',
+          classmethod(lambda cls: collection))
+
+
+class FakeCursor(list):
+    def count(self):
+        return len(self)
+
+    def batch_size(self, n):
+        return self
+
+
+class FakeCollection(object):
+    """
+    In-memory collection for raw queries: equality (membership for lists),
+    `$in` and `$nin`; updates with `$set` or replacement (and upserts);
+    inserts and removals. Updates and removal queries are recorded. Inserts
+    fail (like a lost connection) after `insert_limit` documents.
+    """
+    def __init__(self, documents, insert_limit=None):
+        self.documents = documents
+        self.insert_limit = insert_limit
+        self.updates = []
+        self.removed = []
+
+    def matches(self, document, query):
+        for key, value in query.iteritems():
+            actual = document.get(key)
+            values = actual if isinstance(actual, list) else [actual]
+            if isinstance(value, dict):
+                if '$nin' in value:
+                    if any(v in value['$nin'] for v in values):
+                        return False
+                elif not any(v in value['$in'] for v in values):
+                    return False
+            elif actual != value and value not in values:
+                return False
+        return True
+
+    def find(self, query=None, fields=None):
+        return FakeCursor(dict(document) for document in self.documents
+                          if self.matches(document, query or {}))
+
+    def find_one(self, query=None, fields=None):
+        found = self.find(query, fields)
+        return found[0] if found else None
+
+    def insert(self, documents, **kwargs):
+        self.documents.extend(documents[:self.insert_limit])
+        if self.insert_limit is not None and \
+          len(documents) > self.insert_limit:
+            raise AutoReconnect('Connection lost')
+        return [document['_id'] for document in documents]
+
+    def update(self, query, update, multi=False, upsert=False):
+        self.updates.append(update)
+        matched = False
+        for document in self.documents:
+            if self.matches(document, query):
+                matched = True
+                if '$set' in update:
+                    document.update(update['$set'])
+                else:
+                    document_id = document.get('_id')
+                    document.clear()
+                    document.update(update, _id=document_id)
+        if upsert and not matched:
+            document = dict(query, _id=ObjectId())
+            document.update(update.get('$set', update))
+            self.documents.append(document)
+
+    def remove(self, query):
+        self.removed.append(query)
+        self.documents[:] = [document for document in self.documents
+                             if not self.matches(document, query)]
+
+
+class FakeGridFS(object):
+    """
+    GridFS root collection: `files` and `chunks`.
+    """
+    def __init__(self):
+        self.files = FakeCollection([])
+        self.chunks = FakeCollection([])
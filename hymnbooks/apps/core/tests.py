@@ -1,8 +1,30 @@
 from django.test.simple import DjangoTestSuiteRunner
 from django.conf import settings
+from django.test import SimpleTestCase
+from django.core.management.base import OutputWrapper
+from django.core.exceptions import ImproperlyConfigured
 
 from mongoengine.connection import connect, disconnect, get_connection
 from mongoengine import connect
+from mongoengine.django import sessions as mongo_sessions
+
+from hymnbooks.apps.core import cache, melody, models, musicxml, \
+     sessions, similarity, storage, utils
+from hymnbooks.apps.core.testing import FakeCollection, patch, \
+     patch_collection
+from hymnbooks.apps.core.management.commands import mongo_indexes
+
+from PIL import Image
+from bson import ObjectId
+from cStringIO import StringIO
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+
 
 class MongoTestRunner(DjangoTestSuiteRunner):
     """
@@ -31,3 +53,695 @@ class MongoTestRunner(DjangoTestSuiteRunner):
         connection.drop_database(self.db_name)
         print 'Dropping mongo test database: ' + self.db_name
         disconnect()
+
+
+class MongoUserPermissionsTest(SimpleTestCase):
+    """
+    Effective permissions are compiled in memory, no db access required.
+    """
+    def setUp(self):
+        self.group = models.MongoGroup(name='Escuderos', permissions=[
+            models.GlobalPermission(permission='read_list',
+                                    document_type='Manuscript')])
+        self.user = models.MongoUser(username='kabalyero', permissions=[
+            models.GlobalPermission(permission='update_detail',
+                                    document_type='Section')])
+        self.user.group = [self.group]
+
+    def test_has_permission(self):
+        self.assertTrue(self.user.has_permission('update_detail', 'Section'))
+        self.assertTrue(self.user.has_permission('read_list', 'Manuscript'))
+        self.assertFalse(self.user.has_permission('read_list', 'Section'))
+
+    def test_inactive_user(self):
+        self.user.is_active = False
+        self.assertFalse(self.user.has_permission('update_detail', 'Section'))
+
+    def test_compile_permissions(self):
+        self.user.compile_permissions()
+        self.assertEqual(len(self.user.effective_permissions), 2)
+        self.assertIsNotNone(self.user.permissions_compiled)
+
+
+    def test_recompile_members(self):
+        def permission(name, document_type):
+            return {'permission': name, 'document_type': document_type}
+
+        group_id, other_id = ObjectId(), ObjectId()
+        groups = FakeCollection([
+            {'_id': group_id, 'permissions': [
+                permission('read_list', 'Manuscript')]},
+            {'_id': other_id, 'permissions': [
+                permission('read_list', 'Section')]}])
+        members = [
+            {'_id': ObjectId(), 'username': u'%d' % i, 'group': group_ids,
+             'permissions': []}
+            for i, group_ids in enumerate([[group_id], [group_id],
+                                           [group_id, other_id],
+                                           [group_id, ObjectId()]])]
+        outsider = {'_id': ObjectId(), 'username': u'x', 'group': [other_id]}
+        users = FakeCollection(members + [outsider])
+        patch_collection(self, models.MongoGroup, groups)
+        patch_collection(self, models.MongoUser, users)
+        models.MongoGroup(id=group_id).recompile_members()
+
+        # One update per distinct set of permissions.
+        self.assertEqual(len(users.updates), 2)
+        self.assertEqual(
+            [len(member['effective_permissions']) for member in members],
+            [1, 1, 2, 1]) # The deleted group is skipped.
+        self.assertNotIn('effective_permissions', outsider)
+
+
+class LRUCacheTest(SimpleTestCase):
+    def test_eviction(self):
+        lru = cache.LRUCache(maxsize=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a') # `b` becomes the least recently used
+        lru.set('c', 3)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(len(lru), 2)
+
+    def test_sizeof(self):
+        lru = cache.LRUCache(maxsize=10, sizeof=len)
+        lru.set('a', 'x' * 4)
+        lru.set('b', 'x' * 4)
+        lru.set('c', 'x' * 4) # `a` is evicted
+        self.assertEqual((lru.get('a'), len(lru), lru.size), (None, 2, 8))
+        lru.set('d', 'x' * 11) # Larger than the cache.
+        self.assertEqual((lru.get('d'), len(lru), lru.size), (None, 2, 8))
+
+    def test_ttl(self):
+        lru = cache.LRUCache(ttl=-1)
+        lru.set('a', 1)
+        self.assertIsNone(lru.get('a'))
+
+    def test_set_api_key_invalidates_credentials(self):
+        user = models.MongoUser(username='kabalyero')
+        cache.credentials.set(user.username, ('id', 'digest', True))
+        user.set_api_key()
+        self.assertIsNone(cache.credentials.get(user.username))
+
+    def test_shared_credentials(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        patch(self, settings, 'CACHES', dict(settings.CACHES, auth={
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': root}))
+        patch(self, settings, 'AUTH_CACHE', 'auth')
+
+        # Another worker has its own SharedCache over the same cache.
+        other_worker = cache.SharedCache('credentials', 300)
+        user = models.MongoUser(username='kabalyero')
+        other_worker.set(user.username, ('id', 'digest', True))
+        self.assertEqual(cache.credentials.get(user.username),
+                         ('id', 'digest', True))
+        user.set_api_key()
+        self.assertIsNone(other_worker.get(user.username))
+
+        settings.AUTH_CACHE = 'default' # Local memory.
+        self.assertRaises(ImproperlyConfigured, cache.credentials.get,
+                          user.username)
+
+    def test_digest(self):
+        self.assertEqual(cache.digest(u'kl\xfcc'), cache.digest('kl\xc3\xbcc'))
+        # Undecodable header value: hashed, not an error.
+        self.assertEqual(len(cache.digest('\xff\xfe')), 40)
+
+    def test_get_user_returns_copies(self):
+        user = models.MongoUser(id=ObjectId(), username='kabalyero',
+                                email='kabalyero@example.com')
+        cache.set_user(user)
+        first, second = cache.get_user(user.id), cache.get_user(str(user.id))
+        self.assertIsNot(first, second)
+        self.assertEqual((first.id, first.username), (user.id, user.username))
+
+        first.is_active = False
+        self.assertTrue(second.is_active)
+        self.assertTrue(cache.get_user(user.id).is_active)
+        cache.users.pop(str(user.id))
+
+
+class SessionStoreTest(SimpleTestCase):
+    """
+    MongoSession is replaced by a counter: the cache is tested alone.
+    """
+    def setUp(self):
+        self.calls = []
+        patch(self, mongo_sessions.SessionStore, 'load',
+              lambda store: self.calls.append('load') or {'a': 1})
+        patch(self, mongo_sessions.SessionStore, 'delete',
+              lambda store, session_key=None: self.calls.append('delete'))
+        self.addCleanup(cache.sessions.clear)
+
+    def test_load_is_cached(self):
+        self.assertEqual(sessions.SessionStore('key').load(), {'a': 1})
+        data = sessions.SessionStore('key').load()
+        self.assertEqual((data, self.calls), ({'a': 1}, ['load']))
+
+        # Callers get copies of the cached data.
+        data['b'] = 2
+        self.assertEqual(sessions.SessionStore('key').load(), {'a': 1})
+
+    def test_delete_drops_cached(self):
+        sessions.SessionStore('key').load()
+        sessions.SessionStore('key').delete()
+        sessions.SessionStore('key').load()
+        self.assertEqual(self.calls, ['load', 'delete', 'load'])
+
+    def test_no_key_is_not_cached(self):
+        sessions.SessionStore().load()
+        self.assertEqual(len(cache.sessions), 0)
+
+    def test_cache_disabled(self):
+        patch(self, cache.sessions, 'maxsize', 0)
+        sessions.SessionStore('key').load()
+        sessions.SessionStore('key').load()
+        self.assertEqual(self.calls, ['load', 'load'])
+        self.assertEqual(len(cache.sessions), 0)
+
+
+class ExplainingCommand(mongo_indexes.Command):
+    """
+    Plans come from the queries themselves: `$ne` scans the collection.
+    """
+    def __init__(self):
+        super(ExplainingCommand, self).__init__()
+        self.stdout = OutputWrapper(StringIO())
+        self.explained = []
+
+    def explain(self, document, query, order=None):
+        self.explained.append((query, order))
+        return ['COLLSCAN'] if '$ne' in str(query) else ['FETCH', 'IXSCAN']
+
+
+class MongoIndexesTest(SimpleTestCase):
+    def test_build_queries(self):
+        self.assertEqual(
+            mongo_indexes.build_queries(models.MediaLibrary, 'status',
+                                        ('exact', 'ne')),
+            [('exact', {'status': u''}), ('ne', {'status': {'$ne': u''}})])
+        self.assertEqual(
+            [query for lookup, query in mongo_indexes.build_queries(
+                models.MediaLibrary, 'is_file', 1)],
+            [{'is_file': True}, {'is_file': {'$in': [True]}}])
+        self.assertIsNone(mongo_indexes.build_queries(models.MediaLibrary,
+                                                      'unknown', 1))
+
+    def test_explain_every_lookup(self):
+        class Meta:
+            object_class = models.MediaLibrary
+            filtering = {'status': ('exact', 'ne'), 'is_file': 1,
+                         'unknown': 1}
+            ordering = ('name', 'unknown')
+
+        class Resource:
+            _meta = Meta
+
+        command = ExplainingCommand()
+        scans = command.explain_resources({'media': Resource()})
+
+        # 2 filters x 2 lookups x 2 orders (name, none).
+        self.assertEqual(len(command.explained), 8)
+        self.assertEqual(scans, ['media: filter=status__ne order=name -> '
+                                 'COLLSCAN',
+                                 'media: filter=status__ne order=None -> '
+                                 'COLLSCAN'])
+        output = command.stdout._out.getvalue()
+        self.assertIn('media: unknown filter field unknown, skipped', output)
+        self.assertIn('media: filter=is_file__in order=None -> '
+                      'FETCH <- IXSCAN', output)
+
+    def test_build_indexes(self):
+        class IndexedCollection(object):
+            def __init__(self):
+                self.indexes = []
+
+            def ensure_index(self, fields, **opts):
+                self.indexes.append((fields, opts))
+
+        collection = IndexedCollection()
+        patch_collection(self, models.MongoUser, collection)
+        mongo_indexes.build_indexes(models.MongoUser)
+
+        self.assertEqual(len(collection.indexes),
+                         len(models.MongoUser._meta['index_specs']))
+        self.assertTrue(all(opts['background']
+                            for fields, opts in collection.indexes))
+
+    def test_documents_declare_indexes(self):
+        documents = mongo_indexes.get_documents()
+        self.assertIn(models.PieceMelody, documents)
+        self.assertIn([('_cls', 1), ('username', 1), ('api_key', 1)],
+                      [spec['fields'] for spec in
+                       models.MongoUser._meta['index_specs']])
+
+
+class FileMd5Test(SimpleTestCase):
+    def test_file_md5(self):
+        fileobj = StringIO('x' * 1000)
+        fileobj.seek(10)
+        self.assertEqual(utils.file_md5(fileobj, chunk_size=64),
+                         (hashlib.md5('x' * 1000).hexdigest(), 1000))
+        self.assertEqual(fileobj.tell(), 0)
+
+
+class MediaLibraryTotalsTest(SimpleTestCase):
+    def test_totals(self):
+        self.assertEqual(models.MediaLibrary(name=u'a', size=10).get_totals(),
+                         (10, 1, 0))
+        self.assertEqual(models.MediaLibrary(name=u'b', is_file=False)\
+                         .get_totals(), (0, 0, 1))
+
+
+class MediaLibraryMetadataTest(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage = storage.FileSystemStorage(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def get_document(self, content, content_type):
+        document = models.MediaLibrary(
+            name=u'a', storage='filesystem', content_type=content_type,
+            file_id=self.storage.put(StringIO(content)))
+        document.get_storage = lambda: self.storage
+        return document
+
+    def test_image(self):
+        content = StringIO()
+        Image.new('RGB', (30, 20)).save(content, 'PNG')
+        document = self.get_document(content.getvalue(), 'image/png')
+        document.fill_file_metadata()
+        self.assertEqual((document.size, document.content_type, document.md5),
+                         (len(content.getvalue()), 'image/png',
+                          hashlib.md5(content.getvalue()).hexdigest()))
+        self.assertEqual((document.width, document.height), (30, 20))
+
+    def test_other_file(self):
+        document = self.get_document('x' * 100, 'text/plain')
+        document.fill_file_metadata()
+        self.assertEqual((document.size, document.content_type),
+                         (100, 'text/plain'))
+        self.assertEqual((document.width, document.height), (None, None))
+
+    def test_folder(self):
+        document = self.get_document('x' * 100, 'text/plain')
+        document.is_file = False
+        document.fill_file_metadata()
+        self.assertEqual((document.size, document.content_type, document.md5,
+                          document.width), (None, None, None, None))
+
+
+class MediaLibraryAncestorsTest(SimpleTestCase):
+    def setUp(self):
+        names = 'root other sub a b c f'.split()
+        self.ids = ids = dict((name, ObjectId()) for name in names)
+        tree = [('root', None, []), ('other', None, []),
+                ('sub', 'other', ['other']),
+                ('a', 'root', ['root']), ('b', 'a', ['root', 'a']),
+                ('c', 'b', ['root', 'a', 'b']),
+                ('f', 'c', ['root', 'a', 'b', 'c'])]
+        self.documents = dict(
+            (name, {'_id': ids[name], 'is_file': name == 'f',
+                    'container': ids[container] if container else None,
+                    'ancestors': [ids[ancestor] for ancestor in ancestors]})
+            for name, container, ancestors in tree)
+
+        patch_collection(self, models.MediaLibrary,
+                         FakeCollection(self.documents.values()))
+
+    def ancestors(self, name):
+        names = dict((value, key) for key, value in self.ids.iteritems())
+        return [names[ancestor]
+                for ancestor in self.documents[name]['ancestors']]
+
+    def test_move_keeps_order(self):
+        # `a` moves from `root` to `other/sub`.
+        folder = models.MediaLibrary(id=self.ids['a'], name=u'a',
+                                     is_file=False,
+                                     ancestors=[self.ids['other'],
+                                                self.ids['sub']])
+        folder.update_descendants([self.ids['root']])
+
+        self.assertEqual(self.ancestors('b'), ['other', 'sub', 'a'])
+        self.assertEqual(self.ancestors('c'), ['other', 'sub', 'a', 'b'])
+        self.assertEqual(self.ancestors('f'), ['other', 'sub', 'a', 'b', 'c'])
+
+    def test_move_to_root(self):
+        folder = models.MediaLibrary(id=self.ids['b'], name=u'b',
+                                     is_file=False, ancestors=[])
+        folder.update_descendants([self.ids['root'], self.ids['a']])
+
+        self.assertEqual(self.ancestors('c'), ['b'])
+        self.assertEqual(self.ancestors('f'), ['b', 'c'])
+
+    def test_higher_in_hierarchy(self):
+        folder = models.MediaLibrary(id=self.ids['a'])
+        below = models.MediaLibrary(id=self.ids['c'],
+                                    ancestors=[self.ids['root'], self.ids['a']])
+        self.assertTrue(models.MediaLibrary.higher_in_hierarchy(folder, folder))
+        self.assertTrue(models.MediaLibrary.higher_in_hierarchy(folder, below))
+        self.assertFalse(models.MediaLibrary.higher_in_hierarchy(below, folder))
+
+
+class FileSystemStorageTest(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage = storage.FileSystemStorage(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_put_open(self):
+        content = 'x' * 1000 + 'y' * 1000
+        file_id = self.storage.put(StringIO(content))
+        stored = self.storage.open(file_id, 'text/plain')
+        self.assertEqual(stored.length, 2000)
+        self.assertEqual(stored.md5, hashlib.md5(content).hexdigest())
+        self.assertEqual(stored.content_type, 'text/plain')
+        self.assertEqual(utils.file_md5(stored), (stored.md5, 2000))
+
+        stored.seek(995)
+        self.assertEqual(stored.read(10), 'xxxxxyyyyy')
+        self.assertEqual(''.join(stored.iter_range(990, 1009)),
+                         'x' * 10 + 'y' * 10)
+        stored.close()
+
+    def test_empty_and_missing(self):
+        file_id = self.storage.put(StringIO(''))
+        self.assertEqual(self.storage.open(file_id).read(), '')
+
+        self.storage.delete([file_id])
+        self.assertEqual(self.storage.open(file_id), None)
+
+
+class CoalesceTest(SimpleTestCase):
+    def test_single_flight(self):
+        flights = cache.SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'value'
+
+        def request():
+            results.append(flights.do('key', compute))
+
+        threads = [threading.Thread(target=request) for i in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['value'] * 5)
+
+    def test_single_flight_error(self):
+        def fail():
+            raise ValueError('failed')
+
+        self.assertRaises(ValueError, cache.SingleFlight().do, 'key', fail)
+
+    def test_coalesce(self):
+        store = {}
+
+        def create():
+            store['key'] = 'created'
+            return store['key']
+
+        self.assertEqual(cache.coalesce('key', lambda: store.get('key'),
+                                        create), 'created')
+        self.assertEqual(cache.coalesce('key', lambda: store.get('key'),
+                                        lambda: 'again'), 'created')
+
+    def test_shared_lock(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        patch(self, settings, 'CACHES', dict(settings.CACHES, coalesce={
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': root}))
+        patch(self, settings, 'COALESCE_CACHE', 'coalesce')
+
+        with cache.shared_lock('key') as acquired:
+            self.assertTrue(acquired)
+            with cache.shared_lock('key', wait=0) as acquired_again:
+                self.assertFalse(acquired_again)
+        with cache.shared_lock('key', wait=0) as acquired:
+            self.assertTrue(acquired)
+
+    def test_shared_lock_cache(self):
+        patch(self, settings, 'COALESCE_CACHE', None)
+
+        # Only threads of a worker are coalesced.
+        with cache.shared_lock('key', wait=0) as acquired:
+            with cache.shared_lock('key', wait=0) as acquired_again:
+                self.assertTrue(acquired and acquired_again)
+
+        settings.COALESCE_CACHE = 'default' # Local memory.
+        self.assertRaises(ImproperlyConfigured, cache.get_lock_cache)
+
+
+class ReloadableTest(SimpleTestCase):
+    def test_stale_while_reload(self):
+        loads, release = [], threading.Event()
+
+        def load():
+            loads.append(1)
+            if len(loads) > 1:
+                release.wait()
+            return len(loads)
+
+        value = cache.Reloadable(load, ttl=0)
+        self.assertEqual(value.get(), 1)
+
+        # Stale value while one reload runs.
+        self.assertEqual(value.get(), 1)
+        reloading = value.reloading
+        self.assertEqual(value.get(), 1)
+        self.assertTrue(value.reloading is reloading)
+
+        release.set()
+        reloading.join()
+        self.assertEqual(len(loads), 2)
+        value.ttl = 60
+        self.assertEqual(value.get(), 2)
+
+
+class PieceScoresTest(SimpleTestCase):
+    def test_unchanged_scores_are_not_parsed(self):
+        class MediaItem(object):
+            md5 = 'abc'
+            name = u'score.xml'
+
+            def open_file(self):
+                raise AssertionError('The file should not be read')
+
+        scores = {'version': musicxml.VERSION, 'parts': []}
+        piece = models.Piece(name=u'Piece', scores=scores, scores_md5='abc')
+        self.assertEqual(piece.convert_mxml_to_dict(MediaItem()), None)
+        self.assertEqual(piece.scores, scores)
+
+
+SCORE = os.path.join(os.path.dirname(__file__), '..', '..', 'tmp',
+                     'kanc_71_1.xml')
+
+
+class MusicXMLTest(SimpleTestCase):
+    def test_extract(self):
+        scores = musicxml.extract(open(SCORE, 'rb'))
+        part = scores['parts'][0]
+        self.assertEqual((part['id'], part['keys'], part['times']),
+                         ('P1', [['1', -1, 'major']], [['1', '2', 2]]))
+
+        notes = [dict(zip(scores['fields'], note)) for note in part['notes']]
+        self.assertEqual([n['pitch'] for n in notes[:4]],
+                         ['F4', 'A4', 'C5', 'B-4'])
+        self.assertEqual([n['midi'] for n in notes[:4]], [65, 69, 72, 70])
+        self.assertEqual(notes[0]['duration'], 4)
+        self.assertEqual((notes[0]['lyric'], notes[0]['syllabic']),
+                         ('O', 'begin'))
+        self.assertTrue(notes[6]['tied'])
+
+    def test_rest_and_chord(self):
+        scores = musicxml.extract(StringIO(
+            '<score-partwise><part id="P1"><measure number="1">'
+            '<attributes><divisions>4</divisions></attributes>'
+            '<note><rest/><duration>2</duration></note>'
+            '<note><pitch><step>C</step><alter>1</alter><octave>4</octave>'
+            '</pitch><duration>4</duration></note>'
+            '<note><chord/><pitch><step>E</step><octave>4</octave></pitch>'
+            '<duration>4</duration></note>'
+            '</measure></part></score-partwise>'))
+        notes = scores['parts'][0]['notes']
+        self.assertEqual(notes[0][2:6], [None, None, 0.5, False])
+        self.assertEqual(notes[1][2:6], ['C#4', 61, 1, False])
+        self.assertEqual(notes[2][2:6], ['E4', 64, 1, True])
+
+
+class ScoresExtractionTest(SimpleTestCase):
+    def test_prepare_extraction(self):
+        media_item = models.MediaLibrary(id=ObjectId(), name=u'score.xml',
+                                         content_type='text/xml', md5='abc')
+        piece = models.Piece(name=u'Piece', media=[media_item])
+        self.assertTrue(piece.prepare_extraction())
+        self.assertEqual(piece.extraction_status, 'pending')
+
+        piece.extraction_status, piece.scores_md5 = 'failed', 'abc'
+        self.assertFalse(piece.prepare_extraction())
+
+        self.assertFalse(models.Piece(name=u'No XML').prepare_extraction())
+
+    def test_progress(self):
+        manuscript = models.Manuscript(title=u'Manuscript', pieces=[
+            models.Piece(name=u'%d' % i, extraction_status=status)
+            for i, status in enumerate(['done', 'pending', 'done', None])])
+        self.assertEqual(manuscript.get_extraction_progress(),
+                         {'pending': 1, 'done': 2, 'failed': 0})
+
+    def test_melodies_changed(self):
+        son = models.Manuscript(id=ObjectId(), title=u'Manuscript', pieces=[
+            models.Piece(name=u'%d' % i) for i in range(2)]).to_mongo()
+
+        def saved():
+            return models.Manuscript._from_son(son)
+
+        manuscript = saved()
+        self.assertFalse(manuscript.melodies_changed())
+        manuscript.description = u'Description'
+        manuscript.pieces[0].incipit = [u'Incipit']
+        self.assertFalse(manuscript.melodies_changed())
+
+        manuscript = saved()
+        manuscript.pieces[1].scores = {'parts': []}
+        self.assertTrue(manuscript.melodies_changed())
+
+        manuscript = saved()
+        manuscript.pieces[0].extraction_status = 'failed'
+        self.assertTrue(manuscript.melodies_changed())
+
+        manuscript = saved()
+        manuscript.pieces = manuscript.pieces[::-1]
+        self.assertTrue(manuscript.melodies_changed())
+
+        manuscript = saved()
+        manuscript.title = u'Other'
+        self.assertTrue(manuscript.melodies_changed())
+
+        self.assertTrue(models.Manuscript(title=u'New', pieces=[
+            models.Piece(name=u'0')]).melodies_changed())
+        self.assertFalse(models.Manuscript(title=u'New').melodies_changed())
+
+
+    def test_update_melodies(self):
+        def scores(*pitches):
+            return {'parts': [{'notes': [
+                ['1', '1', None, midi, 1, False, False, None, None]
+                for midi in pitches]}]}
+
+        manuscript = models.Manuscript(id=ObjectId(), title=u'Manuscript',
+                                       pieces=[
+            models.Piece(name=u'0', scores=scores(60, 62, 64)),
+            models.Piece(name=u'1', scores=scores(60)),
+            models.Piece(name=u'2', scores=scores(67, 65))])
+        other = {'_id': ObjectId(), 'manuscript': ObjectId(), 'piece_index': 1}
+        stale = {'_id': ObjectId(), 'manuscript': manuscript.id,
+                 'piece_index': 1}
+        kept = {'_id': ObjectId(), 'manuscript': manuscript.id,
+                'piece_index': 0}
+        collection = FakeCollection([other, stale, kept])
+        patch_collection(self, models.PieceMelody, collection)
+        self.assertEqual(models.PieceMelody.update_manuscript(manuscript), 2)
+
+        melodies = dict((melody['piece_index'], melody)
+                        for melody in collection.documents
+                        if melody['manuscript'] == manuscript.id)
+        self.assertEqual(sorted(melodies), [0, 2])
+        # Updated in place.
+        self.assertEqual(melodies[0]['_id'], kept['_id'])
+        self.assertEqual(melodies[0]['pitches'], [60, 62, 64])
+        self.assertEqual(melodies[2]['piece_name'], u'2')
+        self.assertIn(other, collection.documents)
+
+class MelodySearchTest(SimpleTestCase):
+    def test_get_melody(self):
+        pitches, measures, durations = musicxml.get_melody(
+            musicxml.extract(open(SCORE, 'rb')))
+        self.assertEqual(pitches[:4], [65, 69, 72, 70])
+        self.assertEqual((measures[0], durations[0]), ('1', 4))
+
+    def test_parse_melody(self):
+        self.assertEqual(melody.parse_melody('F4 A4, C5 B-4'),
+                         [65, 69, 72, 70])
+        self.assertEqual(melody.parse_melody('65 Bb4 c f#'),
+                         [65, 70, 72, 66])
+        self.assertRaises(ValueError, melody.parse_melody, 'H4')
+
+    def test_search(self):
+        melodies = [
+            {'_id': ObjectId(), 'manuscript': ObjectId(), 'piece_index': i,
+             'title': title, 'pitches': pitches}
+            for i, (title, pitches) in enumerate([
+                (u'Exact', [60, 62, 64, 65, 67, 65, 64]),
+                (u'Transposed', [50, 55, 57, 59, 60, 62, 60]),
+                (u'Contour', [60, 63, 67, 68, 72, 65, 64]),
+                (u'Other', [60, 60, 60, 60, 60, 60, 60])])]
+        index = melody.MelodyIndex(melodies, n=3, contour_n=4)
+
+        hits = index.search([60, 62, 64, 65, 67])
+        self.assertEqual([(h.title, h.note, h.transposition, h.score)
+                          for h in hits],
+                         [(u'Exact', 0, 0, 1.0), (u'Transposed', 1, -5, 1.0),
+                          (u'Contour', 0, 0, 0.5)])
+        self.assertEqual(hits[2].match, 'contour')
+        self.assertRaises(ValueError, index.search, [60, 62, 64])
+
+    def test_search_before_piece(self):
+        # The query starts two notes before the piece (a fifth lower).
+        index = melody.MelodyIndex([
+            {'_id': ObjectId(), 'manuscript': ObjectId(), 'piece_index': 0,
+             'title': u'Late', 'pitches': [67, 69, 71, 72, 74, 72]}],
+            n=3, contour_n=4)
+        hit, = index.search([55, 57, 60, 62, 64, 65, 67])
+        self.assertEqual((hit.offset, hit.note, hit.transposition),
+                         (-2, 0, 7))
+
+
+class SimilarityTest(SimpleTestCase):
+    def test_features(self):
+        features = similarity.get_features([60, 62, 64, 60], [1, 1, 2, 1])
+        self.assertEqual(features.shape, (similarity.FEATURE_SIZE,))
+        self.assertAlmostEqual(float(features.dot(features)), 1, places=5)
+
+        # Transposition and note values do not matter.
+        transposed = similarity.get_features([67, 69, 71, 67], [2, 2, 4, 2])
+        self.assertTrue((abs(features - transposed) < 1e-6).all())
+
+    def test_top_k(self):
+        melodies = [
+            {'_id': ObjectId(), 'manuscript': ObjectId(), 'piece_index': i,
+             'features': similarity.to_binary(
+                 similarity.get_features(pitches, [1] * len(pitches)))}
+            for i, pitches in enumerate([
+                [60, 62, 64, 65, 67, 65, 64, 62],
+                [70, 68, 66, 65, 63, 65, 66, 68],
+                [55, 57, 59, 60, 62, 60, 59, 57],
+                [60, 62, 64, 65, 67, 65, 64, 60],
+                [60, 60, 60, 60, 60, 60, 60, 60]])]
+        melodies.append(dict(melodies[0], features=''))
+        matrix = similarity.FeatureMatrix(melodies)
+        self.assertEqual(len(matrix), 5)
+
+        results = matrix.top_k(matrix.matrix[0], 2, exclude=[0])
+        self.assertEqual([position for position, score in results], [2, 3])
+        self.assertAlmostEqual(results[0][1], 1, places=5)
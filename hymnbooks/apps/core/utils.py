@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 from django.utils.translation import ugettext_lazy as _
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, \
+     quote_etag
 from django.template.defaultfilters import slugify
 
+import hashlib
 import re
 import random
 import string
@@ -160,6 +163,39 @@ def sizify(value):
     return '%s %s' % (str(round(value, 2)), ext)
 
 
+def image_size(fileobj):
+    """
+    Returns (width, height) of an image reading its header only, or
+    (None, None) if it is not an image.
+    """
+    from PIL import Image
+
+    try:
+        return Image.open(fileobj).size
+    except Exception:
+        return None, None
+
+
+def file_md5(fileobj, chunk_size=256 * 1024):
+    """
+    Returns hex md5 of the file (read in chunks from the beginning) and
+    its size. The file is rewound afterwards.
+    """
+    digest = hashlib.md5()
+    size = 0
+
+    fileobj.seek(0)
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        digest.update(chunk)
+        size += len(chunk)
+    fileobj.seek(0)
+
+    return digest.hexdigest(), size
+
+
 """
 Custom procedure for unique slug depending on the document type.
 See slugify_unique
@@ -315,3 +351,38 @@ def ensure_list(val, flat=False):
             return list(val)
     except Exception as e: # unsuccessfull!
         return []
+
+
+# CONDITIONAL GET
+
+def is_not_modified(request, etag=None, last_modified=None):
+    """
+    Checks conditional GET headers of the request against `etag` (unquoted)
+    and `last_modified` (seconds since epoch). If-None-Match takes
+    precedence over If-Modified-Since.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', None)
+    if if_none_match is not None:
+        if etag is None:
+            return False
+        etags = parse_etags(if_none_match)
+        return ('*' in etags) or (etag in etags)
+
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE', None)
+    if if_modified_since and (last_modified is not None):
+        if_modified_since = parse_http_date_safe(if_modified_since)
+        return (if_modified_since is not None) and \
+          (int(last_modified) <= if_modified_since)
+
+    return False
+
+
+def set_validators(response, etag=None, last_modified=None, weak=False):
+    """
+    Sets ETag and Last-Modified headers of the response.
+    """
+    if etag is not None:
+        response['ETag'] = ('W/' if weak else '') + quote_etag(etag)
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
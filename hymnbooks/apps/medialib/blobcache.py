@@ -0,0 +1,216 @@
+"""
+Local disk cache of GridFS files keyed by md5, and sending of cached files
+without copying them through Python.
+
+Files are written to the cache on upload (write-through) and while the
+first request streams them from GridFS (the response never waits for the
+copy), the least recently used ones are evicted when the cache exceeds
+MEDIA_BLOB_CACHE_SIZE bytes (see core.cache.DiskLRUCache).
+
+Cached files (and IIIF tiles, which live under the same MEDIA_CACHE_ROOT,
+and files of file system storage) are sent according to MEDIA_SENDFILE:
+
+* 'x-sendfile' - X-Sendfile header with the path (Apache mod_xsendfile,
+  lighttpd)
+* 'x-accel-redirect' - X-Accel-Redirect header with the path under
+  MEDIA_SENDFILE_URL, an internal location of nginx aliased to
+  MEDIA_CACHE_ROOT (MEDIA_STORAGE_SENDFILE_URL for MEDIA_STORAGE_ROOT)
+* None - no front proxy: the file goes to `wsgi.file_wrapper` of the
+  server (sendfile(2) under gunicorn) via FileWrapperMiddleware.
+
+Front proxies answer Range requests themselves.
+"""
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+
+from hymnbooks.apps.core import cache
+
+import os
+import threading
+
+
+CHUNK_SIZE = 256 * 1024
+
+# Key of the WSGI environ with the file to be sent by FileWrapperMiddleware.
+FILE_WRAPPER_KEY = 'hymnbooks.file_wrapper'
+
+blobs = cache.DiskLRUCache(os.path.join(settings.MEDIA_CACHE_ROOT, 'blobs'),
+                           settings.MEDIA_BLOB_CACHE_SIZE)
+
+# Md5 of the files being stored in the cache by requests of this worker.
+_filling = set()
+_filling_lock = threading.Lock()
+
+
+def is_cacheable(size, md5):
+    return (settings.MEDIA_BLOB_CACHE_SIZE > 0) and bool(md5) and \
+      (size <= settings.MEDIA_BLOB_CACHE_MAX_FILE)
+
+
+def get_path(md5):
+    """
+    Returns path to the cached file or None.
+    """
+    if settings.MEDIA_BLOB_CACHE_SIZE <= 0:
+        return None
+    return blobs.get(md5)
+
+
+def store(md5, chunks):
+    """
+    Stores the file (iterable of strings) in the cache, returns its path.
+    """
+    return blobs.set(md5, chunks)
+
+
+def stream_through(md5, chunks):
+    """
+    Yields content of a file missing in the cache (iterable of strings)
+    and stores it in the cache while doing so: the file is there once it
+    has been sent whole. Only one request of a worker fills the cache with
+    a file at a time, the others just pass the content on.
+    """
+    with _filling_lock:
+        filling = md5 in _filling
+        _filling.add(md5)
+    if filling:
+        for chunk in chunks:
+            yield chunk
+        return
+
+    content = blobs.tee(md5, chunks)
+    try:
+        for chunk in content:
+            yield chunk
+    finally:
+        content.close() # Not stored if the response has been abandoned.
+        with _filling_lock:
+            _filling.discard(md5)
+
+
+def write_through(md5, fileobj, size):
+    """
+    Stores a freshly uploaded file in the cache (if it is not too big, see
+    MEDIA_BLOB_CACHE_MAX_FILE), so that the first request does not read it
+    from GridFS.
+    """
+    if not is_cacheable(size, md5):
+        return
+    fileobj.seek(0)
+    store(md5, iter(lambda: fileobj.read(CHUNK_SIZE), ''))
+    fileobj.seek(0)
+
+
+def iter_file(fileobj, start=0, end=None):
+    """
+    Yields content of the file from `start` to `end` (inclusive).
+    """
+    fileobj.seek(start)
+    remaining = None if end is None else end - start + 1
+    while remaining is None or remaining > 0:
+        chunk = fileobj.read(CHUNK_SIZE if remaining is None
+                             else min(CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield chunk
+
+
+def get_accel_url(path):
+    """
+    Returns internal URL of nginx for the file under one of the roots.
+    """
+    for root, url in ((settings.MEDIA_CACHE_ROOT, settings.MEDIA_SENDFILE_URL),
+                      (settings.MEDIA_STORAGE_ROOT,
+                       settings.MEDIA_STORAGE_SENDFILE_URL)):
+        relpath = os.path.relpath(path, root)
+        if not relpath.startswith(os.pardir):
+            return url + relpath.replace(os.sep, '/')
+    raise ValueError('No sendfile URL for %s' % path)
+
+
+def sendfile_response(request, path, content_type):
+    """
+    Returns response sending the whole cached file with the front proxy
+    (MEDIA_SENDFILE) or with the server's `wsgi.file_wrapper`.
+    """
+    if settings.MEDIA_SENDFILE == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = path
+        return response
+
+    if settings.MEDIA_SENDFILE == 'x-accel-redirect':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = get_accel_url(path)
+        return response
+
+    # The file stays readable even if it is evicted in the meantime.
+    fileobj = open(path, 'rb')
+    request.META[FILE_WRAPPER_KEY] = fileobj
+    response = StreamingHttpResponse(iter_file(fileobj),
+                                     content_type=content_type)
+    response['Content-Length'] = str(os.fstat(fileobj.fileno()).st_size)
+    return response
+
+
+class FileWrapperMiddleware(object):
+    """
+    WSGI middleware: if the view has chosen a file to be sent (see
+    sendfile_response), the server's `wsgi.file_wrapper` sends it instead
+    of the response body, so that Python does not copy it. Without a file
+    wrapper the response body (reading the file) is used.
+    """
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, environ, start_response):
+        status = []
+
+        def start(response_status, headers, exc_info=None):
+            status.append(response_status)
+            return start_response(response_status, headers, exc_info)
+
+        try:
+            result = self.application(environ, start)
+        except:
+            fileobj = environ.pop(FILE_WRAPPER_KEY, None)
+            if fileobj is not None:
+                fileobj.close()
+            raise
+
+        fileobj = environ.pop(FILE_WRAPPER_KEY, None)
+        if fileobj is None:
+            return result
+
+        if not status[0].startswith('200'):
+            fileobj.close()
+            return result
+
+        if 'wsgi.file_wrapper' not in environ:
+            # The body reads the file: it is closed with the body.
+            return ClosingIterable(result, fileobj)
+
+        if hasattr(result, 'close'):
+            result.close()
+        return environ['wsgi.file_wrapper'](fileobj, CHUNK_SIZE)
+
+
+class ClosingIterable(object):
+    """
+    Iterable (a WSGI response body, streamed content) that closes the file
+    after it, when the server is done with it.
+    """
+    def __init__(self, result, fileobj):
+        self.result = result
+        self.fileobj = fileobj
+
+    def __iter__(self):
+        return iter(self.result)
+
+    def close(self):
+        try:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+        finally:
+            self.fileobj.close()
@@ -0,0 +1,101 @@
+"""
+Resized copies (derivatives) of images from Media library.
+
+Variants are defined in MEDIA_DERIVATIVES setting. They are generated in
+the background after upload (see tasks.process_upload), or on demand if a
+variant is requested before it is ready: concurrent requests for it wait
+for one rendering.
+"""
+from django.conf import settings
+from django.http import Http404
+
+from hymnbooks.apps.core import cache
+from hymnbooks.apps.core.models import MediaDerivative
+from hymnbooks.apps.medialib import streaming
+
+from cStringIO import StringIO
+
+import mongoengine
+
+
+def is_image(media_item):
+    return (media_item.content_type or '').startswith('image/')
+
+
+def render(fileobj, variant):
+    """
+    Returns progressive JPEG (file-like object) of the image scaled down to
+    fit the box of the variant and its size.
+    """
+    from PIL import Image, ImageFile
+
+    width, height, quality = settings.MEDIA_DERIVATIVES[variant]
+
+    image = Image.open(fileobj)
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    image.thumbnail((width, height), Image.ANTIALIAS)
+
+    # Progressive and optimized JPEG is written in one block.
+    ImageFile.MAXBLOCK = max(ImageFile.MAXBLOCK,
+                             image.size[0] * image.size[1] * 3)
+    output = StringIO()
+    image.save(output, 'JPEG', quality=quality, optimize=True,
+               progressive=True)
+    output.seek(0)
+
+    return output, image.size
+
+
+def create_derivative(media_item, variant):
+    """
+    Renders variant of the media item and stores it.
+    """
+    stored = media_item.open_file()
+    try:
+        output, (width, height) = render(stored, variant)
+    finally:
+        stored.close()
+
+    derivative = MediaDerivative(source_md5=media_item.md5, variant=variant,
+                                 width=width, height=height)
+    derivative.image.put(output, content_type='image/jpeg',
+                         filename='%s-%s.jpg' % (media_item.md5, variant))
+    try:
+        derivative.save()
+    except mongoengine.errors.NotUniqueError:
+        # Created concurrently by another worker, use that one.
+        derivative.image.delete()
+        derivative = MediaDerivative.objects.get(source_md5=media_item.md5,
+                                                 variant=variant)
+    return derivative
+
+
+def get_derivative(media_item, variant, create=True):
+    """
+    Returns derivative of the media item, creates it if it doesn't exist
+    (unless `create` is False).
+    """
+    def get():
+        return MediaDerivative.objects(source_md5=media_item.md5,
+                                       variant=variant).first()
+
+    if not create:
+        return get()
+
+    return cache.coalesce('derivative:%s:%s' % (media_item.md5, variant), get,
+                          lambda: create_derivative(media_item, variant))
+
+
+def serve_derivative(request, media_item, variant):
+    """
+    Returns response with the variant of the media item (generated on
+    demand if not ready yet).
+    """
+    if (variant not in settings.MEDIA_DERIVATIVES) or \
+      (not is_image(media_item)):
+        raise Http404
+
+    derivative = get_derivative(media_item, variant)
+
+    return streaming.serve_file(request, derivative.open_file())
@@ -0,0 +1,269 @@
+"""
+Image tiles of Media library images following IIIF Image API 2.0
+(http://iiif.io/api/image/2.0/), level 1 plus rotation and qualities:
+
+    /cms/lib/<id>/iiif/<region>/<size>/<rotation>/<quality>.<format>
+    /cms/lib/<id>/iiif/info.json
+
+The tile pyramid is built lazily: every level (the source scaled down by
+a power of 2) is decoded once and kept in memory of the worker, up to
+IIIF_LEVEL_CACHE_BYTES of decoded images; rendered tiles are stored in the
+disk cache (see IIIF_TILE_CACHE_* settings).
+Concurrent requests for the same level or tile share one rendering.
+"""
+from django.conf import settings
+
+from hymnbooks.apps.core import cache
+
+from cStringIO import StringIO
+
+import math
+import re
+
+
+FORMATS = {'jpg': ('JPEG', 'image/jpeg'),
+           'png': ('PNG', 'image/png'),
+           'gif': ('GIF', 'image/gif')}
+
+QUALITIES = ('default', 'color', 'gray', 'bitonal')
+
+NUMBER = r'(\d+(?:\.\d+)?)'
+REGION_RE = re.compile(r'^(pct:)?%s,%s,%s,%s$' % ((NUMBER,) * 4))
+SIZE_RE = re.compile(r'^(!)?(\d+)?,(\d+)?$')
+ROTATION_RE = re.compile(r'^(!)?%s$' % NUMBER)
+
+# Bytes per pixel and band of PIL image modes (1 for the others).
+BAND_BYTES = {'I': 4, 'F': 4, 'I;16': 2}
+
+
+def image_bytes(image):
+    """
+    Returns size of the decoded image in memory.
+    """
+    return image.size[0] * image.size[1] * len(image.getbands()) * \
+      BAND_BYTES.get(image.mode, 1)
+
+
+# Decoded pyramid levels: (md5, scale factor) -> PIL image, bounded by
+# their decoded size.
+levels = cache.LRUCache(
+    maxsize=getattr(settings, 'IIIF_LEVEL_CACHE_BYTES', 256 * 1024 * 1024),
+    sizeof=image_bytes)
+
+# Rendered tiles.
+tiles = cache.DiskLRUCache(settings.IIIF_TILE_CACHE_ROOT,
+                           settings.IIIF_TILE_CACHE_SIZE)
+
+
+def parse_region(region, width, height):
+    """
+    Returns region of the image as (x, y, w, h) in pixels.
+    """
+    if region == 'full':
+        return 0, 0, width, height
+
+    if region == 'square':
+        side = min(width, height)
+        return (width - side) // 2, (height - side) // 2, side, side
+
+    match = REGION_RE.match(region)
+    if match is None:
+        raise ValueError('Wrong region: %s' % region)
+
+    x, y, w, h = [float(v) for v in match.groups()[1:]]
+    if match.group(1):
+        x, w = x * width / 100.0, w * width / 100.0
+        y, h = y * height / 100.0, h * height / 100.0
+    x, y, w, h = int(x), int(y), int(round(w)), int(round(h))
+
+    # Cut off the part outside of the image.
+    w, h = min(w, width - x), min(h, height - y)
+    if x >= width or y >= height or w <= 0 or h <= 0:
+        raise ValueError('Region outside of the image: %s' % region)
+
+    return x, y, w, h
+
+
+def parse_size(size, width, height):
+    """
+    Returns size (w, h) of the region (`width` x `height`) in the output.
+    Upscaling is not supported.
+    """
+    if size in ('full', 'max'):
+        return width, height
+
+    if size.startswith('pct:'):
+        try:
+            pct = float(size[4:])
+        except ValueError:
+            raise ValueError('Wrong size: %s' % size)
+        w, h = width * pct / 100.0, height * pct / 100.0
+    else:
+        match = SIZE_RE.match(size)
+        if match is None or match.group(2, 3) == (None, None):
+            raise ValueError('Wrong size: %s' % size)
+
+        best_fit, w, h = match.group(1), match.group(2), match.group(3)
+        if best_fit:
+            if w is None or h is None:
+                raise ValueError('Wrong size: %s' % size)
+            scale = min(float(w) / width, float(h) / height)
+            w, h = width * scale, height * scale
+        elif w is None:
+            w, h = width * float(h) / height, float(h)
+        elif h is None:
+            w, h = float(w), height * float(w) / width
+        else:
+            w, h = float(w), float(h)
+
+    w, h = max(int(round(w)), 1), max(int(round(h)), 1)
+    if w > width or h > height:
+        raise ValueError('Upscaling is not supported: %s' % size)
+
+    return w, h
+
+
+def parse_rotation(rotation):
+    """
+    Returns (mirror, degrees clockwise).
+    """
+    match = ROTATION_RE.match(rotation)
+    if match is None or float(match.group(2)) > 360:
+        raise ValueError('Wrong rotation: %s' % rotation)
+
+    return bool(match.group(1)), float(match.group(2)) % 360
+
+
+def scale_factors(width, height):
+    """
+    Returns scale factors of the pyramid: down to the level that fits a tile.
+    """
+    tile_size = settings.IIIF_TILE_SIZE
+    factors = [1]
+    while max(width, height) > factors[-1] * tile_size:
+        factors.append(factors[-1] * 2)
+    return factors
+
+
+def get_level(media_item, factor):
+    """
+    Returns the source image scaled down `factor` times.
+    """
+    key = (media_item.md5, factor)
+    image = levels.get(key)
+    if image is not None:
+        return image
+
+    return cache.flights.do(('iiif', ) + key, decode_level, media_item,
+                            factor)
+
+
+def decode_level(media_item, factor):
+    """
+    Decodes level of the pyramid and keeps it in memory (unless it is
+    larger than the whole cache).
+    """
+    from PIL import Image
+
+    # The image is decoded (read) before its file is closed.
+    stored = media_item.open_file()
+    try:
+        image = Image.open(stored)
+        if factor > 1:
+            size = (int(math.ceil(float(image.size[0]) / factor)),
+                    int(math.ceil(float(image.size[1]) / factor)))
+            # JPEG can be decoded right at a lower resolution.
+            image.draft(image.mode, size)
+            image = image.resize(size, Image.ANTIALIAS)
+        else:
+            image.load()
+    finally:
+        stored.close()
+
+    levels.set((media_item.md5, factor), image)
+    return image
+
+
+def render(media_item, region, size, rotation, quality, format):
+    """
+    Returns image request result as a string.
+    """
+    from PIL import Image, ImageOps
+
+    if quality not in QUALITIES:
+        raise ValueError('Wrong quality: %s' % quality)
+    if format not in FORMATS:
+        raise ValueError('Wrong format: %s' % format)
+
+    width, height = media_item.width, media_item.height
+    x, y, w, h = parse_region(region, width, height)
+    tw, th = parse_size(size, w, h)
+    mirror, degrees = parse_rotation(rotation)
+
+    # Use the smallest level that is still larger than the output.
+    factor = 1
+    for candidate in scale_factors(width, height):
+        if w / candidate >= tw and h / candidate >= th:
+            factor = candidate
+
+    level = get_level(media_item, factor)
+    image = level.crop((x // factor, y // factor,
+                        min(int(math.ceil(float(x + w) / factor)), level.size[0]),
+                        min(int(math.ceil(float(y + h) / factor)), level.size[1])))
+    if image.size != (tw, th):
+        image = image.resize((tw, th), Image.ANTIALIAS)
+
+    if mirror:
+        image = ImageOps.mirror(image)
+    if degrees:
+        # PIL rotates counter-clockwise.
+        image = image.rotate(-degrees, expand=True)
+
+    if quality == 'gray':
+        image = image.convert('L')
+    elif quality == 'bitonal':
+        image = image.convert('1')
+    elif image.mode not in ('RGB', 'L') and format == 'jpg':
+        image = image.convert('RGB')
+
+    output = StringIO()
+    image.save(output, FORMATS[format][0])
+    return output.getvalue()
+
+
+def info(media_item, base_uri):
+    """
+    Returns image information (contents of info.json).
+    """
+    width, height = media_item.width, media_item.height
+    factors = scale_factors(width, height)
+    return {
+        '@context': 'http://iiif.io/api/image/2/context.json',
+        '@id': base_uri,
+        'protocol': 'http://iiif.io/api/image',
+        'width': width,
+        'height': height,
+        'profile': ['http://iiif.io/api/image/2/level1.json', {
+            'formats': sorted(FORMATS.keys()),
+            'qualities': list(QUALITIES),
+            'supports': ['mirroring', 'rotationArbitrary', 'sizeByPct',
+                         'regionByPct']
+            }],
+        'tiles': [{'width': settings.IIIF_TILE_SIZE,
+                   'scaleFactors': factors}],
+        'sizes': [{'width': int(math.ceil(float(width) / f)),
+                   'height': int(math.ceil(float(height) / f))}
+                  for f in reversed(factors)],
+        }
+
+
+def get_tile(media_item, region, size, rotation, quality, format):
+    """
+    Returns path to the rendered image request in the tile cache.
+    """
+    key = '/'.join((media_item.md5, region, size, rotation,
+                    '%s.%s' % (quality, format)))
+    return cache.coalesce(
+        'tile:%s' % key, lambda: tiles.get(key),
+        lambda: tiles.set(key, [render(media_item, region, size, rotation,
+                                       quality, format)]))
@@ -0,0 +1,269 @@
+"""
+Bulk ingest of directory trees (and zip archives) into Media library.
+
+* Folders are mirrored one by one (there are few of them), existing ones
+  are reused.
+* Files are streamed into the storage (deduplicated, see MediaBlob) by a pool
+  of threads, their documents are written with batched inserts.
+* Files already present in a folder (by name) are skipped, so an
+  interrupted ingest can simply be run again. Files stored for the
+  documents of a failed batch that were not inserted are released.
+"""
+from django.conf import settings
+
+from bson import ObjectId
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+from hymnbooks.apps.core.models import MediaBlob, MediaLibrary
+from hymnbooks.apps.medialib import tasks
+
+import logging
+import mimetypes
+import mongoengine
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+
+logger = logging.getLogger(__name__)
+
+
+class IngestStats(object):
+    """
+    Counters of an ingest and its throughput.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.files = 0
+        self.bytes = 0
+        self.folders = 0
+        self.skipped = 0
+
+    def add(self, media_items):
+        self.files += len(media_items)
+        self.bytes += sum(item.size or 0 for item in media_items)
+
+    def rates(self):
+        """
+        Returns (files per second, MB per second).
+        """
+        elapsed = max(time.time() - self.started, 0.001)
+        return self.files / elapsed, self.bytes / elapsed / (1024 * 1024)
+
+    def serialize(self):
+        files_rate, mb_rate = self.rates()
+        return {'files': self.files, 'bytes': self.bytes,
+                'folders': self.folders, 'skipped': self.skipped,
+                'files_per_second': round(files_rate, 2),
+                'mb_per_second': round(mb_rate, 2)}
+
+    def __str__(self):
+        return '%(files)d files (%(bytes)d bytes), %(folders)d new folders, ' \
+          '%(skipped)d skipped: %(files_per_second)s files/s, ' \
+          '%(mb_per_second)s MB/s' % self.serialize()
+
+
+class Ingest(object):
+    """
+    Mirrors a directory tree into Media library `container` (None for the
+    root) on behalf of `user`. `progress` (if given) is called with stats
+    after every batch.
+    """
+    def __init__(self, container=None, user=None, workers=None,
+                 batch_size=None, progress=None):
+        self.container = container
+        self.user = user
+        self.workers = workers or settings.MEDIA_INGEST_WORKERS
+        self.batch_size = batch_size or settings.MEDIA_INGEST_BATCH_SIZE
+        self.progress = progress
+        self.stats = IngestStats()
+
+    def run(self, root):
+        """
+        Ingests contents of the `root` directory. Returns stats.
+        """
+        root = os.path.abspath(root)
+        folders = {root: self.container}
+
+        pool = ThreadPool(self.workers)
+        try:
+            for directory, dirnames, filenames in os.walk(root):
+                folder = folders[directory]
+                dirnames.sort()
+                for dirname in dirnames:
+                    folders[os.path.join(directory, dirname)] = \
+                      self.get_folder(dirname, folder)
+
+                self.ingest_files(pool, folder, directory, sorted(filenames))
+        finally:
+            pool.close()
+            pool.join()
+
+        return self.stats
+
+    def run_zip(self, path):
+        """
+        Ingests contents of the zip archive. Returns stats.
+        """
+        directory = tempfile.mkdtemp(prefix='ingest-')
+        try:
+            with zipfile.ZipFile(path) as archive:
+                # Member names are sanitized by extractall.
+                archive.extractall(directory)
+            return self.run(directory)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def get_folder(self, name, container):
+        """
+        Returns folder `name` in `container`, creates it if it doesn't exist.
+        """
+        name = self.decode(name)
+        try:
+            return MediaLibrary.objects.get(name=name, container=container)
+        except MediaLibrary.DoesNotExist:
+            pass
+
+        folder = MediaLibrary(name=name, container=container, is_file=False,
+                              created_by=self.user, updated_by=self.user)
+        try:
+            folder.save()
+        except mongoengine.NotUniqueError:
+            # Created concurrently.
+            return MediaLibrary.objects.get(name=name, container=container)
+
+        self.stats.folders += 1
+        return folder
+
+    def ingest_files(self, pool, folder, directory, filenames):
+        names = dict((self.decode(filename), filename)
+                     for filename in filenames)
+        existing = set(MediaLibrary.objects(container=folder,
+                                            name__in=names.keys())\
+                       .scalar('name'))
+        self.stats.skipped += len(existing)
+
+        files = [(folder, name, os.path.join(directory, names[name]))
+                 for name in sorted(names) if name not in existing]
+        for start in xrange(0, len(files), self.batch_size):
+            self.insert(self.store_batch(
+                pool, files[start:start + self.batch_size]))
+
+    def store_batch(self, pool, files):
+        """
+        Stores the files in the worker threads, returns their documents. If
+        any of them fails, the files stored for the others are released and
+        the error is raised.
+        """
+        results = pool.map(self.try_store, files)
+        errors = [result for result in results
+                  if not isinstance(result, MediaLibrary)]
+        if errors:
+            self.release([result for result in results
+                          if isinstance(result, MediaLibrary)])
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return results
+
+    def try_store(self, file_info):
+        """
+        Returns result of `store` or exc_info of its error.
+        """
+        try:
+            return self.store(file_info)
+        except Exception:
+            return sys.exc_info()
+
+    def store(self, file_info):
+        """
+        Streams the file (given as (folder, name, path)) into storage and
+        returns (unsaved) document for it. Runs in a worker thread.
+        """
+        folder, name, path = file_info
+        now = datetime.now()
+        media_item = MediaLibrary(
+            id=ObjectId(), name=name, container=folder, container_safe=folder,
+            ancestors=folder.ancestors + [folder.id] if folder else [],
+            status='active', created=now, updated=now,
+            created_by=self.user, updated_by=self.user)
+
+        content_type = mimetypes.guess_type(path)[0] or \
+          'application/octet-stream'
+        with open(path, 'rb') as fileobj:
+            media_item.put_file(fileobj, content_type=content_type)
+        try:
+            media_item.fill_file_metadata()
+        except:
+            media_item.release_file()
+            raise
+        return media_item
+
+    def insert(self, media_items):
+        """
+        Writes documents (of one folder) with one insert and adds them to the
+        counters of the folders above. Files of the documents that could not
+        be inserted (created concurrently) are released. If the insert fails
+        otherwise (or is interrupted), the files of the documents that have
+        not been inserted are released before the error is raised.
+        """
+        try:
+            MediaLibrary.objects.insert(media_items, load_bulk=False,
+                                        write_concern={'continue_on_error': True})
+            inserted = media_items
+        except mongoengine.NotUniqueError:
+            inserted = self.release_rejected(media_items)
+            self.stats.skipped += len(media_items) - len(inserted)
+        except:
+            error = sys.exc_info()
+            try:
+                self.release_rejected(media_items)
+            except Exception:
+                # The db is gone: dedupe_media corrects the references.
+                logger.exception('Files of a failed batch not released')
+            raise error[0], error[1], error[2]
+
+        if inserted:
+            MediaLibrary.update_counters(inserted[0].ancestors,
+                                         sum(item.size or 0 for item in inserted),
+                                         len(inserted))
+        for media_item in inserted:
+            tasks.process_upload(media_item)
+
+        self.stats.add(inserted)
+        if self.progress is not None:
+            self.progress(self.stats)
+
+    def release_rejected(self, media_items):
+        """
+        Releases files of the documents that are not in the db (after an
+        insert of them failed), returns the inserted ones.
+        """
+        ids = set(document['_id'] for document in
+                  MediaLibrary._get_collection().find(
+                      {'_id': {'$in': [item.id for item in media_items]}},
+                      fields=['_id']))
+        self.release([item for item in media_items if item.id not in ids])
+        return [item for item in media_items if item.id in ids]
+
+    @staticmethod
+    def release(media_items):
+        """
+        Drops references of the (unsaved) documents to their files, deletes
+        the files nothing references any more.
+        """
+        if not media_items:
+            return
+        storages = dict((item.get_file_id(), item.get_storage())
+                        for item in media_items)
+        for file_id in MediaBlob.release(
+            [item.get_file_id() for item in media_items]):
+            storages[file_id].delete([file_id])
+
+    @staticmethod
+    def decode(name):
+        if isinstance(name, unicode):
+            return name
+        return name.decode('utf-8', 'replace')
@@ -0,0 +1,34 @@
+"""
+Copies file metadata from GridFS into Media library documents uploaded
+before it was stored in the documents.
+"""
+from django.core.management.base import BaseCommand
+
+from hymnbooks.apps.core.models import MediaLibrary
+
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    help = 'Stores size, content type, md5 and image dimensions of media files.'
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='Refresh metadata of all files, not only missing.'),
+        )
+
+    def handle(self, *args, **options):
+        media_filter = {'is_file': True}
+        if not options['all']:
+            media_filter['md5'] = None
+
+        count = 0
+        for media_item in MediaLibrary.objects(**media_filter).timeout(False):
+            media_item.fill_file_metadata()
+            media_item.update(set__size=media_item.size,
+                              set__content_type=media_item.content_type,
+                              set__md5=media_item.md5,
+                              set__width=media_item.width,
+                              set__height=media_item.height)
+            count += 1
+
+        self.stdout.write('Updated %d files' % count)
@@ -0,0 +1,79 @@
+"""
+Moves Media library files into the content-addressed store (MediaBlob):
+documents with the same content are pointed to one GridFS file, the
+duplicates are deleted and reference counts are (re)computed. Files in
+other storages are in the store already.
+
+Safe to run again: counts are always rebuilt from the documents. Uploads
+and deletions should be stopped while it runs.
+"""
+from django.core.management.base import BaseCommand
+
+from mongoengine.connection import get_db
+
+from hymnbooks.apps.core.models import MediaBlob, MediaLibrary
+from hymnbooks.apps.medialib.tasks import remove_gridfs_files
+
+from optparse import make_option
+
+import collections
+
+
+class Command(BaseCommand):
+    help = 'Deduplicates media files and rebuilds their reference counts.'
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False, help='Only report what would be done.'),
+        )
+
+    def handle(self, *args, **options):
+        field = MediaLibrary._fields['mediafile']
+        files = get_db(field.db_alias)['%s.files' % field.collection_name]
+
+        # grid_id -> ids of the documents referencing it.
+        references = collections.defaultdict(list)
+        for doc in MediaLibrary._get_collection().find(
+            {'mediafile': {'$ne': None}}, fields=['mediafile']):
+            references[doc['mediafile']].append(doc['_id'])
+
+        # md5 -> [(grid_id, length)]
+        contents = collections.defaultdict(list)
+        for gridout in files.find({'_id': {'$in': references.keys()}},
+                                  fields=['md5', 'length']):
+            contents[gridout['md5']].append((gridout['_id'], gridout['length']))
+
+        stored = dict((blob['md5'], blob['grid_id']) for blob in
+                      MediaBlob._get_collection().find(
+                          {'md5': {'$in': contents.keys()}},
+                          fields=['md5', 'grid_id']))
+
+        duplicates, saved = 0, 0
+        for md5, grid_files in contents.iteritems():
+            grid_ids = [grid_id for grid_id, length in grid_files]
+            canonical = stored.get(md5)
+            obsolete = [grid_id for grid_id in grid_ids if grid_id != canonical]
+            if canonical not in grid_ids:
+                # Stored file that nothing references goes with duplicates.
+                canonical = obsolete.pop(0)
+                if md5 in stored:
+                    obsolete.append(stored[md5])
+
+            documents = sum((references[grid_id] for grid_id in grid_ids), [])
+            duplicates += len(obsolete)
+            saved += grid_files[0][1] * len(obsolete)
+            if options['dry_run']:
+                continue
+
+            if obsolete:
+                MediaLibrary._get_collection().update(
+                    {'mediafile': {'$in': obsolete}},
+                    {'$set': {'mediafile': canonical}}, multi=True)
+                remove_gridfs_files(field, obsolete)
+
+            MediaBlob.objects(md5=md5).update_one(
+                set__storage='gridfs', set__grid_id=canonical, set__size=grid_files[0][1],
+                set__refcount=len(documents), upsert=True)
+
+        self.stdout.write('%s %d duplicate files of %d contents (%d bytes)' % (
+            'Found' if options['dry_run'] else 'Removed',
+            duplicates, len(contents), saved))
@@ -0,0 +1,57 @@
+"""
+Bulk ingest of a directory tree or a zip archive into Media library
+(see medialib.ingest). Run it again to resume an interrupted ingest.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from hymnbooks.apps.core.models import MediaLibrary, MongoUser
+from hymnbooks.apps.medialib.ingest import Ingest
+
+from optparse import make_option
+
+import os
+import zipfile
+
+
+class Command(BaseCommand):
+    args = '<directory or zip archive>'
+    help = 'Mirrors a directory tree (or zip archive) into Media library.'
+    option_list = BaseCommand.option_list + (
+        make_option('--container', dest='container', default=None,
+                    help='Id of the destination folder (root by default).'),
+        make_option('--user', dest='user', default=None,
+                    help='Username of the owner of created documents.'),
+        make_option('--workers', dest='workers', type='int', default=None,
+                    help='Number of threads streaming files into GridFS.'),
+        make_option('--batch-size', dest='batch_size', type='int',
+                    default=None, help='Number of documents per insert.'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: manage.py ingest_media %s' % self.args)
+        path = args[0]
+
+        container, user = None, None
+        try:
+            if options['container']:
+                container = MediaLibrary.objects.get(id=options['container'],
+                                                     is_file=False)
+            if options['user']:
+                user = MongoUser.objects.get(username=options['user'])
+        except (MediaLibrary.DoesNotExist, MongoUser.DoesNotExist) as e:
+            raise CommandError(str(e))
+
+        ingest = Ingest(container, user, workers=options['workers'],
+                        batch_size=options['batch_size'],
+                        progress=lambda stats: self.stdout.write(str(stats)))
+
+        if os.path.isdir(path):
+            stats = ingest.run(path)
+        elif zipfile.is_zipfile(path):
+            stats = ingest.run_zip(path)
+        else:
+            raise CommandError('%s is neither a directory nor a zip archive' % \
+                               path)
+
+        self.stdout.write('Done: %s' % stats)
@@ -0,0 +1,81 @@
+"""
+Moves Media library files (blobs, see MediaBlob) from one storage into
+another: every file is copied, the blob and the documents referencing it
+are pointed to the copy, then the original is deleted.
+
+Files outside of the store should be moved into it by `dedupe_media`
+first. Safe to run again (only blobs still in other storages are moved);
+uploads should be stopped while it runs.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from hymnbooks.apps.core import storage
+from hymnbooks.apps.core.models import MediaBlob, MediaLibrary
+
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    args = '<gridfs|filesystem>'
+    help = 'Moves media files into the storage.'
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False, help='Only report what would be moved.'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: migrate_media_storage %s' % self.args)
+        try:
+            target = storage.get_storage(args[0])
+        except ValueError as e:
+            raise CommandError(e)
+
+        # Blobs stored before there was a choice have no storage recorded.
+        query = {'storage': {'$ne': target.name}} if target.name != 'gridfs' \
+          else {'storage': {'$nin': [None, 'gridfs']}}
+        collection = MediaBlob._get_collection()
+
+        moved, size = 0, 0
+        for blob in collection.find(query, timeout=False):
+            moved += 1
+            size += blob.get('size') or 0
+            if options['dry_run']:
+                continue
+
+            source = storage.get_storage(blob.get('storage', 'gridfs'))
+            self.move(blob, source, target)
+
+        self.stdout.write('%s %d files (%d bytes) to %s' % (
+            'Found' if options['dry_run'] else 'Moved', moved, size,
+            target.name))
+
+    def move(self, blob, source, target):
+        media_items = MediaLibrary._get_collection()
+        old_id = blob['grid_id']
+        stored = source.open(old_id)
+        if stored is None:
+            self.stderr.write('Missing file %s (%s)' % (old_id, blob['md5']))
+            return
+
+        # File system storage keeps no content type: the documents do.
+        content_type = stored.content_type or (media_items.find_one(
+            {'md5': blob['md5']}, fields=['content_type']) or {})\
+            .get('content_type')
+        new_id = target.put(stored, content_type)
+        stored.close()
+
+        MediaBlob._get_collection().update(
+            {'_id': blob['_id']},
+            {'$set': {'storage': target.name, 'grid_id': new_id}})
+
+        reference = 'mediafile' if source.name == 'gridfs' else 'file_id'
+        if target.name == 'gridfs':
+            change = {'$set': {'storage': 'gridfs', 'mediafile': new_id},
+                      '$unset': {'file_id': 1}}
+        else:
+            change = {'$set': {'storage': target.name, 'file_id': new_id},
+                      '$unset': {'mediafile': 1}}
+        media_items.update({reference: old_id}, change, multi=True)
+
+        source.delete([old_id])
@@ -0,0 +1,37 @@
+"""
+Fills `ancestors` of all the Media library documents, walking the tree
+level by level from the root.
+"""
+from django.core.management.base import BaseCommand
+
+from hymnbooks.apps.core.models import MediaLibrary
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds materialized ancestors of the Media library tree.'
+
+    def handle(self, *args, **options):
+        collection = MediaLibrary._get_collection()
+
+        # Root level.
+        collection.update({'container': None}, {'$set': {'ancestors': []}},
+                          multi=True)
+        level = [(doc['_id'], []) for doc in collection.find(
+            {'container': None, 'is_file': False}, fields=['_id'])]
+
+        depth = 0
+        while level:
+            depth += 1
+            next_level = []
+            for folder_id, ancestors in level:
+                children_ancestors = ancestors + [folder_id]
+                collection.update({'container': folder_id},
+                                  {'$set': {'ancestors': children_ancestors}},
+                                  multi=True)
+                next_level.extend(
+                    (doc['_id'], children_ancestors) for doc in collection.find(
+                        {'container': folder_id, 'is_file': False},
+                        fields=['_id']))
+
+            self.stdout.write('Level %d: %d folders' % (depth, len(level)))
+            level = next_level
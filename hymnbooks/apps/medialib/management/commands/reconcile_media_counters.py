@@ -0,0 +1,57 @@
+"""
+Recomputes recursive counters of Media library folders (total size of the
+files, number of files and folders under them) with one aggregation over
+`ancestors`, and fixes the folders whose counters are off.
+"""
+from django.core.management.base import BaseCommand
+
+from hymnbooks.apps.core.models import MediaLibrary
+
+from optparse import make_option
+
+
+PIPELINE = [
+    {'$project': {'ancestors': 1, 'size': 1, 'is_file': 1}},
+    {'$unwind': '$ancestors'},
+    {'$group': {
+        '_id': '$ancestors',
+        'total_size': {'$sum': {'$cond': ['$is_file', '$size', 0]}},
+        'file_count': {'$sum': {'$cond': ['$is_file', 1, 0]}},
+        'folder_count': {'$sum': {'$cond': ['$is_file', 0, 1]}},
+        }},
+    ]
+
+COUNTERS = ('total_size', 'file_count', 'folder_count')
+
+
+class Command(BaseCommand):
+    help = 'Recomputes total size, file and folder counts of media folders.'
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False, help='Only report folders to be fixed.'),
+        )
+
+    def handle(self, *args, **options):
+        collection = MediaLibrary._get_collection()
+
+        result = collection.aggregate(PIPELINE)
+        counters = dict((row['_id'], row) for row in result['result'])
+
+        fixed = 0
+        for folder in collection.find({'is_file': False},
+                                      fields=list(COUNTERS)):
+            row = counters.get(folder['_id'], {})
+            expected = dict((key, row.get(key) or 0) for key in COUNTERS)
+            if all(folder.get(key) == expected[key] for key in COUNTERS):
+                continue
+
+            fixed += 1
+            self.stdout.write('%s: %s -> %s' % (
+                folder['_id'],
+                ', '.join('%s=%s' % (key, folder.get(key)) for key in COUNTERS),
+                ', '.join('%s=%s' % (key, expected[key]) for key in COUNTERS)))
+            if not options['dry_run']:
+                collection.update({'_id': folder['_id']}, {'$set': expected})
+
+        self.stdout.write('%s %d folders' % (
+            'Found' if options['dry_run'] else 'Fixed', fixed))
@@ -0,0 +1,187 @@
+"""
+Waveform peaks of WAV files from Media library, so that players can draw
+a recording before it is downloaded.
+
+Peaks are (min, max) pairs of 8-bit samples over blocks of frames (all the
+channels together), computed with numpy over PCM chunks of bounded
+size. Every next level of resolution has twice as many frames per peak.
+They are served in the formats of audiowaveform (binary .dat version 1 or
+JSON), understood by peaks.js and similar waveform viewers.
+"""
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseNotModified
+
+from hymnbooks.apps.core import cache, utils
+from hymnbooks.apps.core.models import MediaPeaks, MediaPeaksLevel
+
+import json
+import mongoengine
+import numpy
+import struct
+import wave
+
+
+WAVE_TYPES = ('audio/wav', 'audio/x-wav', 'audio/wave', 'audio/vnd.wave')
+
+# Blocks of frames per read from the file.
+BLOCKS_PER_READ = 64
+
+# Sample width (bytes) -> type of samples in WAV (8-bit WAV is unsigned).
+SAMPLE_TYPES = {1: numpy.uint8, 2: numpy.dtype('<i2'), 4: numpy.dtype('<i4')}
+
+
+def is_wave(media_item):
+    return (media_item.content_type or '') in WAVE_TYPES
+
+
+def compute_peaks(fileobj, frames_per_peak):
+    """
+    Returns (sample rate, number of channels, number of frames, peaks) of
+    WAV file, peaks being numpy array (int8) of min and max values
+    alternately.
+    """
+    reader = wave.open(fileobj, 'rb')
+    channels, width = reader.getnchannels(), reader.getsampwidth()
+    if width not in SAMPLE_TYPES:
+        raise ValueError('Unsupported sample width: %d bytes' % width)
+
+    shift = 8 * (width - 1)
+    block = frames_per_peak * channels
+    levels = []
+    while True:
+        data = reader.readframes(frames_per_peak * BLOCKS_PER_READ)
+        if not data:
+            break
+        samples = numpy.frombuffer(data, SAMPLE_TYPES[width])
+        if width == 1:
+            samples = samples.astype(numpy.int16) - 128
+
+        # Whole blocks as rows, the last block of the file may be shorter.
+        whole = len(samples) // block * block
+        rows = samples[:whole].reshape(-1, block)
+        lows, highs = rows.min(axis=1), rows.max(axis=1)
+        if whole < len(samples):
+            lows = numpy.append(lows, samples[whole:].min())
+            highs = numpy.append(highs, samples[whole:].max())
+
+        chunk = numpy.empty(2 * len(lows), numpy.int8)
+        chunk[0::2], chunk[1::2] = lows >> shift, highs >> shift
+        levels.append(chunk)
+
+    peaks = numpy.concatenate(levels) if levels else numpy.empty(0, numpy.int8)
+    return reader.getframerate(), channels, reader.getnframes(), peaks
+
+
+def downsample(peaks):
+    """
+    Returns peaks of half the resolution: pairs of peaks merged.
+    """
+    peaks = numpy.asarray(peaks, numpy.int8)
+    if len(peaks) % 4:
+        peaks = numpy.append(peaks, peaks[-2:])
+
+    merged = numpy.empty(len(peaks) // 2, numpy.int8)
+    merged[0::2] = numpy.minimum(peaks[0::4], peaks[2::4])
+    merged[1::2] = numpy.maximum(peaks[1::4], peaks[3::4])
+    return merged
+
+
+def create_peaks(media_item):
+    """
+    Computes all the levels of peaks of the media item and stores them.
+    """
+    frames_per_peak = settings.MEDIA_PEAKS_FRAMES_PER_PEAK
+    stored = media_item.open_file()
+    try:
+        sample_rate, channels, frames, peaks = compute_peaks(
+            stored, frames_per_peak)
+    finally:
+        stored.close()
+
+    levels = [MediaPeaksLevel(samples_per_peak=frames_per_peak,
+                              data=peaks.tostring())]
+    while len(peaks) > 2 * settings.MEDIA_PEAKS_MIN_LENGTH:
+        peaks = downsample(peaks)
+        frames_per_peak *= 2
+        levels.append(MediaPeaksLevel(samples_per_peak=frames_per_peak,
+                                      data=peaks.tostring()))
+
+    media_peaks = MediaPeaks(source_md5=media_item.md5,
+                             sample_rate=sample_rate, channels=channels,
+                             frames=frames, levels=levels)
+    try:
+        media_peaks.save()
+    except mongoengine.errors.NotUniqueError:
+        # Computed concurrently by another worker.
+        media_peaks = MediaPeaks.objects.get(source_md5=media_item.md5)
+    return media_peaks
+
+
+def get_peaks(media_item, create=True):
+    """
+    Returns peaks of the media item, computes them if they don't exist
+    (unless `create` is False, concurrent requests wait for one computation).
+    """
+    def get():
+        return MediaPeaks.objects(source_md5=media_item.md5).first()
+
+    if not create:
+        return get()
+
+    return cache.coalesce('peaks:%s' % media_item.md5, get,
+                          lambda: create_peaks(media_item))
+
+
+def to_dat(media_peaks, level):
+    """
+    Returns peaks in audiowaveform binary format (version 1, 8 bits).
+    """
+    header = struct.pack('<iIiiI', 1, 1, media_peaks.sample_rate,
+                         level.samples_per_peak, len(level.data) // 2)
+    return header + level.data
+
+
+def to_json(media_peaks, level):
+    """
+    Returns peaks in audiowaveform JSON format.
+    """
+    return json.dumps({'version': 1,
+                       'sample_rate': media_peaks.sample_rate,
+                       'samples_per_pixel': level.samples_per_peak,
+                       'bits': 8,
+                       'length': len(level.data) // 2,
+                       'data': array('b', level.data).tolist()})
+
+
+def serve_peaks(request, media_item):
+    """
+    Returns response with peaks of the media item (computed on demand if not
+    ready yet). ?samples_per_peak=<n> selects the finest level with at least
+    n samples per peak (the coarsest level by default), ?format=json
+    switches from binary to JSON.
+    """
+    if not is_wave(media_item):
+        raise Http404
+
+    try:
+        wanted = int(request.GET.get('samples_per_peak', 0))
+    except ValueError:
+        wanted = 0
+    output = 'json' if request.GET.get('format', None) == 'json' else 'dat'
+
+    media_peaks = get_peaks(media_item)
+    levels = [l for l in media_peaks.levels if l.samples_per_peak >= wanted]
+    level = levels[0] if wanted and levels else media_peaks.levels[-1]
+
+    etag = '%s-%d.%s' % (media_item.md5, level.samples_per_peak, output)
+    if utils.is_not_modified(request, etag):
+        return utils.set_validators(HttpResponseNotModified(), etag)
+
+    if output == 'json':
+        response = HttpResponse(to_json(media_peaks, level),
+                                content_type='application/json')
+    else:
+        response = HttpResponse(to_dat(media_peaks, level),
+                                content_type='application/octet-stream')
+    response['Cache-Control'] = 'public, max-age=31536000'
+    return utils.set_validators(response, etag)
@@ -0,0 +1,130 @@
+"""
+Streaming of stored files (see core.storage) with HTTP Range support.
+
+Files are sent chunk by chunk as they come from the storage, so worker
+memory does not depend on the file size. Files on the local disk (in
+file system storage, or GridFS files small enough for the local disk cache,
+see blobcache) are sent by the front proxy or the server's sendfile.
+"""
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, \
+     StreamingHttpResponse, Http404
+from django.utils.http import http_date, parse_etags
+
+from hymnbooks.apps.core import utils
+from hymnbooks.apps.medialib import blobcache
+
+import calendar
+import re
+
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header, length):
+    """
+    Parses `Range` header into (start, end) inclusive offsets.
+
+    Returns None if the header is malformed or asks for several ranges
+    (the whole file should be sent then), raises ValueError if the range
+    cannot be satisfied.
+    """
+    match = RANGE_RE.match(header.strip())
+    if match is None:
+        return None
+
+    start, end = match.groups()
+    if start == '' and end == '':
+        return None
+
+    if start == '':
+        # Suffix range: the last `end` bytes.
+        if int(end) == 0:
+            raise ValueError('Unsatisfiable range %s' % header)
+        return max(length - int(end), 0), length - 1
+
+    start = int(start)
+    end = length - 1 if end == '' else min(int(end), length - 1)
+    if start > end or start >= length:
+        raise ValueError('Unsatisfiable range %s' % header)
+
+    return start, end
+
+
+def get_validators(stored, md5=None):
+    """
+    Returns strong ETag (from md5 and upload date) and Last-Modified
+    timestamp of stored file.
+    """
+    last_modified = calendar.timegm(stored.upload_date.utctimetuple())
+    return '%s-%d' % (md5 or stored.md5, last_modified), last_modified
+
+
+def serve_file(request, stored, md5=None):
+    """
+    Returns streaming response with the content of stored file, partial
+    (206) if the request asks for a byte range, or 304 if the client's
+    copy is still valid (the file is not read then). Known `md5` of the
+    content saves hashing of files that don't keep it.
+    """
+    if stored is None:
+        raise Http404
+
+    md5 = md5 or stored.md5
+    etag, last_modified = get_validators(stored, md5)
+    if utils.is_not_modified(request, etag, last_modified):
+        return utils.set_validators(HttpResponseNotModified(),
+                                    etag, last_modified)
+
+    length = stored.length
+    byte_range = None
+    if_range = request.META.get('HTTP_IF_RANGE', None)
+    if if_range and if_range != http_date(last_modified) \
+      and etag not in parse_etags(if_range):
+        # Resuming a download of a changed file: send it all.
+        pass
+    elif length and 'HTTP_RANGE' in request.META:
+        try:
+            byte_range = parse_range(request.META['HTTP_RANGE'], length)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % length
+            return response
+
+    # Files missing in the cache are streamed from the storage, a request
+    # for the whole file stores it in the cache on the way.
+    path = getattr(stored, 'path', None)
+    cacheable = (path is None) and blobcache.is_cacheable(length, md5)
+    if cacheable:
+        path = blobcache.get_path(md5)
+
+    if path is not None and (byte_range is None or settings.MEDIA_SENDFILE):
+        # The front proxy answers Range requests itself.
+        response = blobcache.sendfile_response(request, path,
+                                               stored.content_type)
+        response['Accept-Ranges'] = 'bytes'
+        return utils.set_validators(response, etag, last_modified)
+
+    if byte_range is None:
+        start, end = 0, length - 1
+        content = stored.iter_range(start, end)
+        if cacheable:
+            content = blobcache.stream_through(md5, content)
+        response = StreamingHttpResponse(
+            content, content_type=stored.content_type)
+    else:
+        start, end = byte_range
+        if path is None or hasattr(stored, 'path'):
+            content = stored.iter_range(start, end)
+        else:
+            fileobj = open(path, 'rb')
+            content = blobcache.ClosingIterable(
+                blobcache.iter_file(fileobj, start, end), fileobj)
+        response = StreamingHttpResponse(
+            content, status=206, content_type=stored.content_type)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, length)
+
+    response['Content-Length'] = str(end - start + 1)
+    response['Accept-Ranges'] = 'bytes'
+
+    return utils.set_validators(response, etag, last_modified)
@@ -0,0 +1,204 @@
+"""
+Background processing of Media library files (celery tasks).
+"""
+from django.conf import settings
+
+from celery import task
+from celery.utils.log import get_task_logger
+
+from mongoengine import ImageField
+from mongoengine.connection import get_db
+
+from hymnbooks.apps.core import storage
+from hymnbooks.apps.core.models import MediaBlob, MediaIngest, MediaLibrary, \
+     MongoUser
+from hymnbooks.apps.medialib import derivatives, peaks
+
+import collections
+import os
+
+
+logger = get_task_logger(__name__)
+
+
+@task()
+def generate_derivatives(media_id):
+    """
+    Generates all the variants (see MEDIA_DERIVATIVES) of an image.
+    """
+    media_item = MediaLibrary.objects.get(id=media_id)
+    for variant in settings.MEDIA_DERIVATIVES:
+        derivatives.get_derivative(media_item, variant)
+
+
+@task()
+def generate_peaks(media_id):
+    """
+    Computes waveform peaks of a WAV file.
+    """
+    media_item = MediaLibrary.objects.get(id=media_id)
+    peaks.get_peaks(media_item)
+
+
+def process_upload(media_item):
+    """
+    Schedules background processing of a freshly uploaded file.
+    """
+    if derivatives.is_image(media_item):
+        generate_derivatives.delay(str(media_item.id))
+    elif peaks.is_wave(media_item):
+        generate_peaks.delay(str(media_item.id))
+
+
+def remove_gridfs_files(field, ids):
+    """
+    Removes GridFS files (and their chunks) stored by the document `field`
+    with two `$in` removals. Thumbnails of ImageField go with them.
+    """
+    if isinstance(field, ImageField):
+        files = get_db(field.db_alias)['%s.files' % field.collection_name]
+        ids = ids + [f['thumbnail_id'] for f in files.find(
+            {'_id': {'$in': ids}, 'thumbnail_id': {'$exists': True}},
+            fields=['thumbnail_id'])]
+
+    storage.GridFSStorage(field.collection_name, field.db_alias).delete(ids)
+
+
+def delete_documents(documents, ancestors):
+    """
+    Removes media library documents (raw, as fetched from the collection)
+    with their files, returns their number. Signals and delete rules are
+    not involved: the whole subtree goes anyway, only the counters of the
+    folders above it (`ancestors`) are updated.
+    """
+    # Files shared with documents outside of the subtree stay.
+    ids, storages = [], {}
+    for doc in documents:
+        if doc.get('mediafile'):
+            ids.append(doc['mediafile'])
+            storages[doc['mediafile']] = 'gridfs'
+        elif doc.get('file_id'):
+            ids.append(doc['file_id'])
+            storages[doc['file_id']] = doc.get('storage')
+    released = collections.defaultdict(list)
+    for file_id in MediaBlob.release(ids):
+        released[storages[file_id]].append(file_id)
+    for name, ids in released.iteritems():
+        storage.get_storage(name).delete(ids)
+
+    ids = [doc['thumbnail'] for doc in documents if doc.get('thumbnail')]
+    if ids:
+        remove_gridfs_files(MediaLibrary._fields['thumbnail'], ids)
+
+    MediaLibrary._get_collection().remove(
+        {'_id': {'$in': [doc['_id'] for doc in documents]}})
+
+    files = [doc for doc in documents if doc.get('is_file')]
+    MediaLibrary.update_counters(
+        ancestors, -sum(doc.get('size') or 0 for doc in files),
+        -len(files), len(files) - len(documents))
+
+    return len(documents)
+
+
+# Fields of the raw documents needed to remove them.
+DELETE_FIELDS = ['storage', 'mediafile', 'file_id', 'thumbnail', 'is_file',
+                 'size']
+
+
+def delete_folder(folder):
+    """
+    Removes everything under the folder in batches of
+    MEDIA_DELETE_BATCH_SIZE documents, then the folder itself. Progress is
+    stored in the folder: `deleted_count` of `delete_total` documents
+    (including the folder). Returns the number of documents removed.
+    """
+    batch_size = settings.MEDIA_DELETE_BATCH_SIZE
+    collection = MediaLibrary._get_collection()
+
+    def report(done, total):
+        collection.update({'_id': folder.id}, {'$set': {
+            'deleted_count': done, 'delete_total': total + 1}})
+
+    done = 0
+    while True:
+        # Files uploaded into the subtree while it was being removed are
+        # picked up by the next round.
+        cursor = collection.find({'ancestors': folder.id},
+                                 fields=DELETE_FIELDS)
+        total = done + cursor.count()
+        if total == done:
+            break
+
+        batch = []
+        for doc in cursor.batch_size(batch_size):
+            batch.append(doc)
+            if len(batch) < batch_size:
+                continue
+            done += delete_documents(batch, folder.ancestors)
+            batch = []
+            report(done, total)
+        if batch:
+            done += delete_documents(batch, folder.ancestors)
+            report(done, total)
+
+    doc = collection.find_one({'_id': folder.id}, fields=DELETE_FIELDS)
+    if doc is not None:
+        done += delete_documents([doc], folder.ancestors)
+    return done
+
+
+@task()
+def delete_subtree(folder_id):
+    """
+    Removes the folder marked as deleted with everything under it (see
+    delete_folder).
+    """
+    done = delete_folder(MediaLibrary.objects.get(id=folder_id))
+    logger.info('Media library folder %s removed (%d documents)',
+                folder_id, done)
+    return done
+
+
+def delete_item(media_item):
+    """
+    Deletes a file right away. Folder is marked as deleted (with everything
+    under it) and removed in the background.
+    """
+    if media_item.is_file:
+        media_item.delete()
+        return None
+
+    media_item.mark_deleted()
+    return delete_subtree.delay(str(media_item.id))
+
+
+@task()
+def ingest_zip(ingest_id, path, container_id=None, user_id=None):
+    """
+    Ingests contents of the zip archive (removed afterwards) into the
+    container, storing the state and stats in MediaIngest `ingest_id` after
+    every batch. Returns the stats.
+    """
+    from hymnbooks.apps.medialib.ingest import Ingest
+
+    container = MediaLibrary.objects.get(id=container_id) \
+      if container_id else None
+    user = MongoUser.objects.get(id=user_id) if user_id else None
+
+    def progress(stats):
+        MediaIngest.report(ingest_id, 'PROGRESS', stats.serialize())
+
+    ingest = Ingest(container, user, progress=progress)
+    try:
+        stats = ingest.run_zip(path)
+    except Exception as e:
+        MediaIngest.report(ingest_id, 'FAILURE', ingest.stats.serialize(),
+                           str(e))
+        raise
+    finally:
+        os.remove(path)
+
+    MediaIngest.report(ingest_id, 'SUCCESS', stats.serialize())
+    logger.info('Zip archive ingested: %s', stats)
+    return stats.serialize()
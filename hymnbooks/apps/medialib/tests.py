@@ -1,3 +1,505 @@
-from django.test import TestCase
+from django.conf import settings
+from django.test import SimpleTestCase
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test.client import RequestFactory
 
-# Create your tests here.
+from hymnbooks.apps.core import storage, utils
+from hymnbooks.apps.core.models import MediaBlob, MediaLibrary
+from hymnbooks.apps.core.testing import FakeCollection, FakeGridFS, patch, \
+  patch_collection
+from hymnbooks.apps.medialib import blobcache, derivatives, iiif, peaks, \
+     streaming, tasks, views
+from hymnbooks.apps.medialib.ingest import Ingest, IngestStats
+
+from mongoengine.errors import NotUniqueError
+from pymongo.errors import AutoReconnect
+
+from array import array
+from bson import ObjectId
+from cStringIO import StringIO
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import wave
+
+
+class ParseRangeTest(SimpleTestCase):
+    def test_byte_ranges(self):
+        self.assertEqual(streaming.parse_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(streaming.parse_range('bytes=900-', 1000), (900, 999))
+        self.assertEqual(streaming.parse_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(streaming.parse_range('bytes=0-5000', 1000), (0, 999))
+
+    def test_ignored_ranges(self):
+        self.assertIsNone(streaming.parse_range('bytes=0-1,5-6', 1000))
+        self.assertIsNone(streaming.parse_range('items=0-1', 1000))
+
+    def test_unsatisfiable_ranges(self):
+        self.assertRaises(ValueError, streaming.parse_range, 'bytes=1000-', 1000)
+        self.assertRaises(ValueError, streaming.parse_range, 'bytes=5-1', 1000)
+
+
+class ConditionalGetTest(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_if_none_match(self):
+        request = self.factory.get('/', HTTP_IF_NONE_MATCH='"abc-1", "def-2"')
+        self.assertTrue(utils.is_not_modified(request, 'def-2', 2))
+        self.assertFalse(utils.is_not_modified(request, 'def-3', 2))
+
+        request = self.factory.get('/', HTTP_IF_NONE_MATCH='W/"def-2"')
+        self.assertTrue(utils.is_not_modified(request, 'def-2'))
+
+    def test_if_modified_since(self):
+        request = self.factory.get(
+            '/', HTTP_IF_MODIFIED_SINCE='Sun, 06 Nov 1994 08:49:37 GMT')
+        self.assertTrue(utils.is_not_modified(request, 'abc', 784111777))
+        self.assertFalse(utils.is_not_modified(request, 'abc', 784111778))
+
+
+SCAN = os.path.join(os.path.dirname(__file__), '..', '..', 'tmp',
+                    'kancjonal_st_v1.jpg')
+
+
+class DerivativesTest(SimpleTestCase):
+    def test_render_fits_box(self):
+        for variant, (width, height, quality) in \
+          settings.MEDIA_DERIVATIVES.iteritems():
+            output, size = derivatives.render(open(SCAN, 'rb'), variant)
+            self.assertTrue(size[0] <= width and size[1] <= height)
+            self.assertEqual(output.read(2), '\xff\xd8') # JPEG
+
+
+class IIIFParseTest(SimpleTestCase):
+    def test_region(self):
+        self.assertEqual(iiif.parse_region('full', 800, 600), (0, 0, 800, 600))
+        self.assertEqual(iiif.parse_region('square', 800, 600),
+                         (100, 0, 600, 600))
+        self.assertEqual(iiif.parse_region('512,512,512,512', 800, 600),
+                         (512, 512, 288, 88))
+        self.assertEqual(iiif.parse_region('pct:50,50,50,50', 800, 600),
+                         (400, 300, 400, 300))
+        self.assertRaises(ValueError, iiif.parse_region, '900,0,10,10', 800, 600)
+        self.assertRaises(ValueError, iiif.parse_region, '0,0,10', 800, 600)
+
+    def test_size(self):
+        self.assertEqual(iiif.parse_size('full', 800, 600), (800, 600))
+        self.assertEqual(iiif.parse_size('400,', 800, 600), (400, 300))
+        self.assertEqual(iiif.parse_size(',150', 800, 600), (200, 150))
+        self.assertEqual(iiif.parse_size('pct:25', 800, 600), (200, 150))
+        self.assertEqual(iiif.parse_size('!100,100', 800, 600), (100, 75))
+        self.assertRaises(ValueError, iiif.parse_size, '1600,', 800, 600)
+        self.assertRaises(ValueError, iiif.parse_size, ',', 800, 600)
+
+    def test_rotation(self):
+        self.assertEqual(iiif.parse_rotation('90'), (False, 90))
+        self.assertEqual(iiif.parse_rotation('!0'), (True, 0))
+        self.assertRaises(ValueError, iiif.parse_rotation, '-90')
+
+
+class IIIFRenderTest(SimpleTestCase):
+    class MediaItem(object):
+        md5 = 'iiif-test'
+
+        def __init__(self):
+            from PIL import Image
+
+            self.width, self.height = Image.open(SCAN).size
+
+        def open_file(self):
+            return open(SCAN, 'rb')
+
+    def test_tile(self):
+        from PIL import Image
+
+        media_item = self.MediaItem()
+        data = iiif.render(media_item, '0,0,400,200', '200,', '90', 'gray',
+                           'png')
+        image = Image.open(StringIO(data))
+        self.assertEqual((image.format, image.mode, image.size),
+                         ('PNG', 'L', (100, 200)))
+
+    def test_info(self):
+        info = iiif.info(self.MediaItem(), 'http://localhost/iiif')
+        factors = info['tiles'][0]['scaleFactors']
+        self.assertEqual(factors[0], 1)
+        self.assertTrue(max(info['width'], info['height']) <= \
+                        factors[-1] * settings.IIIF_TILE_SIZE)
+
+
+class IngestStatsTest(SimpleTestCase):
+    def test_throughput(self):
+        stats = IngestStats()
+        stats.started -= 2
+        stats.files, stats.bytes = 10, 4 * 1024 * 1024
+        data = stats.serialize()
+        self.assertAlmostEqual(data['files_per_second'], 5, places=1)
+        self.assertAlmostEqual(data['mb_per_second'], 2, places=1)
+        self.assertIn('files/s', str(stats))
+
+
+RECORDING = os.path.join(os.path.dirname(__file__), '..', '..', 'tmp',
+                         '71-1.wav')
+
+
+class PeaksTest(SimpleTestCase):
+    def test_compute_peaks(self):
+        frames = wave.open(RECORDING).getnframes()
+        sample_rate, channels, length, data = peaks.compute_peaks(
+            open(RECORDING, 'rb'), 256)
+        self.assertEqual((sample_rate, channels, length), (44100, 2, frames))
+        self.assertEqual(len(data), 2 * ((frames + 255) // 256))
+        self.assertTrue(all(low <= high
+                            for low, high in zip(data[0::2], data[1::2])))
+
+    def test_downsample(self):
+        data = array('b', [-1, 1, -5, 2, 0, 7, -3, 3, -2, 2])
+        self.assertEqual(peaks.downsample(data).tolist(),
+                         [-5, 2, -3, 7, -2, 2])
+
+
+class KeysetQuerySet(object):
+    """
+    In-memory stand-in for the queryset of folder content.
+    """
+    def __init__(self, objects):
+        self.objects = sorted(objects,
+                              key=lambda obj: (obj.is_file, obj.name, obj.id))
+
+    def filter(self, is_file, name__gte=u''):
+        return KeysetQuerySet([obj for obj in self.objects
+                               if obj.is_file == is_file and
+                               obj.name >= name__gte])
+
+    def limit(self, n):
+        return self.objects[:n]
+
+
+class KeysetPaginationTest(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.queryset = KeysetQuerySet(
+            [MediaLibrary(id=ObjectId(), name=u'folder %d' % i, is_file=False)
+             for i in range(4)] +
+            [MediaLibrary(id=ObjectId(), name=u'scan %02d' % i)
+             for i in range(7)])
+        patch(self, views.settings.base, 'MEDIA_PAGE_SIZE', 3)
+
+    def test_pages(self):
+        names, after = [], None
+        while True:
+            data = {'after': after} if after else {}
+            page, after = views.get_page(self.factory.get('/', data),
+                                         self.queryset)
+            self.assertTrue(len(page) <= 3)
+            names.extend(obj.name for obj in page)
+            if after is None:
+                break
+
+        self.assertEqual(names, [obj.name for obj in self.queryset.objects])
+
+    def test_malformed_cursor(self):
+        page, after = views.get_page(self.factory.get('/', {'after': 'x'}),
+                                     self.queryset)
+        self.assertEqual(page[0].name, u'folder 0')
+
+
+class IngestFailureTest(SimpleTestCase):
+    def setUp(self):
+        self.collection = FakeCollection([], insert_limit=1)
+        self.gridfs = FakeGridFS()
+        self.released = []
+        patch(self, MediaBlob, 'release', classmethod(
+            lambda cls, ids: self.released.extend(ids) or list(ids)))
+        patch_collection(self, MediaLibrary, self.collection)
+        patch(self, storage.GridFSStorage, 'get_collection',
+              lambda storage: self.gridfs)
+
+        self.media_items = []
+        for name in (u'a', u'b', u'c'):
+            media_item = MediaLibrary(id=ObjectId(), name=name, is_file=True)
+            media_item.set_file('gridfs', ObjectId())
+            self.media_items.append(media_item)
+        self.files = [item.get_file_id() for item in self.media_items]
+
+    def test_failed_insert(self):
+        self.assertRaises(AutoReconnect, Ingest().insert, self.media_items)
+        # The inserted document keeps its file.
+        self.assertEqual(self.released, self.files[1:])
+        self.assertEqual(
+            [query['_id']['$in'] for query in self.gridfs.files.removed],
+            [[self.files[1]], [self.files[2]]])
+
+    def test_failed_store(self):
+        media_items = dict((item.name, item) for item in self.media_items)
+
+        def store(file_info):
+            if file_info == u'b':
+                raise IOError('Unreadable')
+            return media_items[file_info]
+
+        ingest = Ingest()
+        ingest.store = store
+        pool = ThreadPool(2)
+        try:
+            self.assertRaises(IOError, ingest.store_batch, pool,
+                              [u'a', u'b', u'c'])
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(sorted(self.released),
+                         sorted([self.files[0], self.files[2]]))
+
+
+class DeleteFolderTest(SimpleTestCase):
+    def setUp(self):
+        self.root, self.folder, self.subfolder = \
+          ObjectId(), ObjectId(), ObjectId()
+        self.files = [ObjectId() for i in range(3)]
+        file_docs = [{'_id': ObjectId(), 'is_file': True,
+                      'mediafile': file_id, 'size': 10}
+                     for file_id in self.files]
+        for doc in file_docs[:2]:
+            doc['ancestors'] = [self.root, self.folder]
+        file_docs[2]['ancestors'] = [self.root, self.folder, self.subfolder]
+
+        self.collection = FakeCollection(
+            [{'_id': self.root, 'is_file': False, 'ancestors': []},
+             {'_id': self.folder, 'is_file': False,
+              'ancestors': [self.root]},
+             {'_id': self.subfolder, 'is_file': False,
+              'ancestors': [self.root, self.folder]}] + file_docs)
+        self.gridfs = FakeGridFS()
+        self.counters = []
+
+        patch(self, settings, 'MEDIA_DELETE_BATCH_SIZE', 2)
+        patch(self, MediaBlob, 'release',
+              classmethod(lambda cls, ids: list(ids)))
+        patch(self, MediaLibrary, 'update_counters',
+              staticmethod(lambda *args: self.counters.append(args)))
+        patch_collection(self, MediaLibrary, self.collection)
+        patch(self, storage.GridFSStorage, 'get_collection',
+              lambda storage: self.gridfs)
+
+    def test_delete_folder(self):
+        folder = MediaLibrary(id=self.folder, is_file=False,
+                              ancestors=[self.root], status='deleted')
+        self.assertEqual(tasks.delete_folder(folder), 5)
+        self.assertEqual([doc['_id'] for doc in self.collection.documents],
+                         [self.root])
+
+        # Batches of 2 with progress stored in the folder, the folder last.
+        removed = [query['_id']['$in'] for query in self.collection.removed]
+        self.assertEqual([len(ids) for ids in removed], [2, 2, 1])
+        self.assertEqual(removed[-1], [self.folder])
+        self.assertEqual([update['$set']
+                          for update in self.collection.updates],
+                         [{'deleted_count': 2, 'delete_total': 5},
+                          {'deleted_count': 4, 'delete_total': 5}])
+
+        # Files go with one `$in` removal per batch.
+        removed = [query['_id']['$in'] for query in self.gridfs.files.removed]
+        self.assertEqual(sorted(sum(removed, [])), sorted(self.files))
+        self.assertEqual(len(removed), 2)
+        self.assertEqual([query['files_id']['$in']
+                          for query in self.gridfs.chunks.removed], removed)
+
+        self.assertEqual(sum(counters[1] for counters in self.counters), -30)
+        self.assertEqual(sum(counters[2] for counters in self.counters), -3)
+        self.assertEqual(sum(counters[3] for counters in self.counters), -2)
+        self.assertTrue(all(counters[0] == [self.root]
+                            for counters in self.counters))
+
+
+class BlockingCollection(FakeCollection):
+    """
+    Collection answering `find_one` with a file once it is released.
+    """
+    def __init__(self, doc):
+        super(BlockingCollection, self).__init__([doc])
+        self.doc = doc
+        self.queries = []
+        self.started, self.released = threading.Event(), threading.Event()
+
+    def find_one(self, query=None, fields=None):
+        self.queries.append(query)
+        self.started.set()
+        self.released.wait()
+        return super(BlockingCollection, self).find_one(query, fields)
+
+
+class MediaObjectLookupTest(SimpleTestCase):
+    def setUp(self):
+        self.collection = BlockingCollection(
+            {'_id': ObjectId(), 'name': u'scan.jpg', 'is_file': True,
+             'status': 'active'})
+        patch_collection(self, MediaLibrary, self.collection)
+
+    def test_concurrent_lookups(self):
+        container = str(self.collection.doc['_id'])
+        results = []
+
+        def request():
+            results.append(views.get_MediaLibrary(RequestFactory().get('/'),
+                                                  container=container))
+
+        threads = [threading.Thread(target=request) for i in range(2)]
+        threads[0].start()
+        self.collection.started.wait()
+        threads[1].start()
+        time.sleep(0.05)
+        self.collection.released.set()
+        for thread in threads:
+            thread.join()
+
+        # One query, but documents are not shared by the requests.
+        self.assertEqual(len(self.collection.queries), 1)
+        self.assertEqual([obj.id for obj in results],
+                         [self.collection.doc['_id']] * 2)
+        self.assertFalse(results[0] is results[1])
+
+
+class LoggedInUser(object):
+    def is_anonymous(self):
+        return False
+
+
+class FileUploadTest(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.storage = storage.FileSystemStorage(self.root)
+        self.file_ids = []
+
+        def put_file(document, fileobj, content_type=None):
+            self.file_ids.append(self.storage.put(fileobj, content_type))
+            document.set_file('filesystem', self.file_ids[-1])
+
+        def save(document, **kwargs):
+            raise NotUniqueError('Duplicate name')
+
+        patch(self, MediaBlob, 'release',
+              classmethod(lambda cls, ids: list(ids)))
+        patch(self, MediaLibrary, 'put_file', put_file)
+        patch(self, MediaLibrary, 'save', save)
+        patch(self, MediaLibrary, 'get_storage',
+              lambda document: self.storage)
+
+    def test_duplicate_name(self):
+        request = RequestFactory().post('/')
+        request.user = LoggedInUser()
+
+        message, created = views.FileUploadView().handle_upload(
+            SimpleUploadedFile('scan.jpg', 'x' * 100, 'image/jpeg'), None,
+            request)
+        self.assertEqual(created, None)
+        self.assertTrue('already exists' in message['message'])
+        self.assertEqual(self.storage.open(self.file_ids[0]), None)
+
+
+class FileWrapperMiddlewareTest(SimpleTestCase):
+    def setUp(self):
+        self.path = blobcache.store('0' * 32, ['abc', 'def'])
+
+    def call(self, environ, status='200 OK'):
+        def application(environ, start_response):
+            request = RequestFactory().get('/')
+            request.META = environ
+            response = blobcache.sendfile_response(request, self.path,
+                                                   'text/plain')
+            self.fileobj = environ[blobcache.FILE_WRAPPER_KEY]
+            start_response(status, response.items())
+            return response
+
+        middleware = blobcache.FileWrapperMiddleware(application)
+        return middleware(environ, lambda status, headers, exc_info=None: None)
+
+    def test_file_wrapper(self):
+        wrapped = []
+        environ = {'wsgi.file_wrapper':
+                   lambda fileobj, block_size: wrapped.append(fileobj) or
+                   [fileobj.read()]}
+        self.assertEqual(list(self.call(environ)), ['abcdef'])
+        self.assertEqual(len(wrapped), 1)
+
+    def test_no_file_wrapper(self):
+        result = self.call({})
+        self.assertEqual(''.join(result), 'abcdef')
+        self.assertFalse(self.fileobj.closed)
+        result.close()
+        self.assertTrue(self.fileobj.closed)
+
+    def test_not_sent(self):
+        self.call({'wsgi.file_wrapper': None}, status='304 Not Modified')
+        self.assertTrue(self.fileobj.closed)
+
+
+class StoredFile(object):
+    """
+    File of a storage without a local path (like a GridFS one).
+    """
+    def __init__(self, content, md5):
+        self.content = content
+        self.length = len(content)
+        self.md5 = md5
+        self.content_type = 'text/plain'
+        self.upload_date = datetime(2014, 1, 1)
+
+    def iter_range(self, start, end):
+        for offset in xrange(start, end + 1, 4):
+            yield self.content[offset:min(offset + 4, end + 1)]
+
+
+class StreamThroughTest(SimpleTestCase):
+    def test_miss_is_streamed(self):
+        md5 = hashlib.md5(os.urandom(16)).hexdigest()
+        response = streaming.serve_file(RequestFactory().get('/'),
+                                        StoredFile('x' * 10, md5))
+
+        # Nothing is copied before the response is sent.
+        self.assertEqual(blobcache.get_path(md5), None)
+        self.assertEqual(''.join(response.streaming_content), 'x' * 10)
+        self.assertEqual(open(blobcache.get_path(md5)).read(), 'x' * 10)
+
+    def test_abandoned_stream(self):
+        md5 = hashlib.md5(os.urandom(16)).hexdigest()
+        response = streaming.serve_file(RequestFactory().get('/'),
+                                        StoredFile('x' * 10, md5))
+        content = iter(response.streaming_content)
+        next(content)
+        response.close()
+        self.assertEqual(blobcache.get_path(md5), None)
+
+
+    def test_cached_range(self):
+        md5 = hashlib.md5(os.urandom(16)).hexdigest()
+        stored = StoredFile('0123456789', md5)
+        blobcache.store(md5, stored.iter_range(0, 9))
+        response = streaming.serve_file(
+            RequestFactory().get('/', HTTP_RANGE='bytes=2-5'), stored)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(''.join(response.streaming_content), '2345')
+
+        # The cached file is closed with the response.
+        body, = response._closable_objects
+        response.close()
+        self.assertTrue(body.fileobj.closed)
+
+
+class WriteThroughTest(SimpleTestCase):
+    def setUp(self):
+        patch(self, settings, 'MEDIA_BLOB_CACHE_MAX_FILE', 10)
+
+    def test_write_through(self):
+        blobcache.write_through('1' * 32, StringIO('x' * 10), 10)
+        self.assertNotEqual(blobcache.get_path('1' * 32), None)
+
+        blobcache.write_through('2' * 32, StringIO('x' * 11), 11)
+        self.assertEqual(blobcache.get_path('2' * 32), None)
@@ -38,4 +38,23 @@ urlpatterns = patterns('',
         views.MediaLibraryDelete.as_view(),
         name='medialib_delete'),
 
+    # Waveform peaks of an audio file.
+    url(r'^(?P<id>[-\w]+)/peaks/$',
+        views.MediaPeaksView.as_view(),
+        name='medialib_peaks'),
+
+    # IIIF Image API: image information and tiles.
+    url(r'^(?P<id>[-\w]+)/iiif$',
+        views.IIIFBaseView.as_view(),
+        name='medialib_iiif_base'),
+
+    url(r'^(?P<id>[-\w]+)/iiif/info.json$',
+        views.IIIFInfoView.as_view(),
+        name='medialib_iiif_info'),
+
+    url(r'^(?P<id>[-\w]+)/iiif/(?P<region>[^/]+)/(?P<size>[^/]+)/'
+        r'(?P<rotation>[^/]+)/(?P<quality>\w+)\.(?P<format>\w+)$',
+        views.IIIFImageView.as_view(),
+        name='medialib_iiif_image'),
+
 )
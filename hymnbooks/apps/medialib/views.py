@@ -3,14 +3,22 @@ from django.shortcuts import render, redirect
 from django.views.generic.base import View
 from django.template import RequestContext
 from django.utils.encoding import force_unicode
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest, \
+     HttpResponseNotModified, Http404
 from django.utils.translation import ugettext as _
 
-from hymnbooks.apps.core.models import MediaLibrary
+from hymnbooks.apps.core.models import MediaLibrary, MongoUser
+from hymnbooks.apps.core import cache, utils
 from hymnbooks.apps.core.utils import UserMessage
-from hymnbooks.apps.medialib import forms
+from hymnbooks.apps.medialib import blobcache, derivatives, forms, iiif, peaks, \
+     streaming, tasks
 from hymnbooks import settings
 
+from bson import DBRef, ObjectId
+from bson.errors import InvalidId
+
+import base64
+import json
 import mongoengine
 
 
@@ -24,6 +32,17 @@ def get_media_object(**kwargs):
     return obj
 
 
+def get_raw_media_object(obj_id):
+    """
+    Returns raw document of the Media library object or None.
+    """
+    try:
+        return MediaLibrary._get_collection().find_one(
+            {'_id': ObjectId(obj_id)})
+    except (InvalidId, TypeError):
+        return None
+
+
 def get_MediaLibrary(request, *args, **kwargs):
     """
     Returns a QuerySet in case if kwargs['container'] points to None or folder,
@@ -42,13 +61,88 @@ def get_MediaLibrary(request, *args, **kwargs):
     else:
         lib_filter.update({'container': None})
 
-    media_object = get_media_object(**lib_filter)
-    if media_object:
-        if media_object.is_file:
-            return media_object
+    # Concurrent requests for the same object share one query, every one
+    # gets its own document.
+    if container:
+        raw = cache.flights.do(('media', container), get_raw_media_object,
+                               container)
+        if raw and raw.get('is_file'):
+            return MediaLibrary._from_son(raw)
 
     return MediaLibrary.objects.filter(**lib_filter)\
-      .order_by('is_file', 'name')
+      .order_by('is_file', 'name', 'id')
+
+
+def encode_cursor(obj):
+    return base64.urlsafe_b64encode(
+        json.dumps([obj.is_file, obj.name, str(obj.id)]))
+
+
+def decode_cursor(cursor):
+    """
+    Returns (is_file, name, id) of the last object of the previous page or
+    None if the cursor is missing or malformed (first page).
+    """
+    try:
+        is_file, name, obj_id = json.loads(base64.urlsafe_b64decode(
+            str(cursor)))
+        return bool(is_file), unicode(name), ObjectId(obj_id)
+    except (TypeError, ValueError, InvalidId):
+        return None
+
+
+def prefetch_creators(objects):
+    """
+    Loads authors of the objects with one query (instead of dereferencing
+    `created_by` of every object).
+    """
+    refs = [obj._data.get('created_by') for obj in objects]
+    ids = set(ref.id for ref in refs if isinstance(ref, DBRef))
+    users = MongoUser.objects.in_bulk(list(ids)) if ids else {}
+    for obj, ref in zip(objects, refs):
+        if isinstance(ref, DBRef):
+            obj._data['created_by'] = users.get(ref.id)
+
+
+def get_page(request, queryset):
+    """
+    Returns a page of folder content (ordered by is_file, name and id) that
+    follows the cursor ?after=<cursor>, and the cursor of the next page (or
+    None). Every page is a range scan of the index on (container, is_file,
+    name, id), so its cost does not depend on the position in the folder.
+    """
+    size = settings.base.MEDIA_PAGE_SIZE
+    cursor = decode_cursor(request.GET.get('after', ''))
+
+    if cursor is None:
+        page = list(queryset.limit(size + 1))
+    else:
+        is_file, name, obj_id = cursor
+        # Name is unique in a folder, but go on with id if it has changed.
+        following = queryset.filter(is_file=is_file, name__gte=name)\
+          .limit(size + 2)
+        page = [obj for obj in following if (obj.name, obj.id) > (name, obj_id)]
+        if (not is_file) and (len(page) <= size):
+            # Folders are over, files go next.
+            page += list(queryset.filter(is_file=True)\
+                         .limit(size + 1 - len(page)))
+
+    next_cursor = encode_cursor(page[size - 1]) if len(page) > size else None
+    page = page[:size]
+    prefetch_creators(page)
+
+    return page, next_cursor
+
+
+def get_folder_context(request, context_objects):
+    """
+    Returns template context for the page of folder content.
+    """
+    page, next_cursor = get_page(request, context_objects)
+    return {'context_objects': page,
+            'next_cursor': next_cursor,
+            'first_page': 'after' not in request.GET,
+            'user_message': request.session.pop('user_message', {})}
 
 
 def reverse_back(**kwargs):
@@ -69,18 +163,87 @@ class MediaLibraryView(View):
         context_objects = get_MediaLibrary(request, *args, **kwargs)
         if isinstance(context_objects, MediaLibrary):
 
-            # Display file.
-            return HttpResponse(context_objects.mediafile.read(),
-                                content_type=context_objects.mediafile.content_type)
+            # Display file (or its resized copy).
+            variant = request.GET.get('size', None)
+            if variant:
+                return derivatives.serve_derivative(request, context_objects,
+                                                    variant)
+            return streaming.serve_file(request, context_objects.open_file(),
+                                        context_objects.md5)
 
         # Display folder content.
+        context = get_folder_context(request, context_objects)
+        context['form'] = None
         return render(request,
                       self.template_name,
-                      {'form': None,
-                       'context_objects': context_objects,
-                       'user_message': request.session.pop('user_message', {})
-                       },
-                       context_instance=RequestContext(request))
+                      context,
+                      context_instance=RequestContext(request))
+
+
+class IIIFView(View):
+    """
+    Base for IIIF Image API views: tiles can be requested by viewers from
+    other hosts and never change (the source is identified by md5).
+    """
+    def get_media_item(self, **kwargs):
+        try:
+            media_item = MediaLibrary.objects.get(id=kwargs['id'])
+        except (MediaLibrary.DoesNotExist, mongoengine.ValidationError):
+            raise Http404
+        if not (derivatives.is_image(media_item) and media_item.width):
+            raise Http404
+        return media_item
+
+    def finalize(self, response, etag):
+        response['Access-Control-Allow-Origin'] = '*'
+        response['Cache-Control'] = 'public, max-age=31536000'
+        return utils.set_validators(response, etag)
+
+
+class IIIFBaseView(View):
+    def get(self, request, *args, **kwargs):
+        response = redirect(reverse('medialib_iiif_info', args=(kwargs['id'],)))
+        response.status_code = 303
+        return response
+
+
+class IIIFInfoView(IIIFView):
+    def get(self, request, *args, **kwargs):
+        media_item = self.get_media_item(**kwargs)
+        base_uri = request.build_absolute_uri(
+            reverse('medialib_iiif_base', args=(kwargs['id'],)))
+        response = HttpResponse(json.dumps(iiif.info(media_item, base_uri)),
+                                content_type='application/json')
+        return self.finalize(response, '%s-info' % media_item.md5)
+
+
+class IIIFImageView(IIIFView):
+    def get(self, request, *args, **kwargs):
+        media_item = self.get_media_item(**kwargs)
+        params = [kwargs[key] for key in
+                  ('region', 'size', 'rotation', 'quality', 'format')]
+
+        etag = '-'.join([media_item.md5] + params)
+        if utils.is_not_modified(request, etag):
+            return self.finalize(HttpResponseNotModified(), etag)
+
+        try:
+            path = iiif.get_tile(media_item, *params)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+
+        response = blobcache.sendfile_response(
+            request, path, iiif.FORMATS[kwargs['format']][1])
+        return self.finalize(response, etag)
+
+
+class MediaPeaksView(View):
+    def get(self, request, *args, **kwargs):
+        try:
+            media_item = MediaLibrary.objects.get(id=kwargs['id'])
+        except (MediaLibrary.DoesNotExist, mongoengine.ValidationError):
+            raise Http404
+        return peaks.serve_peaks(request, media_item)
 
 
 class FileUploadView(View):
@@ -89,13 +252,12 @@ class FileUploadView(View):
 
     def get(self, request, *args, **kwargs):
         context_objects = get_MediaLibrary(request, *args, **kwargs)
+        context = get_folder_context(request, context_objects)
+        context['form'] = self.form_class()
         return render(request,
                       self.template_name,
-                      {'form': self.form_class(),
-                       'context_objects': context_objects,
-                       'user_message': request.session.pop('user_message', {})
-                       },
-                       context_instance=RequestContext(request))
+                      context,
+                      context_instance=RequestContext(request))
 
     def post(self, request, *args, **kwargs):
         form = self.form_class(request.POST, request.FILES)
@@ -129,13 +291,19 @@ class FileUploadView(View):
 
         mediafile = MediaLibrary(name=force_unicode(in_memory.name),
                                  container=container)
-        mediafile.mediafile.put(in_memory, content_type=in_memory.content_type)
+        mediafile.put_file(in_memory, content_type=in_memory.content_type)
         try:
             mediafile.save(request=request)
         except mongoengine.errors.NotUniqueError:
+            # Nothing references the file stored for the document.
+            mediafile.release_file()
             message = _('File with this name already exists!')
             return UserMessage(message).danger(), None
 
+        if mediafile.storage == 'gridfs':
+            blobcache.write_through(mediafile.md5, in_memory, mediafile.size)
+        tasks.process_upload(mediafile)
+
         return None, mediafile
 
 
@@ -145,12 +313,11 @@ class NewFolderView(View):
 
     def get(self, request, *args, **kwargs):
         context_objects = get_MediaLibrary(request, *args, **kwargs)
+        context = get_folder_context(request, context_objects)
+        context['form'] = self.form_class()
         return render(request,
                       self.template_name,
-                      {'form': self.form_class(),
-                       'context_objects': context_objects,
-                       'user_message': request.session.pop('user_message', {})
-                       },
+                      context,
                       context_instance=RequestContext(request))
 
     def post(self, request, *args, **kwargs):
@@ -202,8 +369,10 @@ class MediaLibraryDelete(View):
         if media_item.container:
             rev_kwargs = {'container': media_item.container.id}
         try:
-            media_item.delete()
+            if tasks.delete_item(media_item) is not None:
+                message = _('Folder is being deleted in background.')
+                request.session['user_message'] = UserMessage(message).info()
         except Exception as e:
-            request.session['user_message'] = UserMessage(message).danger(str(e))
+            request.session['user_message'] = UserMessage().danger(str(e))
             
         return reverse_back(**rev_kwargs)
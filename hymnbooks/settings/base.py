@@ -1,5 +1,8 @@
 from hymnbooks.settings.local_settings import *
 
+import os
+import tempfile
+
 DEBUG = True
 TEMPLATE_DEBUG = DEBUG
 
@@ -74,6 +77,8 @@ INSTALLED_APPS = (
     'tastypie',
     'tastypie_mongoengine',
     'mongoengine.django.mongo_auth',
+    'djcelery',
+    'kombu.transport.django',
 
     # project apps
     'hymnbooks.apps.core',
@@ -123,3 +128,122 @@ LOGGING = {
 # Api related
 API_NAME = 'v1'
 MEDIA_POST_REDIRECTS_TO_API = True
+
+# Number of items per page of the media library views.
+MEDIA_PAGE_SIZE = 100
+
+# API key credentials and authenticated users are cached for TTL seconds in
+# the Django cache AUTH_CACHE (an alias of CACHES), so that a rotated or
+# revoked key is refused by every worker at once. It must be shared by the
+# workers (memcached, redis): a local-memory cache raises
+# ImproperlyConfigured. None caches in-process - right only for a single
+# worker, set it (with CACHES) for deployments with several workers.
+AUTH_CACHE = None
+API_KEY_CACHE_TTL = 300
+USER_CACHE_TTL = 300
+
+# Sessions are stored in MongoDB (expired by a TTL index) and cached
+# in-process for SESSION_CACHE_TTL seconds; SESSION_CACHE_SIZE = 0
+# disables the cache.
+SESSION_ENGINE = 'hymnbooks.apps.core.sessions'
+SESSION_CACHE_SIZE = 10000
+SESSION_CACHE_TTL = 60
+
+# Concurrent requests building the same thing (derivative, tile, peaks,
+# cached copy of a file) wait for one build: within a worker in-process,
+# across workers with a lock in the Django cache COALESCE_CACHE (an alias
+# of CACHES). It must be shared by the workers (memcached, redis): a
+# local-memory cache raises ImproperlyConfigured. None coalesces only
+# within a worker - set it (with CACHES) for deployments with several
+# workers. The lock expires after COALESCE_LOCK_TIMEOUT seconds, waiting
+# for it - after COALESCE_LOCK_WAIT.
+COALESCE_CACHE = None
+COALESCE_LOCK_TIMEOUT = 120
+COALESCE_LOCK_WAIT = 30
+
+# Celery. The broker is a local stand-in (kombu's django transport, keeping
+# messages in the SQL db): override BROKER_URL in local_settings with a real
+# broker (amqp://, redis://) for production. Workers: manage.py celery worker
+import djcelery
+djcelery.setup_loader()
+BROKER_URL = 'django://'
+
+# Image derivatives, generated in the background after upload and served
+# with ?size=<name>: name -> (max width, max height, JPEG quality).
+MEDIA_DERIVATIVES = {
+    'thumbnail': (100, 100, 75),
+    'preview': (400, 400, 80),
+    'web': (1200, 1200, 85),
+    }
+
+# Waveform peaks of WAV files (/cms/lib/<id>/peaks/), computed after upload:
+# frames per peak at the finest level, levels are halved down to the
+# minimal number of peaks.
+MEDIA_PEAKS_FRAMES_PER_PEAK = 256
+MEDIA_PEAKS_MIN_LENGTH = 1000
+
+# Folders are deleted in the background, documents (with their GridFS files)
+# are removed in batches of this size.
+MEDIA_DELETE_BATCH_SIZE = 500
+
+# Bulk ingest (manage.py ingest_media, zip uploads to the API): threads
+# streaming files into GridFS and documents per insert.
+MEDIA_INGEST_WORKERS = 4
+MEDIA_INGEST_BATCH_SIZE = 100
+# Zip archives uploaded to the API wait here for a worker: it should be
+# shared by web servers and workers.
+MEDIA_INGEST_ROOT = os.path.join(tempfile.gettempdir(), 'hymnbooks-ingest')
+
+# Storage of new Media library files (see core.storage): 'gridfs' or
+# 'filesystem' (under MEDIA_STORAGE_ROOT, served by nginx from
+# MEDIA_STORAGE_SENDFILE_URL aliased to it, see MEDIA_SENDFILE below).
+# Existing files are moved between them by `migrate_media_storage`. The
+# root should be on a persistent disk shared by web servers and workers.
+MEDIA_STORAGE = 'gridfs'
+MEDIA_STORAGE_ROOT = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'storage')
+MEDIA_STORAGE_SENDFILE_URL = '/protected/storage/'
+
+# MusicXML of pieces is extracted into a compact representation for search
+# (Piece.scores, see core.musicxml). The raw dictionary of the whole file
+# (Piece.scores_dict) is kept only if MUSICXML_RAW_DICT is True.
+MUSICXML_RAW_DICT = False
+# Extraction runs in the background (core.tasks.extract_scores): a run
+# taking longer than this (seconds) is interrupted, the piece being
+# extracted then fails.
+SCORES_EXTRACTION_TIME_LIMIT = 300
+
+# Melodic search (core.melody): melodies of the pieces are indexed by
+# n-grams of MELODY_NGRAM intervals and of MELODY_CONTOUR_NGRAM contour
+# steps in memory of every worker, reloaded after MELODY_INDEX_TTL seconds.
+# A search returns up to MELODY_SEARCH_RESULTS pieces.
+MELODY_NGRAM = 3
+MELODY_CONTOUR_NGRAM = 5
+MELODY_INDEX_TTL = 300
+MELODY_SEARCH_RESULTS = 50
+# Similarity of pieces (core.similarity) returns SIMILARITY_RESULTS pieces.
+SIMILARITY_RESULTS = 20
+
+# Local disk caches of media (GridFS files, IIIF tiles).
+MEDIA_CACHE_ROOT = os.path.join(tempfile.gettempdir(), 'hymnbooks')
+
+# GridFS files up to MEDIA_BLOB_CACHE_MAX_FILE bytes are cached on disk
+# (MEDIA_CACHE_ROOT/blobs, up to MEDIA_BLOB_CACHE_SIZE bytes, 0 disables
+# the cache) and sent by the front proxy:
+# MEDIA_SENDFILE = 'x-sendfile' (Apache mod_xsendfile, lighttpd) or
+# 'x-accel-redirect' (nginx, with an internal location MEDIA_SENDFILE_URL
+# aliased to MEDIA_CACHE_ROOT). With None they are sent by the server's
+# wsgi.file_wrapper (see hymnbooks/wsgi.py).
+MEDIA_BLOB_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+MEDIA_BLOB_CACHE_MAX_FILE = 256 * 1024 * 1024
+MEDIA_SENDFILE = None
+MEDIA_SENDFILE_URL = '/protected/media/'
+
+# IIIF image tiles (/cms/lib/<id>/iiif/...). Decoded levels of the pyramid
+# are kept in memory of a worker, up to IIIF_LEVEL_CACHE_BYTES of decoded
+# pixels (a level larger than that is not kept), rendered tiles - on disk,
+# up to IIIF_TILE_CACHE_SIZE bytes.
+IIIF_TILE_SIZE = 256
+IIIF_LEVEL_CACHE_BYTES = 256 * 1024 * 1024
+IIIF_TILE_CACHE_ROOT = os.path.join(MEDIA_CACHE_ROOT, 'tiles')
+IIIF_TILE_CACHE_SIZE = 512 * 1024 * 1024
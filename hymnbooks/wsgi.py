@@ -30,3 +30,7 @@ application = get_wsgi_application()
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)
+
+# Cached media files are sent by the server's wsgi.file_wrapper.
+from hymnbooks.apps.medialib.blobcache import FileWrapperMiddleware
+application = FileWrapperMiddleware(application)